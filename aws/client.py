@@ -1,28 +1,134 @@
 import os
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
 
 import boto3
+from botocore.config import Config
 
 from .logger import get_logger
 
 
+def _env_number(key: str, cast):
+    value = os.environ.get(key)
+    return cast(value) if value else None
+
+
+class ClientConfig:
+    """
+    Overrides of the `botocore.config.Config` shared by the clients, each one is only set when its environment
+    variable is, otherwise the botocore default applies (e.g. `legacy` retries, a 60 s read timeout)
+    """
+    MAX_POOL_CONNECTIONS = _env_number('AWS_CLIENT_MAX_POOL_CONNECTIONS', int)
+    RETRY_MODE = os.environ.get('AWS_CLIENT_RETRY_MODE') or None
+    MAX_ATTEMPTS = _env_number('AWS_CLIENT_MAX_ATTEMPTS', int)
+    CONNECT_TIMEOUT = _env_number('AWS_CLIENT_CONNECT_TIMEOUT', float)
+    READ_TIMEOUT = _env_number('AWS_CLIENT_READ_TIMEOUT', float)
+
+
+def client_config(max_pool_connections: Optional[int] = ClientConfig.MAX_POOL_CONNECTIONS,
+                  retry_mode: Optional[str] = ClientConfig.RETRY_MODE,
+                  max_attempts: Optional[int] = ClientConfig.MAX_ATTEMPTS,
+                  connect_timeout: Optional[float] = ClientConfig.CONNECT_TIMEOUT,
+                  read_timeout: Optional[float] = ClientConfig.READ_TIMEOUT) -> Config:
+    """ A `Config` with only the options set here, the ones left to None keep their botocore default """
+    retries = {key: value for key, value in [('mode', retry_mode), ('total_max_attempts', max_attempts)]
+               if value is not None}
+    options = {'max_pool_connections': max_pool_connections,
+               'retries': retries or None,
+               'connect_timeout': connect_timeout,
+               'read_timeout': read_timeout}
+    return Config(**{key: value for key, value in options.items() if value is not None})
+
+
+class ClientCache:
+    """
+    Process-wide cache of boto3 sessions (per region & credentials) & of their clients with the default config
+    (per service). Only a hash of the secret key is kept in the keys.
+
+    It pays off where a process creates several wrappers of a service, e.g. an `SSMParameter` per parameter or the
+    `SSMDocument` & `SSMParameter` of a deployment: they share one client & its connection pool instead of each
+    building a client (see `hubapi/benchmark_aws_clients.py`).
+    A wrapper passing its own `config` gets a client of its own, which isn't cached, as configs don't compare by value
+    """
+    _sessions: Dict[Tuple, boto3.session.Session] = {}
+    _clients: Dict[Tuple, object] = {}
+    _lock = threading.Lock()
+    _default_config: Optional[Config] = None
+
+    @staticmethod
+    def _session_key(region: str, access_key_id: Optional[str], secret_access_key: Optional[str]) -> Tuple:
+        secret_hash = hashlib.sha256(secret_access_key.encode('utf-8')).hexdigest() if secret_access_key else None
+        return region, access_key_id, secret_hash
+
+    @classmethod
+    def default_config(cls) -> Config:
+        if cls._default_config is None:
+            cls._default_config = client_config()
+        return cls._default_config
+
+    @classmethod
+    def get(cls, service: str, region: str, access_key_id: Optional[str] = None,
+            secret_access_key: Optional[str] = None, config: Optional[Config] = None):
+        """ The client of `service`, created on first use. A `config` other than the default gets a new client """
+        session_key = cls._session_key(region, access_key_id, secret_access_key)
+        if config is not None and config is not cls._default_config:
+            with cls._lock:
+                return cls._session(session_key, access_key_id, secret_access_key).client(service_name=service,
+                                                                                          config=config)
+
+        key = (service, session_key)
+        client = cls._clients.get(key)
+        if client is None:
+            with cls._lock:
+                client = cls._clients.get(key)
+                if client is None:
+                    client = cls._session(session_key, access_key_id, secret_access_key).client(
+                        service_name=service, config=cls.default_config())
+                    cls._clients[key] = client
+        return client
+
+    @classmethod
+    def _session(cls, session_key: Tuple, access_key_id: Optional[str],
+                 secret_access_key: Optional[str]) -> boto3.session.Session:
+        """ Called with the lock held, boto3 sessions aren't thread-safe """
+        session = cls._sessions.get(session_key)
+        if session is None:
+            session = boto3.session.Session(aws_access_key_id=access_key_id,
+                                            aws_secret_access_key=secret_access_key,
+                                            region_name=session_key[0])
+            cls._sessions[session_key] = session
+        return session
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._clients.clear()
+            cls._sessions.clear()
+            cls._default_config = None
+
+
 class AWSClientWrapper:
     """Wrapper around boto3 to create aws clients 
-    Using Access key & Secret key we create a boto3 client to be used with other services
+    Using Access key & Secret key we get a boto3 client to be used with other services, shared through `ClientCache`
+    by all the wrappers of the same service, region & credentials that keep the default config
     """
 
     def __init__(self, service,
                  access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
                  secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-                 region='us-east-2'):
+                 region='us-east-2',
+                 config: Optional[Config] = None):
         self.logger = get_logger(self.__class__.__name__)
         self._service = service
         self._access_key_id = access_key_id
         self._secret_access_key = secret_access_key
         self._region = region
-        self._client = boto3.client(service_name=self._service,
-                                    aws_access_key_id=self._access_key_id,
-                                    aws_secret_access_key=self._secret_access_key,
-                                    region_name=self._region)
+        self._client = ClientCache.get(service=self._service,
+                                       region=self._region,
+                                       access_key_id=self._access_key_id,
+                                       secret_access_key=self._secret_access_key,
+                                       config=config)
 
     @property
     def client(self):
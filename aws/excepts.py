@@ -22,6 +22,10 @@ class SSMDocumentAssociationFailed(Exception):
     """ Exception to denote failure during `ssm.associate()` """
 
 
+class SSMParameterFailed(Exception):
+    """ Exception to denote failure during `ssm_parameter.put()` & `ssm_parameter.get()` """
+
+
 class LambdaCreateFailed(Exception):
     """ Exception to denote failure during `lambda.create()` """
 
@@ -13,6 +13,12 @@ def is_db_envs_set():
     return all(len(os.environ.get(k, '')) > 0 for k in keys)
 
 
+def db_connection_string():
+    """ Mongodb Atlas connection string built from the db env variables """
+    return f'mongodb+srv://{os.environ.get("JINA_DB_USERNAME")}:{os.environ.get("JINA_DB_PASSWORD")}' \
+           f'@{os.environ.get("JINA_DB_HOSTNAME")}'
+
+
 def is_aws_cred_set():
     """ Checks if access key id & secret access key env variables set """
     keys = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']
@@ -3,7 +3,7 @@ import botocore
 from ..client import AWSClientWrapper
 from ..enums import SSMCreationStatus, SSMAssociationStatus, SSMDeletionStatus, \
     SSMCreationTime, SSMAssociationTime, SSMDeletionTime
-from ..excepts import SSMDocumentCreationFailed, SSMDocumentDeletionFailed
+from ..excepts import SSMDocumentCreationFailed, SSMDocumentDeletionFailed, SSMParameterFailed
 from ..helper import TimeContext, waiter
 from ..logger import get_logger
 
@@ -236,3 +236,40 @@ class SSMDocument:
         except Exception as exp:
             self.logger.error('Please make sure document gets deleted by checking the AWS console..')
             raise SSMDocumentDeletionFailed(f'Document deletion failed with exception {exp}')
+
+
+class SSMParameter:
+    """Wrapper around boto3 to read/write parameters in SSM Parameter Store, `SecureString`s are encrypted by KMS
+    """
+
+    def __init__(self, name, kms_key_id=None):
+        self.logger = get_logger(self.__class__.__name__)
+        self._client_wrapper = AWSClientWrapper(service='ssm')
+        self._client = self._client_wrapper.client
+        self._name = name
+        self._kms_key_id = kms_key_id
+
+    @property
+    def name(self):
+        return self._name
+
+    def put(self, value, secure=True):
+        kwargs = {'KeyId': self._kms_key_id} if secure and self._kms_key_id else {}
+        try:
+            self._client.put_parameter(Name=self._name,
+                                       Value=value,
+                                       Type='SecureString' if secure else 'String',
+                                       Overwrite=True,
+                                       **kwargs)
+            self.logger.info(f'Stored the parameter `{self._name}`')
+        except botocore.exceptions.ClientError as exp:
+            raise SSMParameterFailed(f'Storing the parameter `{self._name}` failed with following exception \n{exp}')
+
+    def get(self, decrypt=True):
+        try:
+            response = self._client.get_parameter(Name=self._name, WithDecryption=decrypt)
+            return response['Parameter']['Value']
+        except self._client.exceptions.ParameterNotFound:
+            self.logger.error(f'Parameter `{self._name}` doesn\'t exist')
+        except botocore.exceptions.ClientError as exp:
+            raise SSMParameterFailed(f'Reading the parameter `{self._name}` failed with following exception \n{exp}')
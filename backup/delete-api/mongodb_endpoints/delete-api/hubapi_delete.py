@@ -1,101 +1,51 @@
 import os
 import json
-import base64
-import logging
-from typing import Optional, Dict, List, Union
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
 
 import pymongo
 
+from hubdb import (DB_ENV_KEYS, MongoDBException, MongoDBHandler, get_logger, is_db_envs_set, read_env,
+                   read_db_params, archive_collection_name, refresh_catalogue, forget_pushes, tombstone_update,
+                   TOMBSTONE_FIELD, DELETED_AT_FIELD, log_latency, json_response as _return_json_builder)
 
-def get_logger(context='generic', file=True):
-    logger = logging.getLogger(context)
-    logger.setLevel(logging.DEBUG)
-    return logger
+# Documents deleted per round trip, so that no single delete holds its locks for long
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000
 
+# Matching builds listed in the response of a dry run
+PREVIEW_SIZE = 20
 
-class MongoDBException(Exception):
-    """ Any errors raised by MongoDb """
+# No new batch starts once the invocation has less than this left, the caller re-sends the request for the rest
+TIME_MARGIN_MS = 3000
 
+# Soft deleted builds are kept this long (so they can be restored) before the compaction removes them
+DEFAULT_COMPACTION_GRACE_HOURS = 72
 
-class MongoDBHandler:
-    """
-    Mongodb Handler to connect to the database & insert documents in the collection
-    """
 
-    def __init__(self, hostname: str, username: str, password: str,
-                 database_name: str, collection_name: str):
-        self.logger = get_logger(self.__class__.__name__)
-        self.hostname = hostname
-        self.username = username
-        self.password = password
-        self.database_name = database_name
-        self.collection_name = collection_name
-        self.connection_string = \
-            f'mongodb+srv://{self.username}:{self.password}@{self.hostname}'
-
-    def __enter__(self):
-        return self.connect()
-
-    def connect(self) -> 'MongoDBHandler':
-        try:
-            self.client = pymongo.MongoClient(self.connection_string)
-            self.client.admin.command('ismaster')
-            self.logger.info('Successfully connected to the database')
-        except pymongo.errors.ConnectionFailure:
-            raise MongoDBException('Database server is not available')
-        except pymongo.errors.ConfigurationError:
-            raise MongoDBException('Credentials passed are not correct!')
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
-        except Exception as exp:
-            raise MongoDBException(exp)
-        return self
-
-    @property
-    def database(self):
-        return self.client[self.database_name]
-
-    @property
-    def collection(self):
-        return self.database[self.collection_name]
-
-    def delete(self, query: Dict[str, Union[Dict, List]]) -> None:
-        try:
-            # Deletes all the entries matching the query criteria from mongo.
-            # justOne is set to False to delete all matching entries.
-            return self.collection.remove(query, False)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while deleting a document in the db {exp}')
-
-    def insert(self, document: str) -> Optional[str]:
-        try:
-            result = self.collection.insert_one(document)
-            self.logger.info(f'Pushed current summary to the database')
-            return result.inserted_id
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while inserting a document in the db {exp}')
-
-    def replace(self, document: Dict, query: Dict):
-        try:
-            result = self.collection.replace_one(query, document)
-            return result.modified_count
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while replacing a document in the db {exp}')
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            self.client.close()
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
-
-
-def is_db_envs_set():
-    """ Checks if any of the db env variables are not set """
-    keys = ['JINA_DB_HOSTNAME', 'JINA_DB_USERNAME', 'JINA_DB_PASSWORD', 'JINA_DB_NAME', 'JINA_DB_COLLECTION']
-    return all(len(os.environ.get(k, '')) > 0 for k in keys)
-
-
-def _query_builder(params: Dict):
+class DeleteMode:
+    # Tombstones the builds, `hubapi_list` stops showing them right away & the compaction removes them later
+    SOFT = 'soft'
+    # Lifts the tombstones of soft deleted builds that weren't compacted yet
+    RESTORE = 'restore'
+    # Removes soft deleted builds, their metadata & archived build history for good
+    PURGE = 'purge'
+
+
+# Builds each mode applies to, among the ones matching the filters
+MODE_QUERIES = {
+    DeleteMode.SOFT: {TOMBSTONE_FIELD: False},
+    DeleteMode.RESTORE: {TOMBSTONE_FIELD: True},
+    DeleteMode.PURGE: {TOMBSTONE_FIELD: True}
+}
+
+# A hubpod document & its metadata document share these fields
+BUILD_KEY_FIELDS = ['name', 'version', 'jina_version']
+BUILD_KEY_PROJECTION = {field: 1 for field in BUILD_KEY_FIELDS}
+
+
+def _query_builder(params: Dict) -> Tuple[Dict, int]:
     logger = get_logger(context='query_builder')
     logger.info(f'Got the following parans: {params}')
 
@@ -116,10 +66,14 @@ def _query_builder(params: Dict):
         keywords_list = params['keywords'].split(',')
         keyword_query = {'manifest_info.keywords': {'$in': keywords_list}}
         sub_query.append(keyword_query)
+    for field in ['version', 'jina_version']:
+        if field in params:
+            sub_query.append({field: params[field]})
 
-    # A limit() value of 0 (i.e. limit(0)) is equivalent to setting no limit.
-    # Retrieves all matched documents.
-    limit = params.get('limit', 0)
+    # A limit of 0 is equivalent to setting no limit, every matched document gets deleted.
+    limit = int(params.get('limit', 0))
+    if limit < 0:
+        raise ValueError(f'limit should be positive, got {limit}')
 
     if sub_query:
         _executor_query = {'$and': sub_query}
@@ -127,56 +81,229 @@ def _query_builder(params: Dict):
         return _executor_query, limit
     else:
         # select ALL
-        # force the cursor to iterate over each object
         return {}, limit
 
 
-def _return_json_builder(body, status):
-    return {
-        "isBase64Encoded": False,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "statusCode": int(status),
-        "body": body
-    }
+def _batch_size(params: Dict) -> int:
+    batch_size = int(params.get('batch-size', DEFAULT_BATCH_SIZE))
+    if not 0 < batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f'batch-size should be between 1 & {MAX_BATCH_SIZE}, got {batch_size}')
+    return batch_size
+
+
+def _build_key(document: Dict) -> Dict:
+    return {field: document.get(field) for field in BUILD_KEY_FIELDS}
+
+
+def _mode_query(query: Dict, mode: str) -> Dict:
+    return {'$and': [query, MODE_QUERIES[mode]]}
+
 
+def _find(db: MongoDBHandler, query: Dict, limit: int = 0) -> List[Dict]:
+    """ Build keys (& `_id`) of the hubpod documents matching `query`, raises if they can't be read """
+    documents = db.find(query, projection=BUILD_KEY_PROJECTION, limit=limit)
+    if documents is None:
+        raise MongoDBException('Couldn\'t find the matching builds, see the logs')
+    return list(documents)
 
-def str_to_ascii_to_base64_to_str(text):
-    return base64.b64decode(text.encode('ascii')).decode('ascii')
 
+def _matching_build_keys(db: MongoDBHandler, build_keys: List[Dict], query: Dict) -> List[Dict]:
+    """ The build keys whose hubpod document matches `query` """
+    matching = {tuple(_build_key(document).values()) for document in _find(db, {'$and': [{'$or': build_keys}, query]})}
+    return [build_key for build_key in build_keys if tuple(build_key.values()) in matching]
 
-def read_environment():
-    hostname = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_HOSTNAME'))
-    username = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_USERNAME'))
-    password = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_PASSWORD'))
-    database_name = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_NAME'))
-    collection_name = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_COLLECTION'))
-    return hostname, username, password, database_name, collection_name
 
+def _removed_build_keys(db: MongoDBHandler, build_keys: List[Dict]) -> List[Dict]:
+    """ The build keys without a hubpod document left, i.e. the ones not pushed again since they were found """
+    left = {tuple(_build_key(document).values()) for document in _find(db, {'$or': build_keys})}
+    return [build_key for build_key in build_keys if tuple(build_key.values()) not in left]
 
+
+def preview_delete(query: Dict, limit: int, db_params: Dict, hubpod_collection: str,
+                   mode: str = DeleteMode.SOFT) -> Dict:
+    """ What a delete with the same filters & mode would change, without changing anything """
+    query = _mode_query(query, mode)
+    with MongoDBHandler(**db_params, collection_name=hubpod_collection) as db:
+        matched = db.count(query)
+        if matched is None:
+            raise MongoDBException('Couldn\'t count the matching builds')
+        preview = [_build_key(document) for document in _find(db, query, limit=PREVIEW_SIZE)]
+    return {'dry_run': True, 'mode': mode, 'matched': matched, 'to_delete': min(matched, limit) if limit else matched,
+            'preview': preview}
+
+
+def delete_builds(query: Dict, limit: int, batch_size: int, db_params: Dict, hubpod_collection: str,
+                  metadata_collection: str, logger, time_left: Optional[Callable[[], int]] = None,
+                  mode: str = DeleteMode.SOFT, refresh: bool = True, deleted_before: Optional[datetime] = None) -> Dict:
+    """
+    Applies `mode` to the hubpod documents matching `query` (at most `limit` of them, all for 0), `batch_size`
+    at a time by `_id`, & to their metadata documents. Purging (only builds soft deleted before `deleted_before`,
+    if set) also removes the archived build history. Every write re-checks the filters, a build pushed again
+    between the `find` & the write of its batch is left alone, & so are its metadata & history.
+    The latest images of the affected executors are refreshed once at the end, unless `refresh` is off, & their
+    remembered push responses dropped, so pushing a deleted build again isn't answered with a replay.
+    `time_left` returns the milliseconds left in the invocation, no batch starts under `TIME_MARGIN_MS`.
+    Re-sending the same request continues where an incomplete delete stopped
+    """
+    query = _mode_query(query, mode)
+    if deleted_before is not None:
+        query['$and'].append({DELETED_AT_FIELD: {'$lt': deleted_before}})
+    progress = {'mode': mode, 'nRemoved': 0, 'metadataRemoved': 0, 'complete': False, 'batches': []}
+    names = set()
+    with MongoDBHandler(**db_params, collection_name=hubpod_collection) as hubpod_db, \
+            MongoDBHandler(**db_params, collection_name=metadata_collection) as metadata_db, \
+            MongoDBHandler(**db_params, collection_name=archive_collection_name(metadata_collection)) as archive_db:
+        while True:
+            size = min(batch_size, limit - progress['nRemoved']) if limit else batch_size
+            if size <= 0:
+                progress['complete'] = True
+                break
+            if time_left is not None and time_left() < TIME_MARGIN_MS:
+                logger.warning(f'Stopping after {len(progress["batches"])} batches, running out of time')
+                break
+
+            start = time.perf_counter()
+            batch = _find(hubpod_db, query, limit=size)
+            if not batch:
+                progress['complete'] = True
+                break
+            build_keys = [_build_key(document) for document in batch]
+            ids_query = {'$and': [{'_id': {'$in': [document['_id'] for document in batch]}}, query]}
+            if mode == DeleteMode.PURGE:
+                removed = hubpod_db.delete(ids_query)
+                removed_keys = _removed_build_keys(hubpod_db, build_keys) if removed else []
+                metadata_removed = 0
+                if removed_keys:
+                    # pushing a build again lifts the tombstone of its metadata document as well
+                    metadata_removed = metadata_db.delete({'$and': [{'$or': removed_keys},
+                                                                    MODE_QUERIES[DeleteMode.PURGE]]})
+                    archive_db.delete({'$or': removed_keys})
+            else:
+                # every document gets its tombstone (un)set atomically, re-running a batch changes nothing more
+                deleted = mode == DeleteMode.SOFT
+                update = tombstone_update(deleted=deleted)
+                removed = hubpod_db.update_many(ids_query, update)
+                # only the metadata of the builds whose hubpod document ended up (un)tombstoned, not of those pushed
+                # again (or restored) in between
+                changed_keys = []
+                if removed:
+                    changed_keys = _matching_build_keys(hubpod_db, build_keys, {TOMBSTONE_FIELD: deleted})
+                metadata_removed = metadata_db.update_many({'$and': [{'$or': changed_keys}, MODE_QUERIES[mode]]},
+                                                           update) if changed_keys else 0
+            if removed is None:
+                raise MongoDBException(f'Batch {len(progress["batches"]) + 1} failed, see the logs')
+            metadata_removed = metadata_removed or 0
+            names.update(build_key['name'] for build_key in build_keys)
+
+            progress['nRemoved'] += removed
+            progress['metadataRemoved'] += metadata_removed
+            progress['batches'].append({'nRemoved': removed, 'metadataRemoved': metadata_removed,
+                                        'ms': round((time.perf_counter() - start) * 1000, 1)})
+            logger.info(f'Batch {len(progress["batches"])}: {mode} deleted {removed} builds & {metadata_removed} '
+                        f'metadata documents, {progress["nRemoved"]} so far')
+
+        if not progress['complete']:
+            progress['remaining'] = hubpod_db.count(query)
+
+    if names:
+        forget_pushes(names=sorted(names), db_params=db_params, metadata_collection=metadata_collection)
+    if names and refresh:
+        refresh_catalogue(names=sorted(names), db_params=db_params, hubpod_collection=hubpod_collection,
+                          logger=logger)
+    return progress
+
+
+def _is_dry_run(params: Dict) -> bool:
+    return str(params.get('dry-run', 'false')).lower() == 'true'
+
+
+def _mode(params: Dict) -> str:
+    mode = params.get('mode', DeleteMode.SOFT)
+    if mode not in MODE_QUERIES:
+        raise ValueError(f'mode should be one of {sorted(MODE_QUERIES)}, got {mode}')
+    return mode
+
+
+@log_latency
 def lambda_handler(event, context):
-    """Lambda handler to read data from Mongodb Atlas (Used to perform `jina hub delete`)
+    """Lambda handler to delete data from Mongodb Atlas (Used to perform `jina hub delete`)
+
+    `mode` is `soft` (default, tombstones the builds), `restore` (lifts the tombstones) or `purge` (removes the
+    soft deleted builds for good). `dry-run=true` only reports what would change. Otherwise the matching builds are changed
+    in batches of `batch-size`, cascading to the metadata & latest collections, until done or the invocation
+    runs out of time (`complete` is false in the response then, & the same request continues the delete)
     """
     logger = get_logger(context='hub_delete')
 
-    if not is_db_envs_set():
+    if not is_db_envs_set(keys=DB_ENV_KEYS + ('JINA_DB_COLLECTION', 'JINA_METADATA_COLLECTION')):
         logger.warning('MongoDB environment vars are not set! book-keeping skipped.')
         return _return_json_builder(body='Invalid Lambda environment',
                                     status=500)
 
-    _executor_query = _query_builder(params=event.get('queryStringParameters', {}))
-
-    hostname, username, password, database_name, collection_name = read_environment()
-    with MongoDBHandler(hostname=hostname, username=username, password=password,
-                        database_name=database_name, collection_name=collection_name) as db:
-        write_result = db.delete(*_executor_query)
-        if write_result:
-            if write_result['nRemoved'] > 0:
-                return _return_json_builder(body=json.dumps({"delete_info": write_result}),
-                                            status=200)
-            return _return_json_builder(body="No docs found for deletion",
+    params = event.get('queryStringParameters') or {}
+    try:
+        _executor_query, limit = _query_builder(params=params)
+        batch_size = _batch_size(params=params)
+        mode = _mode(params=params)
+    except ValueError as exp:
+        return _return_json_builder(body=f'Invalid filters passed: {exp}',
+                                    status=400)
+
+    db_params = read_db_params()
+    hubpod_collection = read_env('JINA_DB_COLLECTION')
+    try:
+        if _is_dry_run(params):
+            return _return_json_builder(body=json.dumps(preview_delete(query=_executor_query, limit=limit,
+                                                                       db_params=db_params,
+                                                                       hubpod_collection=hubpod_collection,
+                                                                       mode=mode)),
+                                        status=200)
+
+        if not _executor_query:
+            return _return_json_builder(body='Refusing to delete every image, pass at least one filter',
                                         status=400)
 
-    return _return_json_builder(body='Invalid filters passed',
-                                status=400)
+        progress = delete_builds(query=_executor_query, limit=limit, batch_size=batch_size, db_params=db_params,
+                                 hubpod_collection=hubpod_collection,
+                                 metadata_collection=read_env('JINA_METADATA_COLLECTION'), logger=logger,
+                                 time_left=getattr(context, 'get_remaining_time_in_millis', None), mode=mode)
+    except (MongoDBException, pymongo.errors.PyMongoError) as exp:
+        logger.error(f'Got following exception during `hub_delete` {exp!r}')
+        return _return_json_builder(body='Mongodb Delete Failed. Please check Lambda logs',
+                                    status=502)
+
+    if progress['nRemoved'] == 0 and progress['complete']:
+        return _return_json_builder(body="No docs found for deletion",
+                                    status=400)
+    return _return_json_builder(body=json.dumps({"delete_info": progress}),
+                                status=200)
+
+
+@log_latency
+def compaction_handler(event, context):
+    """Scheduled Lambda handler removing the builds soft deleted over `JINA_COMPACTION_GRACE_HOURS` ago
+
+    Runs off-peak, in batches like `purge` deletes. Whatever doesn't fit in one invocation is left for the next run
+    """
+    logger = get_logger(context='hub_compaction')
+
+    if not is_db_envs_set(keys=DB_ENV_KEYS + ('JINA_DB_COLLECTION', 'JINA_METADATA_COLLECTION')):
+        logger.warning('MongoDB environment vars are not set! compaction skipped.')
+        return {'complete': False}
+
+    grace_hours = float(os.environ.get('JINA_COMPACTION_GRACE_HOURS') or DEFAULT_COMPACTION_GRACE_HOURS)
+    deleted_before = datetime.utcnow() - timedelta(hours=grace_hours)
+    try:
+        # tombstoned builds already left the latest collection when they were soft deleted
+        progress = delete_builds(query={}, limit=0, batch_size=MAX_BATCH_SIZE, db_params=read_db_params(),
+                                 hubpod_collection=read_env('JINA_DB_COLLECTION'),
+                                 metadata_collection=read_env('JINA_METADATA_COLLECTION'), logger=logger,
+                                 time_left=getattr(context, 'get_remaining_time_in_millis', None),
+                                 mode=DeleteMode.PURGE, refresh=False, deleted_before=deleted_before)
+    except (MongoDBException, pymongo.errors.PyMongoError) as exp:
+        logger.error(f'Got following exception during the compaction {exp!r}')
+        return {'complete': False}
+
+    logger.info(f'Compaction removed {progress["nRemoved"]} builds & {progress["metadataRemoved"]} metadata '
+                f'documents, complete: {progress["complete"]}')
+    return {key: progress[key] for key in ['nRemoved', 'metadataRemoved', 'complete']}
@@ -1,60 +1,261 @@
+import base64
+import json
 import os
+import sys
+from datetime import datetime, timedelta
 
-import json
-import logging
+import mongomock
 import pymongo
 import pytest
-import mongomock
-import mock
 
-from jina.docker.hubio import HubIO
+# `delete-api` isn't a package, its handler is deployed as a standalone module next to the `hubdb` layer
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'delete-api'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', '..', '..', '..'))
 
-from ....delete-api.hubapi_delete import MongoDBHandler
-from ....delete-api.hubapi_delete import lambda_handler
-from jina.docker.hubapi import JAML
+import hubdb
+import hubapi_delete
+from lambda_handlers import hubapi_push
 
 
-def get_logger(context='generic', file=True):
-    logger = logging.getLogger(context)
-    logger.setLevel(logging.DEBUG)
-    return logger
+def _encode(text):
+    return base64.b64encode(text.encode('ascii')).decode('ascii')
+
 
 @pytest.fixture
-def mock_pymongo_mongoclient():
-    return mongomock.MongoClient()
-
-def test_delete(mocker, monkeypatch, mock_pymongo_mongoclient):
-    monkeypatch.setattr(pymongo, "MongoClient", mock_pymongo_mongoclient)
-    monkeypatch.setenv('JINA_DB_HOSTNAME', "TestingHost")
-    monkeypatch.setenv('JINA_DB_USERNAME', "TestingUser")
-    monkeypatch.setenv('JINA_DB_PASSWORD', "TestingPassword")
-    monkeypatch.setenv('JINA_DB_NAME', "TestingName")
-    monkeypatch.setenv('JINA_DB_COLLECTION', "TestingCollection")
-
-    mock_client = mocker.patch.object(MongoDBHandler, 'client', autospec=True)
-    mock_client.return_value = mock_pymongo_mongoclient
-    mock_client.return_value.find_many = MongoDBHandler.find_many
-
-    sample_collection_objects = [{'_id':1, 'name': 'first', 'manifest_info':{'kind': 'encoder', 'type': 'pod'}}, {'_id':2, 'name': 'second', 'manifest_info':{'kind': 'encoder', 'type': 'pod'}}]
-    mock_collection = mongomock.MongoClient().db.collection
-    for obj in sample_collection_objects:
-        obj['_id'] = mock_collection.insert_one(obj).inserted_id
-    mock_client.return_value.collection = mock_collection
-
-
-    mock_connect = mocker.patch.object(MongoDBHandler, 'connect', autospec=True)
-    mock_connect.return_value = mock_pymongo_mongoclient
-    mock_connect.return_value.close = None
-  
-    objs = []
-    read_file = open('mongo_list_objs.json', "r")
-    mongo_objs = json.load(read_file)
-    objs = mongo_objs["collection"]
-    mock_pymongo_mongoclient.collection = objs
-   
-    event = None
-    with open('event.json', "r") as read_file:
-        event = json.load(read_file)
-
-    lambda_handler(event, None)
+def hub_db(monkeypatch):
+    envs = {
+        'JINA_DB_HOSTNAME': 'TestingHost',
+        'JINA_DB_USERNAME': 'TestingUser',
+        'JINA_DB_PASSWORD': 'TestingPassword',
+        'JINA_DB_NAME': 'TestingName',
+        'JINA_DB_COLLECTION': 'hubpod',
+        'JINA_HUBPOD_COLLECTION': 'hubpod',
+        'JINA_METADATA_COLLECTION': 'metadata'
+    }
+    for key, value in envs.items():
+        monkeypatch.setenv(key, _encode(value))
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongomock.database.Database, 'command', lambda *args, **kwargs: {'ok': 1},
+                        raising=False)
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setattr(hubdb.MongoClientRegistry, '_clients', {})
+    hubdb.reset_environment()
+    yield client[envs['JINA_DB_NAME']]
+    hubdb.reset_environment()
+
+
+class LambdaContext:
+    """ Stands in for the Lambda context, with `remaining` milliseconds left on each call """
+
+    def __init__(self, *remaining):
+        self.remaining = list(remaining)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining.pop(0) if len(self.remaining) > 1 else self.remaining[0]
+
+
+def push(name='jinahub/pod.encoder.dummyencoder', version='0.0.1', kind='encoder'):
+    summary = {
+        'name': name,
+        'version': version,
+        'jina_version': '1.0.0',
+        'manifest_info': {'name': name.split('.')[-1], 'kind': kind, 'type': 'pod', 'keywords': ['numeric']},
+        'details': {},
+        'is_build_success': True,
+        'build_history': {'time': '2020-10-22'}
+    }
+    response = hubapi_push.lambda_handler({'body': json.dumps(summary)}, None)
+    assert response['statusCode'] == 200
+    return response
+
+
+def delete(context=None, **params):
+    return hubapi_delete.lambda_handler({'queryStringParameters': params}, context)
+
+
+def test_delete(hub_db):
+    push(name='jinahub/pod.encoder.first')
+    push(name='jinahub/pod.encoder.second')
+    push(name='jinahub/pod.crafter.third', kind='crafter')
+
+    response = delete(kind='encoder')
+    assert response['statusCode'] == 200
+    progress = json.loads(response['body'])['delete_info']
+    assert progress['mode'] == 'soft' and progress['complete']
+    assert progress['nRemoved'] == 2 and progress['metadataRemoved'] == 2
+
+    assert hub_db['hubpod'].count_documents({'_deleted': True}) == 2
+    assert hub_db['metadata'].count_documents({'_deleted': True}) == 2
+    assert [document['_id'] for document in hub_db['hubpod_latest'].find()] == ['jinahub/pod.crafter.third']
+
+    # nothing left to soft delete
+    assert delete(kind='encoder')['statusCode'] == 400
+
+
+def test_delete_in_batches(hub_db):
+    for patch in range(5):
+        push(version=f'0.0.{patch}')
+
+    progress = json.loads(delete(kind='encoder', limit='3', **{'batch-size': '2'})['body'])['delete_info']
+    assert [batch['nRemoved'] for batch in progress['batches']] == [2, 1]
+    assert progress['nRemoved'] == 3 and progress['complete']
+
+    progress = json.loads(delete(kind='encoder', **{'batch-size': '1'})['body'])['delete_info']
+    assert [batch['nRemoved'] for batch in progress['batches']] == [1, 1]
+    assert hub_db['hubpod'].count_documents({'_deleted': False}) == 0
+
+
+def test_delete_stops_before_running_out_of_time(hub_db):
+    for patch in range(3):
+        push(version=f'0.0.{patch}')
+
+    context = LambdaContext(60000, hubapi_delete.TIME_MARGIN_MS - 1)
+    progress = json.loads(delete(context, kind='encoder', **{'batch-size': '1'})['body'])['delete_info']
+    assert len(progress['batches']) == 1
+    assert not progress['complete'] and progress['remaining'] == 2
+
+    # re-sending the same request continues the delete
+    progress = json.loads(delete(LambdaContext(60000), kind='encoder', **{'batch-size': '1'})['body'])['delete_info']
+    assert progress['nRemoved'] == 2 and progress['complete']
+
+
+def test_delete_dry_run(hub_db):
+    for patch in range(3):
+        push(version=f'0.0.{patch}')
+
+    response = delete(kind='encoder', limit='2', **{'dry-run': 'true'})
+    assert response['statusCode'] == 200
+    preview = json.loads(response['body'])
+    assert preview['dry_run'] and preview['mode'] == 'soft'
+    assert preview['matched'] == 3 and preview['to_delete'] == 2
+    assert sorted(build['version'] for build in preview['preview']) == ['0.0.0', '0.0.1', '0.0.2']
+    assert hub_db['hubpod'].count_documents({'_deleted': False}) == 3
+
+    # a dry run without filters is allowed, it only reports
+    assert json.loads(delete(**{'dry-run': 'true', 'mode': 'purge'})['body'])['matched'] == 0
+
+
+def test_soft_delete_restore_purge(hub_db):
+    push(version='0.0.1')
+    push(version='0.0.2')
+
+    assert delete(version='0.0.2')['statusCode'] == 200
+    assert hub_db['hubpod_latest'].find_one()['version'] == '0.0.1'
+
+    assert delete(version='0.0.2', mode='restore')['statusCode'] == 200
+    assert hub_db['hubpod_latest'].find_one()['version'] == '0.0.2'
+    assert hub_db['metadata'].count_documents({'_deleted': True}) == 0
+
+    # only soft deleted builds are purged
+    assert delete(version='0.0.2', mode='purge')['statusCode'] == 400
+    assert hub_db['hubpod'].count_documents({}) == 2
+
+    delete(version='0.0.2')
+    progress = json.loads(delete(version='0.0.2', mode='purge')['body'])['delete_info']
+    assert progress['nRemoved'] == 1 and progress['metadataRemoved'] == 1
+    assert [document['version'] for document in hub_db['hubpod'].find()] == ['0.0.1']
+    assert [document['version'] for document in hub_db['metadata'].find()] == ['0.0.1']
+    assert [document['version'] for document in hub_db['metadata_archive'].find()] == ['0.0.1']
+
+
+def test_purge_skips_builds_pushed_again(hub_db, monkeypatch):
+    push(version='0.0.1')
+    push(version='0.0.2')
+    delete(kind='encoder')
+
+    find = hubdb.MongoDBHandler.find
+
+    def _find_then_push(self, *args, **kwargs):
+        documents = list(find(self, *args, **kwargs) or [])
+        monkeypatch.setattr(hubdb.MongoDBHandler, 'find', find)
+        # 0.0.2 gets pushed again in between the `find` of the batch & its delete
+        push(version='0.0.2')
+        return documents
+
+    monkeypatch.setattr(hubdb.MongoDBHandler, 'find', _find_then_push)
+    progress = json.loads(delete(kind='encoder', mode='purge')['body'])['delete_info']
+    assert progress['nRemoved'] == 1 and progress['metadataRemoved'] == 1
+
+    assert [document['version'] for document in hub_db['hubpod'].find()] == ['0.0.2']
+    assert hub_db['metadata'].find_one({'version': '0.0.2'})['build_count'] == 2
+    assert hub_db['metadata_archive'].find_one({'version': '0.0.2'})['count'] == 2
+
+
+def test_soft_delete_skips_metadata_of_builds_pushed_again(hub_db, monkeypatch):
+    push(version='0.0.1')
+    push(version='0.0.2')
+
+    update_many = hubdb.MongoDBHandler.update_many
+
+    def _update_then_push(self, *args, **kwargs):
+        modified = update_many(self, *args, **kwargs)
+        monkeypatch.setattr(hubdb.MongoDBHandler, 'update_many', update_many)
+        # 0.0.2 gets pushed again (not an idempotent replay) in between the hubpod & the metadata update of the batch
+        hub_db['metadata_idempotency'].delete_many({})
+        push(version='0.0.2')
+        return modified
+
+    monkeypatch.setattr(hubdb.MongoDBHandler, 'update_many', _update_then_push)
+    progress = json.loads(delete(kind='encoder', limit='2')['body'])['delete_info']
+    assert progress['nRemoved'] == 2 and progress['metadataRemoved'] == 1
+
+    assert hub_db['hubpod'].find_one({'version': '0.0.2'})['_deleted'] is False
+    assert hub_db['metadata'].find_one({'version': '0.0.2'})['_deleted'] is False
+    assert hub_db['metadata'].find_one({'version': '0.0.1'})['_deleted'] is True
+
+
+def test_delete_find_failure(hub_db, monkeypatch):
+    push()
+    # `MongoDBHandler.find` returns `None` when the query fails
+    monkeypatch.setattr(hubdb.MongoDBHandler, 'find', lambda *args, **kwargs: None)
+    assert delete(kind='encoder')['statusCode'] == 502
+    assert delete(kind='encoder', **{'dry-run': 'true'})['statusCode'] == 502
+    assert hub_db['hubpod'].count_documents({'_deleted': False}) == 1
+
+
+def test_push_again_after_delete(hub_db):
+    push(version='0.0.1')
+    assert delete(version='0.0.1')['statusCode'] == 200
+    assert hub_db['metadata_idempotency'].count_documents({}) == 0
+
+    # the same push within the idempotency window writes the build again instead of replaying the first response
+    assert 'Idempotent-Replayed' not in push(version='0.0.1')['headers']
+    assert hub_db['hubpod'].find_one()['_deleted'] is False
+    assert hub_db['hubpod_latest'].find_one()['version'] == '0.0.1'
+
+
+@pytest.mark.parametrize('params', [
+    {},
+    {'limit': '10'},
+    {'kind': 'encoder', 'limit': '-1'},
+    {'kind': 'encoder', 'limit': 'all'},
+    {'kind': 'encoder', 'batch-size': '0'},
+    {'kind': 'encoder', 'batch-size': str(hubapi_delete.MAX_BATCH_SIZE + 1)},
+    {'kind': 'encoder', 'mode': 'hard'},
+])
+def test_delete_rejects_invalid_params(hub_db, params):
+    push()
+    assert delete(**params)['statusCode'] == 400
+    assert hub_db['hubpod'].count_documents({'_deleted': False}) == 1
+
+
+def test_compaction(hub_db, monkeypatch):
+    monkeypatch.setenv('JINA_COMPACTION_GRACE_HOURS', '72')
+    for patch in range(3):
+        push(version=f'0.0.{patch}')
+    delete(kind='encoder', version='0.0.0')
+    delete(kind='encoder', version='0.0.1')
+    hub_db['hubpod'].update_one({'version': '0.0.0'},
+                                {'$set': {'_deleted_at': datetime.utcnow() - timedelta(hours=73)}})
+
+    progress = hubapi_delete.compaction_handler({}, LambdaContext(60000))
+    assert progress == {'nRemoved': 1, 'metadataRemoved': 1, 'complete': True}
+    assert sorted(document['version'] for document in hub_db['hubpod'].find()) == ['0.0.1', '0.0.2']
+    assert sorted(document['version'] for document in hub_db['metadata'].find()) == ['0.0.1', '0.0.2']
+    assert sorted(document['version'] for document in hub_db['metadata_archive'].find()) == ['0.0.1', '0.0.2']
 
+    # the build soft deleted within the grace period can still be restored
+    assert delete(version='0.0.1', mode='restore')['statusCode'] == 200
+    assert hub_db['hubpod_latest'].find_one()['version'] == '0.0.2'
+    assert hubapi_delete.compaction_handler({}, None)['nRemoved'] == 0
@@ -0,0 +1,214 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import click
+import pymongo
+from bson import ObjectId
+
+sys.path.append('..')
+
+from aws.helper import db_connection_string
+from aws.logger import get_logger
+from hubdb import (TOMBSTONE_FIELD, CATALOGUE_GENERATION_ID, search_fields, latest_collection_name,
+                   generation_collection_name, archive_collection_name, latest_images_pipeline,
+                   build_latest_document)
+from lambda_handlers.hubapi_push import (version_sort_key, BUILD_HISTORY_BUCKET_SIZE, BUILD_HISTORY_INLINE,
+                                         BUILD_KEY_FIELDS)
+
+BATCH_SIZE = 1000
+
+
+def is_db_envs_set():
+    """ Checks if any of the db env variables needed for the backfill are not set """
+    keys = ['JINA_DB_HOSTNAME', 'JINA_DB_USERNAME', 'JINA_DB_PASSWORD', 'JINA_DB_NAME', 'JINA_HUBPOD_COLLECTION']
+    return all(len(os.environ.get(k, '')) > 0 for k in keys)
+
+
+def _write_in_batches(collection, requests, logger):
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) == BATCH_SIZE:
+            collection.bulk_write(batch, ordered=False)
+            logger.info(f'Wrote {len(batch)} documents to `{collection.name}`')
+            batch = []
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        logger.info(f'Wrote {len(batch)} documents to `{collection.name}`')
+
+
+def dedupe_builds(database, collection, logger):
+    """
+    Deletes all but one document per build (`name`, `version`, `jina_version`), left by concurrent pushes that
+    upserted the same build before it had a unique index. Keeps a live document over a soft deleted one, then the
+    most recently inserted. Run this before `indexes.ensure_indexes`, which fails to build the unique `build_key`
+    index over duplicates. Unlike the backfills it deletes documents, so it only runs when asked for explicitly.
+    """
+    cursor = database[collection].aggregate([
+        {'$sort': {TOMBSTONE_FIELD: 1, '_id': -1}},
+        {'$group': {'_id': {key: f'${key}' for key in BUILD_KEY_FIELDS}, 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}}
+    ], allowDiskUse=True)
+    requests = []
+    for duplicates in cursor:
+        logger.warning(f'Deleting {len(duplicates["ids"]) - 1} duplicate(s) of {duplicates["_id"]} from '
+                       f'`{collection}`, keeping `{duplicates["ids"][0]}`')
+        requests.extend(pymongo.DeleteOne({'_id': _id}) for _id in duplicates['ids'][1:])
+    _write_in_batches(database[collection], requests, logger)
+
+
+def backfill_search(database, hubpod_collection, logger):
+    """ Adds the `_search` fields (written by `hubapi_push` on every push) to older hubpod documents """
+    cursor = database[hubpod_collection].find({'_search': {'$exists': False}},
+                                              projection={'name': 1, 'manifest_info.name': 1})
+    requests = (pymongo.UpdateOne({'_id': document['_id']},
+                                  {'$set': {'_search': search_fields(document['name'],
+                                                                     document.get('manifest_info', {}).get('name'))}})
+                for document in cursor)
+    _write_in_batches(database[hubpod_collection], requests, logger)
+
+
+def backfill_sort_key(database, hubpod_collection, logger):
+    """
+    Adds the packed `_sort_key` (written by `hubapi_push` on every push) to older hubpod documents.
+    Run this before deploying `hubapi_list`, which sorts on it.
+    """
+    cursor = database[hubpod_collection].find({'_sort_key': {'$exists': False}},
+                                              projection={'version': 1, 'jina_version': 1})
+    requests = []
+    for document in cursor:
+        try:
+            sort_key = version_sort_key(jina_version=document['jina_version'], version=document['version'])
+        except (KeyError, ValueError, AttributeError) as exp:
+            logger.warning(f'Skipping `{document["_id"]}` without a valid semver {exp!r}')
+            continue
+        requests.append(pymongo.UpdateOne({'_id': document['_id']}, {'$set': {'_sort_key': sort_key}}))
+    _write_in_batches(database[hubpod_collection], requests, logger)
+
+
+def backfill_tombstone(database, collection, logger):
+    """
+    Marks older documents as live (`_deleted: False`, written by `hubapi_push` on every push).
+    Run this before deploying `hubapi_list`, whose partial indexes only cover documents with the flag.
+    """
+    result = database[collection].update_many({TOMBSTONE_FIELD: {'$exists': False}},
+                                              {'$set': {TOMBSTONE_FIELD: False}})
+    logger.info(f'Marked {result.modified_count} documents in `{collection}` as live')
+
+
+def count_without_tombstone(database, collection) -> int:
+    """ Documents `hubapi_list` & the catalogue refresh can't see, they only match `_deleted: False` """
+    return database[collection].count_documents({TOMBSTONE_FIELD: {'$exists': False}})
+
+
+def backfill_latest(database, hubpod_collection, logger):
+    """ Rebuilds the materialized latest collection (read by `hubapi_list`) from the full hubpod collection """
+    latest_collection = latest_collection_name(hubpod_collection)
+    cursor = database[hubpod_collection].aggregate(latest_images_pipeline({}), allowDiskUse=True)
+    requests = (pymongo.ReplaceOne({'_id': document['_id']}, build_latest_document(document['latest']), upsert=True)
+                for document in cursor)
+    _write_in_batches(database[latest_collection], requests, logger)
+
+
+def bump_catalogue_generation(database, hubpod_collection, logger):
+    """ Makes `hubapi_list` drop the responses it cached before the backfill, like `hubdb.bump_generation` """
+    database[generation_collection_name(hubpod_collection)].update_one({'_id': CATALOGUE_GENERATION_ID},
+                                                                       {'$inc': {'generation': 1}}, upsert=True)
+    logger.info(f'Bumped the catalogue generation of `{hubpod_collection}`')
+
+
+def _archive_backfill_requests(document):
+    """ Archive buckets holding the inline `build_history` of a metadata document & the update marking it done """
+    build_history = document.get('build_history') or []
+    build_key = {key: document.get(key) for key in ['name', 'version', 'jina_version']}
+    archive_requests = []
+    for position, start in enumerate(range(0, len(build_history), BUILD_HISTORY_BUCKET_SIZE)):
+        entries = build_history[start:start + BUILD_HISTORY_BUCKET_SIZE]
+        # Fixed buckets sort before the ones created by pushes & make re-running an interrupted backfill safe
+        bucket = dict(build_key, bucket=ObjectId.from_datetime(datetime(1970, 1, 1) + timedelta(seconds=position)))
+        archive_requests.append(pymongo.ReplaceOne(bucket, dict(bucket, entries=entries, count=len(entries)),
+                                                   upsert=True))
+    metadata_request = pymongo.UpdateOne({'_id': document['_id']},
+                                         {'$set': {'build_count': len(build_history),
+                                                   'build_history': build_history[-BUILD_HISTORY_INLINE:]}})
+    return archive_requests, metadata_request
+
+
+def backfill_build_history(database, metadata_collection, logger):
+    """
+    Archives the inline `build_history` of metadata documents pushed before the archive collection existed
+    & trims it to the latest `BUILD_HISTORY_INLINE` builds, like `hubapi_push` does.
+    Run this before deploying `hubapi_push`, which only keeps the latest builds inline.
+    """
+    archive_collection = archive_collection_name(metadata_collection)
+    cursor = database[metadata_collection].find({'build_count': {'$exists': False}},
+                                                projection={'name': 1, 'version': 1, 'jina_version': 1,
+                                                            'build_history': 1},
+                                                batch_size=BATCH_SIZE)
+
+    def _write(archive_requests, metadata_requests):
+        # Archive before marking the metadata documents as backfilled
+        _write_in_batches(database[archive_collection], archive_requests, logger)
+        _write_in_batches(database[metadata_collection], metadata_requests, logger)
+
+    archive_requests, metadata_requests = [], []
+    for document in cursor:
+        document_archive_requests, metadata_request = _archive_backfill_requests(document)
+        archive_requests.extend(document_archive_requests)
+        metadata_requests.append(metadata_request)
+        if len(metadata_requests) == BATCH_SIZE:
+            _write(archive_requests, metadata_requests)
+            archive_requests, metadata_requests = [], []
+    _write(archive_requests, metadata_requests)
+
+
+def backfill_catalogue(database, hubpod_collection, metadata_collection, logger):
+    """
+    Runs every backfill, each one only writes the documents it hasn't backfilled yet, so this is safe to re-run.
+    Bumps the catalogue generation last, so that `hubapi_list` serves the backfilled latest collection
+    """
+    backfill_search(database, hubpod_collection, logger)
+    backfill_sort_key(database, hubpod_collection, logger)
+    backfill_tombstone(database, hubpod_collection, logger)
+    backfill_latest(database, hubpod_collection, logger)
+    if metadata_collection:
+        backfill_build_history(database, metadata_collection, logger)
+        backfill_tombstone(database, metadata_collection, logger)
+    bump_catalogue_generation(database, hubpod_collection, logger)
+
+
+@click.command()
+@click.option('--hubpod-collection',
+              default=lambda: os.environ.get('JINA_HUBPOD_COLLECTION'),
+              help='Hubpod collection to backfill (Defaults to env JINA_HUBPOD_COLLECTION)')
+@click.option('--metadata-collection',
+              default=lambda: os.environ.get('JINA_METADATA_COLLECTION'),
+              help='Metadata collection to backfill (Defaults to env JINA_METADATA_COLLECTION)')
+@click.option('--dedupe-builds', 'dedupe_builds_first',
+              is_flag=True,
+              help='Delete the duplicate documents of a build first (see `dedupe_builds`)')
+def backfill(hubpod_collection, metadata_collection, dedupe_builds_first):
+    """Backfills the fields & collections derived by `hubapi_push` for documents pushed before they existed"""
+    logger = get_logger(__name__)
+
+    if not is_db_envs_set():
+        logger.error('MongoDB environment vars are not set! Exiting!')
+        sys.exit(1)
+
+    client = pymongo.MongoClient(db_connection_string())
+    try:
+        database = client[os.environ['JINA_DB_NAME']]
+        if dedupe_builds_first:
+            for collection in filter(None, [hubpod_collection, metadata_collection]):
+                dedupe_builds(database, collection, logger)
+        backfill_catalogue(database, hubpod_collection, metadata_collection, logger)
+    except pymongo.errors.PyMongoError as exp:
+        logger.exception(f'Backfill failed with the following exception. Exiting! \n{exp}')
+        sys.exit(1)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    backfill()
@@ -0,0 +1,60 @@
+import json
+import sys
+
+import click
+
+sys.path.append('..')
+
+from aws.logger import get_logger
+from lambda_handlers.hubapi_authorizer import AuthPolicy, HttpVerb, PolicyShape, policy_document
+from timing import Table, best_us
+
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:123456789012:abcdef1234/dev/POST/push'
+
+
+def _arn_parts():
+    tmp = METHOD_ARN.split(':')
+    api_gateway_arn = tmp[5].split('/')
+    return tmp[4], api_gateway_arn[0], tmp[3], api_gateway_arn[1]
+
+
+def build_per_invocation(shape):
+    """ Policy built from scratch on every invocation, like the authorizer did before """
+    aws_account_id, rest_api_id, region, stage = _arn_parts()
+    policy = AuthPolicy('user|a1b2c3d4', aws_account_id)
+    policy.rest_api_id = rest_api_id
+    policy.region = region
+    policy.stage = stage
+    if shape == PolicyShape.ALLOW_ALL:
+        policy.allow_all_methods()
+    else:
+        policy.allow_method(HttpVerb.GET, '/list/')
+        policy.deny_method(HttpVerb.POST, '/push/')
+    return policy.build()
+
+
+def build_memoized(shape):
+    aws_account_id, rest_api_id, region, stage = _arn_parts()
+    return {'principalId': 'user|a1b2c3d4',
+            'policyDocument': policy_document(shape=shape, aws_account_id=aws_account_id,
+                                              rest_api_id=rest_api_id, region=region, stage=stage)}
+
+
+@click.command()
+@click.option('--number', default=100000, help='Policies built per measurement (Default - 100000)')
+@click.option('--repeat', default=5, help='Measurements, the best one is reported (Default - 5)')
+def benchmark(number, repeat):
+    """Per-invocation cost of building the authorizer policy, from scratch vs memoized"""
+    logger = get_logger(__name__, file=False)
+
+    table = Table(logger, [('shape', 10, ''), ('per invocation us', 17, '.2f'), ('memoized us', 11, '.2f'),
+                           ('speedup', 7, '')])
+    for shape in [PolicyShape.ALLOW_ALL, PolicyShape.READ_ONLY]:
+        assert json.dumps(build_per_invocation(shape)) == json.dumps(build_memoized(shape))
+        per_invocation = best_us(lambda: build_per_invocation(shape), number=number, repeat=repeat)
+        memoized = best_us(lambda: build_memoized(shape), number=number, repeat=repeat)
+        table.row(shape, per_invocation, memoized, f'{per_invocation / memoized:.1f}x')
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import click
+
+sys.path.append('..')
+
+from aws.logger import get_logger
+from timing import Table, median_of, run_fresh
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Runs in a fresh interpreter, like a deploy script. Creates the wrappers `deployment.py` creates, plus the
+# other services, without calling AWS. `uncached` swaps the cache for the previous `boto3.client` call, which
+# creates a client per wrapper
+DEPLOY_STARTUP = '''
+import json, time
+start = time.perf_counter()
+import boto3
+from aws.client import ClientCache
+from aws.services.cloudformation import CFNStack
+from aws.services.cloudwatch import CloudWatch
+from aws.services.lambda_ import Lambda
+from aws.services.s3 import S3
+from aws.services.ssm import SSMDocument, SSMParameter
+imported = time.perf_counter()
+wrappers = [lambda: S3(bucket='bucket'),
+            lambda: SSMParameter(name='/path/username'),
+            lambda: SSMParameter(name='/path/password'),
+            lambda: CFNStack(name='stack', template='template.yml'),
+            lambda: Lambda(name='function', zip_location='function.zip'),
+            lambda: CloudWatch(),
+            lambda: SSMDocument(name='document', template='{{}}')] * {rounds}
+if {uncached}:
+    ClientCache.get = classmethod(lambda cls, service, region, access_key_id=None, secret_access_key=None,
+                                  config=None: boto3.client(service_name=service, aws_access_key_id=access_key_id,
+                                                            aws_secret_access_key=secret_access_key,
+                                                            region_name=region))
+clients = set()
+for wrapper in wrappers:
+    clients.add(id(wrapper()._client))
+print(json.dumps({{'import_ms': (imported - start) * 1000,
+                   'clients_ms': (time.perf_counter() - imported) * 1000,
+                   'wrappers': len(wrappers), 'clients': len(clients)}}))
+'''
+
+
+def _startup(uncached, rounds):
+    # the wrappers don't call AWS, any credentials & region do
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR, AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', 'benchmark'),
+               AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', 'benchmark'))
+    return run_fresh(DEPLOY_STARTUP.format(uncached=uncached, rounds=rounds), env=env)
+
+
+@click.command()
+@click.option('--rounds', default=1, help='Times every wrapper gets created per startup (Default - 1)')
+@click.option('--repeat', default=5, help='Startups per mode, the median is reported (Default - 5)')
+def benchmark(rounds, repeat):
+    """Measures the startup of a deploy script: importing `aws` & creating the service wrappers, with a client
+    per wrapper (as before) & with the clients shared by `ClientCache`
+    """
+    logger = get_logger(__name__, file=False)
+
+    table = Table(logger, [('clients', 18, ''), ('import ms', 9, '.1f'), ('wrappers ms', 11, '.1f'),
+                           ('wrappers', 8, 'd'), ('clients', 7, 'd')])
+    for name, uncached in [('one per wrapper', True), ('ClientCache', False)]:
+        runs = [_startup(uncached, rounds) for _ in range(repeat)]
+        table.row(name, median_of(runs, 'import_ms'), median_of(runs, 'clients_ms'), runs[-1]['wrappers'],
+                  runs[-1]['clients'])
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import click
+
+sys.path.append('..')
+
+from aws.logger import get_logger
+from timing import Table, median_of, run_fresh
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+LAMBDA_HANDLERS_DIR = os.path.join(ROOT_DIR, 'lambda_handlers')
+EVENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events')
+FUNCTIONS = ['hubapi_list', 'hubapi_push', 'hubapi_authorizer', 'docker_auth']
+
+# Runs in a fresh interpreter, like the first invocation of a new Lambda container
+FIRST_INVOCATION = '''
+import json, sys, time
+start = time.perf_counter()
+import {function} as handler
+imported = time.perf_counter()
+with open(sys.argv[1]) as fp:
+    event = json.load(fp)
+try:
+    response = handler.lambda_handler(event, None)
+    status = response.get('statusCode', 'policy') if isinstance(response, dict) else None
+except Exception as exp:
+    status = type(exp).__name__
+print(json.dumps({{'import_ms': (imported - start) * 1000,
+                   'invoke_ms': (time.perf_counter() - imported) * 1000,
+                   'status': status}}))
+'''
+
+
+def _lambda_env():
+    """ The handler & the `hubdb` layer are both importable in the Lambda runtime """
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([LAMBDA_HANDLERS_DIR, ROOT_DIR]))
+
+
+def _import_times(function):
+    """ Cumulative import time (`python -X importtime`) of the handler & its heaviest direct imports, in ms """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {function}'],
+                            env=_lambda_env(), capture_output=True, text=True, check=True)
+    total, direct = 0.0, []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == function:
+            total = int(cumulative) / 1000
+        elif depth == 1:
+            direct.append((int(cumulative) / 1000, name.strip()))
+    return total, sorted(direct, reverse=True)
+
+
+def _first_invocation(function):
+    return run_fresh(FIRST_INVOCATION.format(function=function), args=[os.path.join(EVENTS_DIR, f'{function}.json')],
+                     env=_lambda_env())
+
+
+@click.command()
+@click.option('--function', 'functions', multiple=True, type=click.Choice(FUNCTIONS),
+              help='Lambda function(s) to benchmark (Defaults to all)')
+@click.option('--repeat', default=5, help='Cold starts per function, the median is reported (Default - 5)')
+@click.option('--top', default=3, help='Heaviest direct imports to report per function (Default - 3)')
+def benchmark(functions, repeat, top):
+    """Measures the cold start of the Lambda handlers: import time & first invocation with `events/<function>.json`
+
+    The list & push handlers talk to the db set in the `JINA_DB_*` environment (base64 encoded, like in Lambda),
+    without it they stop early & only the import is representative.
+    """
+    logger = get_logger(__name__, file=False)
+
+    table = Table(logger, [('function', 18, ''), ('import ms', 9, '.1f'), ('1st call ms', 11, '.1f'),
+                           ('status', 6, ''), ('heaviest imports', 0, '')])
+    for function in functions or FUNCTIONS:
+        total, direct = _import_times(function)
+        runs = [_first_invocation(function) for _ in range(repeat)]
+        heaviest = ', '.join(f'{name} {cumulative:.1f}' for cumulative, name in direct[:top])
+        table.row(function, median_of(runs, 'import_ms'), median_of(runs, 'invoke_ms'), runs[-1]['status'],
+                  f'{heaviest} (importtime total {total:.1f})')
+
+
+if __name__ == "__main__":
+    benchmark()
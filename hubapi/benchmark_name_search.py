@@ -0,0 +1,108 @@
+import random
+import sys
+from collections import Counter
+
+import click
+import pymongo
+
+sys.path.append('..')
+
+from aws.logger import get_logger
+from hubdb import build_latest_document
+from indexes import LATEST_INDEXES, _index_models
+from lambda_handlers.hubapi_list import configure_latest_query, latest_query_hint, NameSearchMode
+from lambda_handlers.hubapi_push import parse_summary
+from timing import Table, median_ms
+
+KINDS = ['encoder', 'indexer', 'crafter', 'segmenter', 'ranker', 'evaluator']
+WORDS = ['torch', 'tf', 'transformer', 'image', 'text', 'audio', 'video', 'sparse', 'dense', 'faiss',
+         'annoy', 'clip', 'bert', 'resnet', 'mobilenet', 'zarr', 'redis', 'numeric', 'random', 'dummy']
+QUERIES = ['torch', 'transformer', 'encoder', 'clipimage', 'zz', 'mobilenetvideo', 'nomatchatall']
+
+
+def _synthetic_summary(i):
+    kind = random.choice(KINDS)
+    words = random.sample(WORDS, 2)
+    class_name = ''.join(word.capitalize() for word in words) + kind.capitalize() + str(i)
+    return {
+        'name': f'jinahub/pod.{kind}.{class_name.lower()}',
+        'version': f'0.0.{random.randint(0, 20)}',
+        'jina_version': f'1.{random.randint(0, 3)}.{random.randint(0, 9)}',
+        'manifest_info': {'name': class_name, 'kind': kind, 'type': 'pod', 'keywords': words},
+        'details': {},
+        'is_build_success': True,
+        'build_history': []
+    }
+
+
+def _fetch(collection, query, hint):
+    return list(collection.find(query, sort=[('_id', 1)]).hint(hint))
+
+
+def _docs_examined(collection, query, hint):
+    explain_output = collection.database.command('explain', {'find': collection.name, 'filter': query,
+                                                             'sort': {'_id': 1}, 'hint': hint},
+                                                 verbosity='executionStats')
+    return explain_output['executionStats']['totalDocsExamined']
+
+
+def _selectivity(documents, logger):
+    """
+    Documents each mode has to fetch & filter, without a server. `regex` scans every document,
+    `ngram` fetches the ones holding the first n-gram of the `$all` (the one the index bounds are built on)
+    """
+    postings = Counter(ngram for document in documents for ngram in document['_search']['ngrams'])
+    table = Table(logger, [('query', 16, ''), ('results', 7, 'd'), ('regex docs', 10, 'd'), ('ngram docs', 10, 'd')])
+    for query in QUERIES:
+        filter_, _ = configure_latest_query(name=query)
+        results = sum(1 for document in documents if any(query in name for name in document['_search']['names']))
+        candidates = postings[filter_['_search.ngrams']['$all'][0]]
+        table.row(query, results, len(documents), candidates)
+
+
+@click.command()
+@click.option('--uri', default='mongodb://localhost:27017', help='MongoDB to run the benchmark against')
+@click.option('--executors', default=50000, help='Number of synthetic executors (Default - 50000)')
+@click.option('--repeat', default=5, help='Runs per query, the median is reported (Default - 5)')
+@click.option('--keep', is_flag=True, help='Keep the synthetic database after the benchmark')
+@click.option('--selectivity', is_flag=True, help='Only count the documents each mode examines, without MongoDB')
+def benchmark(uri, executors, repeat, keep, selectivity):
+    """Compares `ngram` & `regex` name search of `hubapi_list` on a synthetic latest collection, with the index
+    `hubapi_list` hints
+    """
+    logger = get_logger(__name__, file=False)
+    random.seed(0)
+
+    logger.info(f'Generating {executors} synthetic executors')
+    documents = [build_latest_document(parse_summary(summary=_synthetic_summary(i), logger=logger)[1])
+                 for i in range(executors)]
+    if selectivity:
+        _selectivity(documents, logger)
+        return
+
+    client = pymongo.MongoClient(uri)
+    database = client['hubapi_benchmark']
+    collection = database['hubpod_latest']
+    try:
+        collection.drop()
+        collection.insert_many(documents, ordered=False)
+        collection.create_indexes(_index_models(LATEST_INDEXES))
+
+        table = Table(logger, [('query', 16, ''), ('mode', 6, ''), ('results', 7, 'd'), ('docs examined', 13, 'd'),
+                               ('median ms', 9, '.2f')])
+        for query in QUERIES:
+            for search_mode in [NameSearchMode.REGEX, NameSearchMode.NGRAM]:
+                filter_, _ = configure_latest_query(name=query, search_mode=search_mode)
+                hint = latest_query_hint(name=query, search_mode=search_mode)
+                duration = median_ms(lambda: _fetch(collection, filter_, hint), repeat)
+                count = len(_fetch(collection, filter_, hint))
+                examined = _docs_examined(collection, filter_, hint)
+                table.row(query, search_mode, count, examined, duration)
+    finally:
+        if not keep:
+            client.drop_database('hubapi_benchmark')
+        client.close()
+
+
+if __name__ == "__main__":
+    benchmark()
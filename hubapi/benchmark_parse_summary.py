@@ -0,0 +1,82 @@
+import random
+import sys
+from typing import Dict, List, Union
+
+import click
+
+sys.path.append('..')
+
+from aws.logger import get_logger
+from lambda_handlers.hubapi_push import parse_summary, _handle_dot_in_keys
+from timing import Table, median_ms
+
+WORDS = ['torch', 'tf', 'transformer', 'image', 'text', 'audio', 'video', 'sparse', 'dense', 'faiss']
+
+
+def _recursive_handle_dot_in_keys(document: Dict[str, Union[Dict, List]]) -> Union[Dict, List]:
+    """ Previous sanitizer, recursive & only looking into the first item of lists, kept as the baseline """
+    updated_document = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            value = _recursive_handle_dot_in_keys(value)
+        if isinstance(value, list) and len(value) > 0 and isinstance(value[0], dict):
+            value[0] = _recursive_handle_dot_in_keys(value[0])
+        updated_document[key.replace('.', '_')] = value
+    return updated_document
+
+
+def _recursive_every_item(document):
+    """ Recursive sanitizer with the fix, to compare the iterative walk against on the same amount of work """
+    if isinstance(document, dict):
+        return {key.replace('.', '_'): _recursive_every_item(value) for key, value in document.items()}
+    if isinstance(document, list):
+        return [_recursive_every_item(value) for value in document]
+    return document
+
+
+def _nested(depth, width):
+    """ Manifest-like dict with dotted keys, lists of dicts & `width` keys per level """
+    if depth == 0:
+        return random.choice(WORDS)
+    return {f'{random.choice(WORDS)}.{i}': [_nested(depth - 1, width) for _ in range(2)] if i % 3 == 0
+            else _nested(depth - 1, width)
+            for i in range(width)}
+
+
+def _synthetic_summary(depth, width):
+    return {
+        'name': 'jinahub/pod.encoder.benchmark',
+        'version': f'0.{random.randint(0, 20)}.{random.randint(0, 20)}-rc.{random.randint(0, 9)}',
+        'jina_version': f'1.{random.randint(0, 3)}.{random.randint(0, 9)}',
+        'manifest_info': {'name': 'BenchmarkEncoder', 'kind': 'encoder', 'type': 'pod', 'keywords': WORDS,
+                          'parameters': _nested(depth, width)},
+        'details': _nested(depth, width),
+        'is_build_success': True,
+        'build_history': [{'time': '2020-10-22', 'docker.tag': 'latest', 'steps': _nested(2, width)}
+                          for _ in range(10)]
+    }
+
+
+@click.command()
+@click.option('--summaries', default=200, help='Number of synthetic summaries (Default - 200)')
+@click.option('--depth', default=4, help='Nesting depth of the synthetic manifests (Default - 4)')
+@click.option('--width', default=6, help='Keys per level of the synthetic manifests (Default - 6)')
+@click.option('--repeat', default=5, help='Runs per function, the median is reported (Default - 5)')
+def benchmark(summaries, depth, width, repeat):
+    """Times the summary sanitizer & `parse_summary` of `hubapi_push` on large synthetic manifests"""
+    logger = get_logger(__name__, file=False)
+    random.seed(0)
+    documents = [_synthetic_summary(depth, width) for _ in range(summaries)]
+
+    table = Table(logger, [('function', 28, ''), ('median ms', 9, '.2f'), ('per summary us', 14, '.1f')])
+    # the baseline rewrites the first item of lists in place, so it goes last
+    for name, function in [('recursive (every item)', _recursive_every_item),
+                           ('iterative (every item)', _handle_dot_in_keys),
+                           ('parse_summary', lambda summary: parse_summary(summary=summary, logger=logger)),
+                           ('recursive (first item only)', _recursive_handle_dot_in_keys)]:
+        duration = median_ms(lambda: [function(summary) for summary in documents], repeat)
+        table.row(name, duration, duration * 1000 / summaries)
+
+
+if __name__ == "__main__":
+    benchmark()
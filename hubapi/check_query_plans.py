@@ -0,0 +1,164 @@
+import itertools
+import os
+import sys
+from typing import Dict, List, Optional, Set
+
+import click
+import pymongo
+
+sys.path.append('..')
+
+from aws.helper import db_connection_string
+from aws.logger import get_logger
+from hubdb import latest_collection_name
+from lambda_handlers.hubapi_list import (configure_aggregation, configure_latest_query, use_latest_collection,
+                                         latest_query_hint, aggregation_hint)
+
+# Plan stages that mean the query isn't served by an index
+BAD_STAGES = {'COLLSCAN', 'SORT'}
+
+# Bounds of an index field the query doesn't restrict
+UNBOUNDED = ['[MinKey, MaxKey]']
+
+# Query strings accepted by `hubapi_list` that change the shape of the pipeline
+SAMPLE_PARAMS = {
+    'jina_version': '0.9.13',
+    'version': '0.0.1',
+    'kind': 'encoder',
+    'type': 'pod',
+    'keywords': ['nlp'],
+    'name': 'encoder',
+    'after': 'jinahub/pod.encoder'
+}
+
+
+def all_query_params() -> List[Dict]:
+    """ Every combination of (up to two) query strings, each with & without a page size """
+    combinations = [{}]
+    for size in [1, 2]:
+        for fields in itertools.combinations(SAMPLE_PARAMS, size):
+            combinations.append({field: SAMPLE_PARAMS[field] for field in fields})
+    return combinations + [dict(params, n_per_page='10') for params in combinations]
+
+
+def index_eligible_stages(pipeline: List[Dict]) -> List[Dict]:
+    """
+    Stages before `$group` are pushed down to the query layer & can be served by an index.
+    Everything after works on the grouped documents, which no index can help with.
+    """
+    stages = []
+    for stage in pipeline:
+        if '$group' in stage:
+            break
+        stages.append(stage)
+    return stages
+
+
+def plan_nodes(explain_output) -> List[Dict]:
+    """ Collects every stage below any `winningPlan` in an explain output """
+    nodes = []
+
+    def _walk(node, in_plan):
+        if isinstance(node, dict):
+            if in_plan and 'stage' in node:
+                nodes.append(node)
+            for key, value in node.items():
+                _walk(value, in_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for value in node:
+                _walk(value, in_plan)
+
+    _walk(explain_output, False)
+    return nodes
+
+
+def execution_stats(explain_output) -> Optional[Dict]:
+    """ First `executionStats` of an explain output, top level for `find` & below `$cursor` for aggregations """
+    if isinstance(explain_output, dict):
+        if 'executionStats' in explain_output:
+            return explain_output['executionStats']
+        values = explain_output.values()
+    elif isinstance(explain_output, list):
+        values = explain_output
+    else:
+        return None
+    for value in values:
+        stats = execution_stats(value)
+        if stats is not None:
+            return stats
+    return None
+
+
+def plan_problems(explain_output, hint: str, filtered: bool) -> Set[str]:
+    """
+    What's wrong with a winning plan: in-memory stages, a different index than the hinted one,
+    or (for queries with filters) an index scan with no bounds, i.e. over the whole index
+    """
+    nodes = plan_nodes(explain_output)
+    problems = {node['stage'] for node in nodes} & BAD_STAGES
+    for node in nodes:
+        if node['stage'] != 'IXSCAN':
+            continue
+        if node.get('indexName') != hint:
+            problems.add(f'IXSCAN on {node.get("indexName")} instead of {hint}')
+        bounds = node.get('indexBounds', {})
+        if filtered and bounds and all(bound == UNBOUNDED for bound in bounds.values()):
+            problems.add(f'unbounded IXSCAN on {node.get("indexName")}')
+    return problems
+
+
+def explain(database, command: Dict):
+    return database.command('explain', command, verbosity='executionStats')
+
+
+@click.command()
+@click.option('--hubpod-collection',
+              default=lambda: os.environ.get('JINA_HUBPOD_COLLECTION'),
+              help='Hubpod collection to explain the list queries on (Defaults to env JINA_HUBPOD_COLLECTION)')
+def check(hubpod_collection):
+    """Explains every query `hubapi_list` can send, with the index it hints, & fails if any of them does a COLLSCAN,
+    an in-memory sort, uses another index or scans a whole index despite its filters
+    """
+    logger = get_logger(__name__)
+
+    client = pymongo.MongoClient(db_connection_string())
+    database = client[os.environ.get('JINA_DB_NAME')]
+    latest_collection = latest_collection_name(hubpod_collection)
+    failures = []
+
+    try:
+        for params in all_query_params():
+            # only the collection `hubapi_list` would read for these query strings
+            if use_latest_collection(**params):
+                collection_name, hint = latest_collection, latest_query_hint(**params)
+                query, limit = configure_latest_query(**params)
+                command = {'find': collection_name, 'filter': query, 'sort': {'_id': 1},
+                           'limit': limit, 'hint': hint}
+                filtered = bool({key for key in query if key != '_id'})
+            else:
+                collection_name, hint = hubpod_collection, aggregation_hint(**params)
+                pipeline = index_eligible_stages(configure_aggregation(**params))
+                command = {'aggregate': collection_name, 'pipeline': pipeline, 'cursor': {}, 'hint': hint}
+                filtered = True
+
+            explain_output = explain(database, command)
+            stats = execution_stats(explain_output) or {}
+            logger.info(f'`{collection_name}` with {params}: {stats.get("nReturned")} returned, '
+                        f'{stats.get("totalKeysExamined")} keys & {stats.get("totalDocsExamined")} docs examined')
+            problems = plan_problems(explain_output, hint=hint, filtered=filtered)
+            if problems:
+                failures.append((collection_name, params, problems))
+    finally:
+        client.close()
+
+    for collection_name, params, problems in failures:
+        logger.error(f'`{collection_name}` with {params}: {sorted(problems)}')
+
+    if failures:
+        logger.error(f'{len(failures)} queries are not served by their index. Exiting!')
+        sys.exit(1)
+    logger.info('All list queries are served by their indexes')
+
+
+if __name__ == "__main__":
+    check()
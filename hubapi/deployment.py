@@ -3,14 +3,21 @@ import sys
 import base64
 
 import click
+import pymongo
 
 sys.path.append('..')
 
-from aws.helper import file_exists, read_file_content, is_aws_cred_set, is_db_envs_set
+from aws.helper import file_exists, read_file_content, is_aws_cred_set, is_db_envs_set, db_connection_string
 from aws.logger import get_logger
-from aws.excepts import StackCreationFailed, StackUpdateFailed
+from aws.excepts import StackCreationFailed, StackUpdateFailed, SSMParameterFailed
 from aws.services.s3 import S3
 from aws.services.cloudformation import CFNStack
+from aws.services.ssm import SSMParameter
+from indexes import ensure_indexes, drop_retired_indexes
+from backfill import dedupe_builds, backfill_catalogue, count_without_tombstone
+
+# duplicate key error code of MongoDB, also raised when a unique index can't be built over the existing documents
+DUPLICATE_KEY_ERROR_CODE = 11000
 
 
 def str_to_ascii_to_base64_to_str(text):
@@ -33,6 +40,8 @@ def read_environment():
 @click.command()
 @click.option('--list-deployment-zip',
               help='Deployment package zip to be used with HubList Lambda function')
+@click.option('--hubdb-layer-zip',
+              help='Lambda layer zip with the shared MongoDB package used by HubList & HubPush Lambda functions')
 @click.option('--push-deployment-zip',
               help='Deployment package zip to be used with HubPush Lambda function')
 @click.option('--authorize-deployment-zip',
@@ -50,8 +59,17 @@ def read_environment():
 @click.option('--deployment-stage',
               default='dev',
               help='Deployment stage for API Gateway (Default - dev)')
-def trigger(list_deployment_zip, push_deployment_zip, authorize_deployment_zip, docker_cred_deployment_zip, key_id,
-            stack_name, template, deployment_stage):
+@click.option('--docker-secret-ssm-path',
+              default='',
+              help='Store the docker credentials as SecureString parameters under this SSM path, read by the '
+                   'DockerCredFetcher Lambda instead of its environment (Default - environment)')
+@click.option('--dedupe-builds', 'dedupe_builds_first',
+              is_flag=True,
+              help='Delete the duplicate documents of a build before creating the unique `build_key` index '
+                   '(see `backfill.dedupe_builds`, Default - off)')
+def trigger(list_deployment_zip, hubdb_layer_zip, push_deployment_zip, authorize_deployment_zip,
+            docker_cred_deployment_zip, key_id, stack_name, template, deployment_stage, docker_secret_ssm_path,
+            dedupe_builds_first):
     logger = get_logger(__name__)
 
     if not is_aws_cred_set():
@@ -81,6 +99,12 @@ def trigger(list_deployment_zip, push_deployment_zip, authorize_deployment_zip,
         s3.put(filepath=list_deployment_zip,
                key=s3_list_key)
 
+    if hubdb_layer_zip is not None:
+        zip_filename = os.path.basename(hubdb_layer_zip)
+        s3_hubdb_layer_key = f'hubdb_layer/{key_id}/{zip_filename}'
+        s3.put(filepath=hubdb_layer_zip,
+               key=s3_hubdb_layer_key)
+
     if push_deployment_zip is not None:
         zip_filename = os.path.basename(push_deployment_zip)
         s3_push_key = f'hubapi_push/{key_id}/{zip_filename}'
@@ -104,9 +128,20 @@ def trigger(list_deployment_zip, push_deployment_zip, authorize_deployment_zip,
     hostname, username, password, database_name, hubpod_collection, metadata_collection, \
         docker_username, docker_password = read_environment()
 
+    if docker_secret_ssm_path:
+        # same (encoded) values as in the environment, so that the Lambda response doesn't change
+        try:
+            SSMParameter(name=f'{docker_secret_ssm_path.rstrip("/")}/username').put(value=docker_username)
+            SSMParameter(name=f'{docker_secret_ssm_path.rstrip("/")}/password').put(value=docker_password)
+        except SSMParameterFailed as exp:
+            logger.exception(f'Storing the docker credentials failed. Exiting! \n{exp}')
+            sys.exit(1)
+        docker_username, docker_password = '', ''
+
     parameters = [
         {'ParameterKey': 'DefS3Bucket', 'ParameterValue': S3_DEFAULT_BUCKET},
         {'ParameterKey': 'HubListLambdaFnS3Key', 'ParameterValue': s3_list_key},
+        {'ParameterKey': 'HubDBLayerS3Key', 'ParameterValue': s3_hubdb_layer_key},
         {'ParameterKey': 'HubPushLambdaFnS3Key', 'ParameterValue': s3_push_key},
         {'ParameterKey': 'HubAPIAuthorizeLambdaFnS3Key', 'ParameterValue': s3_authorize_key},
         {'ParameterKey': 'DockerCredFetcherLambdaFnS3Key', 'ParameterValue': s3_docker_cred_key},
@@ -119,9 +154,44 @@ def trigger(list_deployment_zip, push_deployment_zip, authorize_deployment_zip,
         {'ParameterKey': 'JinaMetadataCollection', 'ParameterValue': metadata_collection},
         {'ParameterKey': 'JinaDBName', 'ParameterValue': database_name},
         {'ParameterKey': 'JinaDockerUsername', 'ParameterValue': docker_username},
-        {'ParameterKey': 'JinaDockerPassword', 'ParameterValue': docker_password}
+        {'ParameterKey': 'JinaDockerPassword', 'ParameterValue': docker_password},
+        {'ParameterKey': 'DockerSecretSSMPath', 'ParameterValue': docker_secret_ssm_path}
     ]
 
+    # the new handlers only read the backfilled fields & the latest collection, & hint their indexes, so those have
+    # to exist before the stack update rolls them out. Every backfill is idempotent, deduping deletes builds & only
+    # runs when asked for
+    client = pymongo.MongoClient(db_connection_string())
+    try:
+        database = client[os.environ.get('JINA_DB_NAME')]
+        if dedupe_builds_first:
+            for collection in [os.environ.get('JINA_HUBPOD_COLLECTION'), os.environ.get('JINA_METADATA_COLLECTION')]:
+                logger.warning(f'Deleting the duplicate builds in `{collection}`')
+                dedupe_builds(database=database, collection=collection, logger=logger)
+        backfill_catalogue(database=database,
+                           hubpod_collection=os.environ.get('JINA_HUBPOD_COLLECTION'),
+                           metadata_collection=os.environ.get('JINA_METADATA_COLLECTION'),
+                           logger=logger)
+        ensure_indexes(database=database,
+                       hubpod_collection=os.environ.get('JINA_HUBPOD_COLLECTION'),
+                       metadata_collection=os.environ.get('JINA_METADATA_COLLECTION'),
+                       logger=logger)
+        # the handlers match live builds on `_deleted: False`, builds without the field would vanish from the hub
+        for collection in [os.environ.get('JINA_HUBPOD_COLLECTION'), os.environ.get('JINA_METADATA_COLLECTION')]:
+            missing = count_without_tombstone(database=database, collection=collection)
+            if missing:
+                logger.error(f'{missing} documents in `{collection}` are still without `_deleted` after the '
+                             f'backfill. Exiting!')
+                sys.exit(1)
+    except pymongo.errors.PyMongoError as exp:
+        if getattr(exp, 'code', None) == DUPLICATE_KEY_ERROR_CODE:
+            logger.error('Duplicate builds block the unique `build_key` index, deploy with `--dedupe-builds` '
+                         'to delete them')
+        logger.exception(f'Backfill or index creation failed. Exiting! \n{exp}')
+        sys.exit(1)
+    finally:
+        client.close()
+
     try:
         with CFNStack(name=stack_name, template=cfn_yml,
                       parameters=parameters, delete_at_exit=False) as api_cfn_stack:
@@ -136,6 +206,22 @@ def trigger(list_deployment_zip, push_deployment_zip, authorize_deployment_zip,
         logger.exception(f'Stack creation/update failed. Exiting context \n{cfn_exp}')
         sys.exit(1)
 
+    # the previous handlers kept serving pushes during the stack update, backfill the builds they wrote
+    client = pymongo.MongoClient(db_connection_string())
+    try:
+        backfill_catalogue(database=client[os.environ.get('JINA_DB_NAME')],
+                           hubpod_collection=os.environ.get('JINA_HUBPOD_COLLECTION'),
+                           metadata_collection=os.environ.get('JINA_METADATA_COLLECTION'),
+                           logger=logger)
+        drop_retired_indexes(database=client[os.environ.get('JINA_DB_NAME')],
+                             hubpod_collection=os.environ.get('JINA_HUBPOD_COLLECTION'),
+                             logger=logger)
+    except pymongo.errors.PyMongoError as exp:
+        logger.exception(f'Backfill or dropping the retired indexes failed. Exiting! \n{exp}')
+        sys.exit(1)
+    finally:
+        client.close()
+
 
 if __name__ == "__main__":
     trigger()
@@ -0,0 +1,147 @@
+from typing import Dict, List
+
+import pymongo
+
+from hubdb import (TOMBSTONE_FIELD, DELETED_AT_FIELD, latest_collection_name, archive_collection_name,
+                   idempotency_collection_name)
+from lambda_handlers.hubapi_list import ListIndex
+from lambda_handlers.hubapi_push import quota_collection_name, rate_limit_collection_name
+
+# Sort order of the hubpod documents in `hubapi_list.configure_aggregation`, both versions packed in one field
+SEMVER_SORT = [
+    ('_sort_key', pymongo.DESCENDING)
+]
+
+# Builds that aren't soft deleted, the only ones `hubapi_list` reads
+LIVE = {TOMBSTONE_FIELD: False}
+
+# `hubapi_push` looks documents up (and replaces them) on this key in both collections
+BUILD_KEY = [
+    ('name', pymongo.ASCENDING),
+    ('version', pymongo.ASCENDING),
+    ('jina_version', pymongo.ASCENDING)
+]
+
+# `hubapi_list` pins its aggregations to the first three with `hint`
+HUBPOD_INDEXES = [
+    {
+        'name': ListIndex.LIVE_NAME,
+        'keys': [('name', pymongo.ASCENDING)] + SEMVER_SORT,
+        'partialFilterExpression': LIVE
+    },
+    {
+        # version filters are equalities, so they have to prefix the sort keys to avoid an in-memory sort
+        'name': ListIndex.LIVE_JINA_VERSION_NAME,
+        'keys': [('jina_version', pymongo.ASCENDING), ('name', pymongo.ASCENDING)] + SEMVER_SORT,
+        'partialFilterExpression': LIVE
+    },
+    {
+        'name': ListIndex.LIVE_VERSION_NAME,
+        'keys': [('version', pymongo.ASCENDING), ('name', pymongo.ASCENDING)] + SEMVER_SORT,
+        'partialFilterExpression': LIVE
+    },
+    {
+        'name': 'manifest_keywords',
+        'keys': [('manifest_info.keywords', pymongo.ASCENDING)]
+    },
+    {
+        'name': 'build_key',
+        'keys': BUILD_KEY,
+        'unique': True
+    },
+    {
+        # only the soft deleted builds, for the compaction
+        'name': 'tombstones',
+        'keys': [(DELETED_AT_FIELD, pymongo.ASCENDING)],
+        'partialFilterExpression': {TOMBSTONE_FIELD: True}
+    }
+]
+
+# Documents in the latest collection are keyed (& sorted) on the docker name, which is already `_id`.
+# `hubapi_list` pins its queries to one of these (or `_id_`) with `hint`, each filter being an equality prefix of
+# `_id` so that the index returns the page in order
+LATEST_INDEXES = [
+    {
+        'name': ListIndex.KIND,
+        'keys': [('kind', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    },
+    {
+        'name': ListIndex.TYPE,
+        'keys': [('type', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    },
+    {
+        'name': ListIndex.KEYWORDS,
+        'keys': [('keywords', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    },
+    {
+        'name': ListIndex.SEARCH_NGRAMS,
+        'keys': [('_search.ngrams', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    }
+]
+
+METADATA_INDEXES = [
+    {
+        'name': 'build_key',
+        'keys': BUILD_KEY,
+        'unique': True
+    }
+]
+
+# `hubapi_push` appends to the open bucket of a build key, `hubapi_list` pages through the buckets in order
+ARCHIVE_INDEXES = [
+    {
+        'name': 'build_key_bucket',
+        'keys': BUILD_KEY + [('bucket', pymongo.ASCENDING)]
+    }
+]
+
+# Daily push counters, token buckets & remembered responses of `hubapi_push` are dropped once they've expired
+EXPIRING_INDEXES = [
+    {
+        'name': 'expires_at_ttl',
+        'keys': [('expires_at', pymongo.ASCENDING)],
+        'expireAfterSeconds': 0
+    }
+]
+
+# Indexes replaced by the ones above, dropped once those exist. On the hubpod collection: first the six separate
+# semver fields, then the `_sort_key` ones over every build, soft deleted ones included, & the n-grams, as the
+# hinted aggregations never use them. On the latest collection: the n-grams without `_id`.
+# Run `backfill.py` before deploying, older documents have neither `_sort_key` nor `_deleted`
+RETIRED_HUBPOD_INDEXES = ['name_semver_sort', 'jina_version_name_semver_sort',
+                          'name_sort_key', 'jina_version_name_sort_key', 'search_ngrams']
+RETIRED_LATEST_INDEXES = ['search_ngrams']
+
+
+def _index_models(spec: List[Dict]) -> List[pymongo.IndexModel]:
+    return [pymongo.IndexModel(index['keys'],
+                               **{k: v for k, v in index.items() if k != 'keys'})
+            for index in spec]
+
+
+def ensure_indexes(database, hubpod_collection: str, metadata_collection: str, logger):
+    """
+    Creates the indexes declared above. `createIndexes` is a no-op for indexes that already exist with the same
+    spec, so this can run on every deployment. It has to run before the Lambda functions get updated,
+    as `hubapi_list` hints the indexes by name
+    """
+    for collection_name, spec in [(hubpod_collection, HUBPOD_INDEXES),
+                                  (latest_collection_name(hubpod_collection), LATEST_INDEXES),
+                                  (metadata_collection, METADATA_INDEXES),
+                                  (archive_collection_name(metadata_collection), ARCHIVE_INDEXES),
+                                  (quota_collection_name(metadata_collection), EXPIRING_INDEXES),
+                                  (rate_limit_collection_name(metadata_collection), EXPIRING_INDEXES),
+                                  (idempotency_collection_name(metadata_collection), EXPIRING_INDEXES)]:
+        created = database[collection_name].create_indexes(_index_models(spec))
+        logger.info(f'Indexes on `{collection_name}`: {created}')
+
+
+def drop_retired_indexes(database, hubpod_collection: str, logger):
+    """ Drops the retired indexes, once the Lambda functions that may still use them got updated """
+    for collection_name, retired in [(hubpod_collection, RETIRED_HUBPOD_INDEXES),
+                                     (latest_collection_name(hubpod_collection), RETIRED_LATEST_INDEXES)]:
+        existing = set(database[collection_name].index_information())
+        for name in retired:
+            if name in existing:
+                database[collection_name].drop_index(name)
+                logger.info(f'Dropped the retired index `{name}` on `{collection_name}`')
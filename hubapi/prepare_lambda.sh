@@ -3,6 +3,9 @@
 TMP_DIR="/tmp"
 DEFAULT_FILENAME="lambda_function.py"
 LAMBDA_HANDLERS_DIR="../lambda_handlers"
+HUBDB_DIR="../hubdb"
+LAYER_NAME="hubdb_layer"
+LAMBDA_PYTHON_VERSION="3.8"
 
 function usage() {
     cat <<EOF
@@ -11,6 +14,8 @@ function usage() {
     -f|--function               Name of Lambda Function (to be picked from `lambda_handlers` directory)
     -p|--package-dir            Directory package
                                 Default - _package
+    -l|--layer                  Build the Lambda layer with the shared `hubdb` package & its requirements
+                                (${LAYER_NAME}.zip) instead of a function
     
     This script helps create a deployment package for different Lambda functions!
 EOF
@@ -22,20 +27,57 @@ for arg in "$@"; do
         "--help")               set -- "$@" "-h" ;;
         "--function")           set -- "$@" "-f" ;;
         "--package-dir")        set -- "$@" "-p" ;;
+        "--layer")              set -- "$@" "-l" ;;
         *)                      set -- "$@" "$arg"
   esac
 done
 
-while getopts "hf:p:" opt
+while getopts "hf:p:l" opt
 do
   case "$opt" in
     "h") usage; exit 0 ;;
     "f") FUNCTION_NAME=${OPTARG} ;;
     "p") PACKAGE_DIR=${OPTARG} ;;
+    "l") BUILD_LAYER=true ;;
     "?") usage >&2; exit 1 ;;
   esac
 done
 
+if [[ -n "$PACKAGE_DIR" ]]; then
+    echo "Got package directory: ${PACKAGE_DIR}"
+else
+    echo "No Package directory passed. Using default"
+    PACKAGE_DIR="_package"
+fi
+
+# Drops what the Lambda runtime never loads from the installed requirements: package metadata, tests, type stubs,
+# `gridfs` (installed along with pymongo) & bytecode. As /var/task & /opt are read-only, bytecode is only shipped
+# when this python matches the runtime, otherwise every cold start would have to compile the modules again
+function trim_package() {
+    local dir=$1
+    find ${dir} -name __pycache__ -type d -prune -exec rm -rf {} +
+    find ${dir} \( -name '*.dist-info' -o -name '*.egg-info' -o -name tests \) -type d -prune -exec rm -rf {} +
+    find ${dir} \( -name '*.pyi' -o -name 'py.typed' \) -type f -delete
+    rm -rf ${dir}/gridfs ${dir}/python/gridfs
+    if [[ "$(python -c 'import sys; print("%d.%d" % sys.version_info[:2])')" == "${LAMBDA_PYTHON_VERSION}" ]]; then
+        python -m compileall -q ${dir}
+    fi
+}
+
+# Layers are extracted in /opt & Lambda adds /opt/python to the path of the python runtimes
+if [[ "$BUILD_LAYER" == true ]]; then
+    echo "Building Lambda layer: ${LAYER_NAME}"
+    if [ -d "${PACKAGE_DIR}" ]; then rm -rf ${PACKAGE_DIR}; fi
+    if [ -f ${LAYER_NAME}.zip ]; then rm ${LAYER_NAME}.zip; fi
+    mkdir -p ${PACKAGE_DIR}/python
+    pip install --no-compile --target ./${PACKAGE_DIR}/python -r ${HUBDB_DIR}/requirements.txt
+    cp -r ${HUBDB_DIR} ${PACKAGE_DIR}/python/
+    rm ${PACKAGE_DIR}/python/hubdb/requirements.txt
+    trim_package ${PACKAGE_DIR}
+    cd ${PACKAGE_DIR} && zip -r9 ${OLDPWD}/${LAYER_NAME}.zip python && cd -
+    exit 0
+fi
+
 if [[ -n "$FUNCTION_NAME" ]]; then
     FUNCTION_NAME=${FUNCTION_NAME//.py}
     echo "Got Lambda function name: ${FUNCTION_NAME}"
@@ -49,13 +91,6 @@ else
     exit 1
 fi
 
-if [[ -n "$PACKAGE_DIR" ]]; then
-    echo "Got package directory: ${PACKAGE_DIR}"
-else
-    echo "No Package directory passed. Using default"
-    PACKAGE_DIR="_package"
-fi
-
 function cleanup() {
     if [ -d "${PACKAGE_DIR}" ]; then rm -rf ${PACKAGE_DIR}; fi
     if [ -f ${FUNCTION_NAME}.zip ]; then rm ${FUNCTION_NAME}.zip; fi
@@ -68,7 +103,8 @@ mkdir -p ${PACKAGE_DIR}
 
 # Build package if req_function_name.txt file exists in lambda_handlers directory
 if [[ -f ${LAMBDA_HANDLERS_DIR}/req_${FUNCTION_NAME}.txt ]]; then
-    pip install --target ./${PACKAGE_DIR} -r ${LAMBDA_HANDLERS_DIR}/req_${FUNCTION_NAME}.txt
+    pip install --no-compile --target ./${PACKAGE_DIR} -r ${LAMBDA_HANDLERS_DIR}/req_${FUNCTION_NAME}.txt
+    trim_package ${PACKAGE_DIR}
     cd ${PACKAGE_DIR} && zip -r9 ${OLDPWD}/${FUNCTION_NAME}.zip . && cd -
 fi
 
@@ -0,0 +1,45 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+def median_ms(function: Callable, repeat: int) -> float:
+    """ Median duration of `repeat` calls of `function`, in ms """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def best_us(function: Callable, number: int, repeat: int) -> float:
+    """ Duration of a call of `function` in the fastest of `repeat` runs of `number` calls, in us """
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def run_fresh(code: str, args: Sequence[str] = (), env: Optional[Dict] = None) -> Dict:
+    """ Runs `code` in a fresh interpreter (e.g. a cold start), returns the json it prints last """
+    result = subprocess.run([sys.executable, '-c', code, *args], env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def median_of(runs: List[Dict], key: str) -> float:
+    return statistics.median(run[key] for run in runs)
+
+
+class Table:
+    """ Logs the results as rows of right-aligned columns, each one a `(title, width, format)`, the header first """
+
+    def __init__(self, logger, columns: List[Tuple[str, int, str]]):
+        self.logger = logger
+        self.columns = columns
+        self.logger.info(' | '.join(f'{title:>{width}}' for title, width, _ in columns))
+
+    def row(self, *values):
+        self.logger.info(' | '.join(format(value if spec else str(value), f'>{width}{spec}')
+                                    for value, (_, width, spec) in zip(values, self.columns)))
@@ -0,0 +1,15 @@
+"""
+MongoDB data access shared by the hub Lambda functions, shipped to them as a Lambda layer
+(see `hubapi/prepare_lambda.sh --layer`)
+"""
+from .environment import (DB_ENV_KEYS, HUB_ENV_KEYS, str_to_ascii_to_base64_to_str, is_db_envs_set, read_env,
+                          read_db_params, read_environment, reset_environment)
+from .handler import (MongoDBException, MongoDBTimeout, MongoClientRegistry, LatencyStats, LATENCY_STATS, log_latency,
+                      MongoDBHandler)
+from .catalogue import (LATEST_FIRST, NGRAM_SIZE, ngrams, search_fields, latest_collection_name,
+                        CATALOGUE_GENERATION_ID, generation_collection_name, archive_collection_name,
+                        idempotency_collection_name, forget_pushes,
+                        build_latest_document, latest_update, latest_images_pipeline, TOMBSTONE_FIELD,
+                        DELETED_AT_FIELD, tombstone_update, bump_generation, refresh_catalogue)
+from .logger import get_logger
+from .response import json_response
@@ -0,0 +1,181 @@
+"""
+Collections derived from the hubpod & metadata collections: the materialized latest images read by `hubapi_list`,
+the catalogue generation & the build history archive. Kept up to date by `hubapi_push` & `hubapi_delete`
+"""
+from datetime import datetime
+from typing import Optional, Dict, List
+
+import pymongo
+
+from bson import Binary
+
+from .handler import MongoDBHandler
+
+
+# Materialized collection read by `hubapi_list`, with one already projected doc per executor name
+LATEST_COLLECTION_SUFFIX = '_latest'
+
+# Same order as the sort stage in `hubapi_list.configure_aggregation`, latest image first
+LATEST_FIRST = [('_sort_key', -1)]
+
+
+# `manifest_info` fields exposed by `hubapi_list`
+MANIFEST_FIELDS = ['name', 'description', 'type', 'kind', 'keywords', 'platform',
+                   'license', 'url', 'documentation', 'author', 'avatar']
+
+
+# Collection with a single counter document, `hubapi_list` drops its cached responses whenever it changes
+GENERATION_COLLECTION_SUFFIX = '_generation'
+CATALOGUE_GENERATION_ID = 'catalogue'
+
+
+def generation_collection_name(hubpod_collection: str) -> str:
+    return f'{hubpod_collection}{GENERATION_COLLECTION_SUFFIX}'
+
+
+# `_search.ngrams` holds every n-gram of the lowercased names, for all sizes from 1 up to this
+NGRAM_SIZE = 3
+
+
+def ngrams(text: str, size: int) -> List[str]:
+    return sorted({text[i:i + size] for i in range(len(text) - size + 1)})
+
+
+def search_fields(*names: Optional[str]) -> Dict:
+    """ Normalized names & their n-grams, used by `hubapi_list` for an indexed substring search """
+    normalized_names = sorted({name.lower() for name in names if name})
+    name_ngrams = set()
+    for name in normalized_names:
+        for size in range(1, NGRAM_SIZE + 1):
+            name_ngrams.update(ngrams(name, size))
+    return {'names': normalized_names, 'ngrams': sorted(name_ngrams)}
+
+
+def latest_collection_name(hubpod_collection: str) -> str:
+    return f'{hubpod_collection}{LATEST_COLLECTION_SUFFIX}'
+
+
+def build_latest_document(hubpod_document: Dict) -> Dict:
+    """
+    Projects a hubpod document into the shape returned by `hubapi_list`
+    (see `project_final_args_stage` in `hubapi_list.configure_aggregation`), keyed on the docker name
+    """
+    name = hubpod_document['name']
+    version = hubpod_document['version']
+    jina_version = hubpod_document['jina_version']
+    manifest_info = hubpod_document.get('manifest_info') or {}
+
+    latest_document = {
+        '_id': name,
+        'docker-name': name,
+        'version': version,
+        'jina-version': jina_version,
+        'docker-command': f'docker pull {name}:{version}-{jina_version}'
+    }
+    latest_document.update({field: manifest_info[field] for field in MANIFEST_FIELDS if field in manifest_info})
+    latest_document['_search'] = hubpod_document.get('_search') or search_fields(name, manifest_info.get('name'))
+    # for `latest_update` to tell whether a pushed image is more recent, left out by `hubapi_list`
+    if '_sort_key' in hubpod_document:
+        latest_document['_sort_key'] = hubpod_document['_sort_key']
+    return latest_document
+
+
+# Lower than the (16 bytes) `_sort_key` of any image, for latest documents written before they had one
+_MIN_SORT_KEY = Binary(bytes(16))
+
+
+def latest_update(hubpod_document: Dict) -> pymongo.UpdateOne:
+    """
+    Upsert of the latest collection document of a pushed (live) image, unless the executor's latest document is
+    of a more recent image. One update pipeline, so concurrent pushes of the same executor can't go back in time &
+    it can be part of a bulk write or a transaction
+    """
+    latest_document = build_latest_document(hubpod_document=hubpod_document)
+    more_recent = {'$lte': [{'$ifNull': ['$_sort_key', _MIN_SORT_KEY]}, latest_document['_sort_key']]}
+    return pymongo.UpdateOne({'_id': latest_document['_id']}, [
+        {'$set': {'_pushed': {'$cond': [more_recent, {'$literal': latest_document}, '$$REMOVE']}}},
+        {'$replaceRoot': {'newRoot': {'$ifNull': ['$_pushed', '$$ROOT']}}}
+    ], upsert=True)
+
+
+# Build history beyond the inline `build_history` of metadata documents, in buckets per build key
+ARCHIVE_COLLECTION_SUFFIX = '_archive'
+
+
+def archive_collection_name(metadata_collection: str) -> str:
+    return f'{metadata_collection}{ARCHIVE_COLLECTION_SUFFIX}'
+
+
+# Responses of recent pushes, replayed to identical pushes (see `hubapi_push.reserve_push`)
+IDEMPOTENCY_COLLECTION_SUFFIX = '_idempotency'
+
+
+def idempotency_collection_name(metadata_collection: str) -> str:
+    return f'{metadata_collection}{IDEMPOTENCY_COLLECTION_SUFFIX}'
+
+
+def forget_pushes(names: List[str], db_params: Dict, metadata_collection: str) -> Optional[int]:
+    """
+    Drops the remembered responses of the pushes of executors in `names`, so that pushing a build again after
+    deleting it writes it instead of replaying the response of its previous push
+    """
+    with MongoDBHandler(**db_params, collection_name=idempotency_collection_name(metadata_collection)) as db:
+        return db.delete({'names': {'$in': names}})
+
+
+# Soft deleted builds keep their documents with `_deleted: True` until the compaction removes them.
+# Pushes write `_deleted: False`, which the partial indexes of `hubapi_list` are filtered on
+TOMBSTONE_FIELD = '_deleted'
+DELETED_AT_FIELD = '_deleted_at'
+
+
+def tombstone_update(deleted: bool) -> Dict:
+    """ Update (un)setting the tombstone of hubpod & metadata documents """
+    if deleted:
+        return {'$set': {TOMBSTONE_FIELD: True, DELETED_AT_FIELD: datetime.utcnow()}}
+    return {'$set': {TOMBSTONE_FIELD: False}, '$unset': {DELETED_AT_FIELD: ''}}
+
+
+def latest_images_pipeline(match: Dict) -> List[Dict]:
+    """
+    Latest live hubpod document (as `latest`) of every executor matching `match`. Matching `_deleted: False`
+    (rather than `$ne: True`) lets the partial `live_name_sort_key` index serve both the match & the sort.
+    Documents pushed before the field existed only match once `hubapi/backfill.py` marked them, the deploy runs it
+    """
+    return [
+        {'$match': dict(match, **{TOMBSTONE_FIELD: False})},
+        {'$sort': dict([('name', 1)] + LATEST_FIRST)},
+        {'$group': {'_id': '$name', 'latest': {'$first': '$$ROOT'}}}
+    ]
+
+
+def bump_generation(db_params: Dict, hubpod_collection: str):
+    """ Makes `hubapi_list` drop the responses it cached for the previous catalogue """
+    with MongoDBHandler(**db_params, collection_name=generation_collection_name(hubpod_collection)) as db:
+        db.update(query={'_id': CATALOGUE_GENERATION_ID}, update={'$inc': {'generation': 1}}, upsert=True)
+
+
+def refresh_catalogue(names: List[str], db_params: Dict, hubpod_collection: str, logger):
+    """
+    Rebuilds the latest collection documents for the executors in `names` & bumps the catalogue generation,
+    so that `hubapi_list` serves (& caches) the new images. Executors without any live image left are dropped.
+    Pushes only add images, they write the latest documents with `latest_update` instead
+    """
+    logger.info(f'refreshing latest images!')
+    with MongoDBHandler(**db_params, collection_name=hubpod_collection) as db:
+        latest_hubpod_docs = db.aggregate(pipeline=latest_images_pipeline({'name': {'$in': names}}))
+        if latest_hubpod_docs is None:
+            logger.error('Couldn\'t read the latest images, the catalogue is left as is')
+            return
+        latest_documents = [build_latest_document(hubpod_document=doc['latest']) for doc in latest_hubpod_docs]
+
+    removed_names = set(names) - {document['_id'] for document in latest_documents}
+    if latest_documents or removed_names:
+        with MongoDBHandler(**db_params, collection_name=latest_collection_name(hubpod_collection)) as db:
+            db.bulk_write([pymongo.ReplaceOne({'_id': document['_id']}, document, upsert=True)
+                           for document in latest_documents] +
+                          [pymongo.DeleteOne({'_id': name}) for name in sorted(removed_names)])
+        for document in latest_documents:
+            logger.info(f'Latest image for `{document["_id"]}` is {document["version"]}-{document["jina-version"]}')
+
+    bump_generation(db_params=db_params, hubpod_collection=hubpod_collection)
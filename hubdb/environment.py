@@ -0,0 +1,52 @@
+import os
+import base64
+import functools
+from typing import Dict, Tuple
+
+# Lambda environment variables are base64 encoded by `hubapi/deployment.py`
+DB_ENV_KEYS = ('JINA_DB_HOSTNAME', 'JINA_DB_USERNAME', 'JINA_DB_PASSWORD', 'JINA_DB_NAME')
+HUB_ENV_KEYS = DB_ENV_KEYS + ('JINA_HUBPOD_COLLECTION', 'JINA_METADATA_COLLECTION')
+
+
+def str_to_ascii_to_base64_to_str(text):
+    return base64.b64decode(text.encode('ascii')).decode('ascii')
+
+
+# The environment of a Lambda container never changes, so it only gets checked & decoded by its first invocation
+
+
+@functools.lru_cache(maxsize=None)
+def is_db_envs_set(keys: Tuple[str, ...] = HUB_ENV_KEYS):
+    """ Checks if any of the db env variables are not set """
+    return all(len(os.environ.get(k, '')) > 0 for k in keys)
+
+
+@functools.lru_cache(maxsize=None)
+def read_env(key: str) -> str:
+    return str_to_ascii_to_base64_to_str(os.environ.get(key))
+
+
+def read_db_params() -> Dict:
+    """ Keyword arguments of `MongoDBHandler` other than the collection """
+    return {
+        'hostname': read_env('JINA_DB_HOSTNAME'),
+        'username': read_env('JINA_DB_USERNAME'),
+        'password': read_env('JINA_DB_PASSWORD'),
+        'database_name': read_env('JINA_DB_NAME')
+    }
+
+
+def read_environment():
+    hostname = read_env('JINA_DB_HOSTNAME')
+    username = read_env('JINA_DB_USERNAME')
+    password = read_env('JINA_DB_PASSWORD')
+    database_name = read_env('JINA_DB_NAME')
+    hubpod_collection = read_env('JINA_HUBPOD_COLLECTION')
+    metadata_collection = read_env('JINA_METADATA_COLLECTION')
+    return hostname, username, password, database_name, hubpod_collection, metadata_collection
+
+
+def reset_environment():
+    """ Forgets the checked & decoded environment, for it to be read again (e.g. after it got patched in tests) """
+    is_db_envs_set.cache_clear()
+    read_env.cache_clear()
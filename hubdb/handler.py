@@ -0,0 +1,311 @@
+import json
+import time
+import functools
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Union
+
+import pymongo
+from pymongo.client_session import ClientSession
+from pymongo.write_concern import WriteConcern
+
+from .logger import get_logger
+
+
+class MongoDBException(Exception):
+    """ Any errors raised by MongoDb """
+
+
+class MongoDBTimeout(MongoDBException):
+    """ A read took longer than the `max_time_ms` of its handler """
+
+
+class MongoClientRegistry:
+    """
+    Process-wide registry of `pymongo.MongoClient` objects, keyed on the connection string.
+
+    It lives at module level so that warm Lambda invocations re-use an already resolved,
+    authenticated connection pool. Liveness is tracked by the client's own background
+    monitor (`heartbeatFrequencyMS`), so there is no per-request `ismaster` round trip.
+    """
+    HEARTBEAT_FREQUENCY_MS = 10000
+    SERVER_SELECTION_TIMEOUT_MS = 5000
+
+    _clients: Dict[str, pymongo.MongoClient] = {}
+
+    @classmethod
+    def get(cls, connection_string: str) -> pymongo.MongoClient:
+        client = cls._clients.get(connection_string)
+        if client is None:
+            client = pymongo.MongoClient(connection_string,
+                                         heartbeatFrequencyMS=cls.HEARTBEAT_FREQUENCY_MS,
+                                         serverSelectionTimeoutMS=cls.SERVER_SELECTION_TIMEOUT_MS,
+                                         retryReads=True,
+                                         retryWrites=True)
+            # Only validated once per container, when the client gets created
+            client.admin.command('ismaster')
+            cls._clients[connection_string] = client
+        return client
+
+    @classmethod
+    def discard(cls, connection_string: str):
+        client = cls._clients.pop(connection_string, None)
+        if client is not None:
+            try:
+                client.close()
+            except pymongo.errors.PyMongoError:
+                pass
+
+
+class LatencyStats:
+    """ Number of calls, total & max latency (in ms) per `<collection>.<operation>`, for the current invocation """
+
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, key: str, elapsed_ms: float):
+        stat = self.stats.setdefault(key, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stat['count'] += 1
+        stat['total_ms'] += elapsed_ms
+        stat['max_ms'] = max(stat['max_ms'], elapsed_ms)
+
+    def reset(self):
+        self.stats = {}
+
+    def log(self, logger):
+        """ One JSON log line with the stats, for CloudWatch Logs Insights to aggregate across invocations """
+        if self.stats:
+            logger.info(json.dumps({'db_latency': {key: dict(stat, total_ms=round(stat['total_ms'], 1),
+                                                             max_ms=round(stat['max_ms'], 1))
+                                                   for key, stat in self.stats.items()}}))
+
+
+LATENCY_STATS = LatencyStats()
+
+
+def log_latency(handler):
+    """ Decorates a Lambda handler to log the latency of the db operations of every invocation """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        LATENCY_STATS.reset()
+        try:
+            return handler(event, context)
+        finally:
+            LATENCY_STATS.log(get_logger(context='db_latency'))
+            LATENCY_STATS.reset()
+
+    return wrapper
+
+
+class MongoDBHandler:
+    """
+    Mongodb Handler to connect to the database & read/write documents in the collection
+
+    :param read_preference: e.g. `pymongo.ReadPreference.SECONDARY_PREFERRED` for read-only handlers,
+        defaults to the primary
+    :param write_concern: e.g. `WriteConcern(w='majority')`, defaults to the client's
+    :param max_time_ms: server side time limit of every read (`maxTimeMS`), no limit by default.
+        Reads going over it raise `MongoDBTimeout`, as do the cursors returned by `find` & `aggregate`
+        (with `pymongo.errors.ExecutionTimeout`) when they get iterated
+    """
+
+    def __init__(self, hostname: str, username: str, password: str,
+                 database_name: str, collection_name: str,
+                 read_preference=None,
+                 write_concern: Optional[WriteConcern] = None,
+                 max_time_ms: Optional[int] = None):
+        self.logger = get_logger(self.__class__.__name__)
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.read_preference = read_preference
+        self.write_concern = write_concern
+        self.max_time_ms = max_time_ms
+        self.connection_string = \
+            f'mongodb+srv://{self.username}:{self.password}@{self.hostname}'
+
+    def __enter__(self):
+        return self.connect()
+
+    def connect(self) -> 'MongoDBHandler':
+        try:
+            self.client = MongoClientRegistry.get(self.connection_string)
+            self.logger.info('Successfully connected to the database')
+        except pymongo.errors.ConnectionFailure:
+            MongoClientRegistry.discard(self.connection_string)
+            raise MongoDBException('Database server is not available')
+        except pymongo.errors.ConfigurationError:
+            raise MongoDBException('Credentials passed are not correct!')
+        except pymongo.errors.PyMongoError as exp:
+            raise MongoDBException(exp)
+        except Exception as exp:
+            raise MongoDBException(exp)
+        return self
+
+    def reconnect(self) -> 'MongoDBHandler':
+        """ Drops the cached client (e.g. after a failover) & connects with a fresh one """
+        self.logger.warning('Lost connection to the database, reconnecting')
+        MongoClientRegistry.discard(self.connection_string)
+        return self.connect()
+
+    @property
+    def database(self):
+        return self.client.get_database(self.database_name, read_preference=self.read_preference,
+                                        write_concern=self.write_concern)
+
+    @property
+    def collection(self):
+        return self.database[self.collection_name]
+
+    @contextmanager
+    def _timed(self, operation: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            LATENCY_STATS.record(f'{self.collection_name}.{operation}', elapsed_ms)
+            self.logger.debug(f'`{operation}` on `{self.collection_name}` took {elapsed_ms:.1f}ms')
+
+    def _read_kwargs(self, max_time_ms_key: str) -> Dict:
+        return {max_time_ms_key: self.max_time_ms} if self.max_time_ms else {}
+
+    def start_session(self) -> ClientSession:
+        """
+        Causally consistent session, its reads see at least what its earlier reads saw, whichever member of the
+        replica set serves them. Pass it as `session` to the reads
+        """
+        return self.client.start_session(causal_consistency=True)
+
+    def find_one(self, query: Dict[str, Union[Dict, List]], sort: Optional[List] = None,
+                 session: Optional[ClientSession] = None) -> Optional[Dict]:
+        try:
+            with self._timed('find_one'):
+                return self.collection.find_one(query, sort=sort, session=session, **self._read_kwargs('max_time_ms'))
+        except pymongo.errors.ExecutionTimeout as exp:
+            raise MongoDBTimeout(exp)
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while finding a document in the db {exp}')
+
+    def find(self,
+             query: Dict[str, Union[Dict, List]],
+             projection: Dict[str, Union[Dict, List]],
+             limit: int = 0,
+             sort: Optional[List] = None,
+             batch_size: int = 0,
+             hint: Optional[str] = None,
+             session: Optional[ClientSession] = None):
+        """
+        Returns a lazy cursor, which isn't timed as the query only runs once it gets iterated.
+        `hint` pins the query to an index (by name), instead of the one the planner picks
+        """
+        try:
+            cursor = self.collection.find(filter=query, projection=projection, limit=limit, sort=sort,
+                                          batch_size=batch_size, session=session, **self._read_kwargs('max_time_ms'))
+            return cursor.hint(hint) if hint else cursor
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while finding a document in the db {exp}')
+
+    def count(self, query: Dict[str, Union[Dict, List]], session: Optional[ClientSession] = None) -> Optional[int]:
+        try:
+            with self._timed('count'):
+                return self.collection.count_documents(query, session=session, **self._read_kwargs('maxTimeMS'))
+        except pymongo.errors.ExecutionTimeout as exp:
+            raise MongoDBTimeout(exp)
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while counting documents in the db {exp}')
+
+    def aggregate(self, pipeline: List[Dict], **kwargs):
+        kwargs = {**self._read_kwargs('maxTimeMS'), **kwargs}
+        try:
+            with self._timed('aggregate'):
+                try:
+                    return self.collection.aggregate(pipeline, **kwargs)
+                except pymongo.errors.ConnectionFailure:
+                    return self.reconnect().collection.aggregate(pipeline, **kwargs)
+        except pymongo.errors.ExecutionTimeout as exp:
+            raise MongoDBTimeout(exp)
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while executing an aggregation pipeline in the collection {exp}')
+
+    def bulk_write(self, requests: List, ordered: bool = False) -> Dict:
+        """
+        Bulk write in a single round trip, unordered unless `ordered` (which stops at the first failed request).
+        Returns the indexes of the requests that upserted a document & the error message per failed request index
+        """
+        try:
+            with self._timed('bulk_write'):
+                result = self.collection.bulk_write(requests, ordered=ordered)
+            self.logger.info(f'Bulk wrote {len(requests)} requests to the database')
+            return {'upserted': set(result.upserted_ids), 'errors': {}}
+        except pymongo.errors.BulkWriteError as exp:
+            self.logger.error(f'got errors for some requests in a bulk write {exp.details.get("writeErrors")}')
+            errors = {error['index']: error['errmsg'] for error in exp.details.get('writeErrors', [])}
+            if ordered and errors:
+                errors.update({index: 'Not written after an earlier error'
+                               for index in range(min(errors) + 1, len(requests))})
+            return {'upserted': {upserted['index'] for upserted in exp.details.get('upserted', [])},
+                    'errors': errors}
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while bulk writing documents in the db {exp}')
+            return {'upserted': set(), 'errors': {index: str(exp) for index in range(len(requests))}}
+
+    def insert(self, document: Dict) -> Optional[str]:
+        """ Returns the `_id` of the inserted document, `None` if one with the same `_id` exists or the insert fails """
+        try:
+            with self._timed('insert'):
+                result = self.collection.insert_one(document)
+            self.logger.info(f'Pushed current summary to the database')
+            return result.inserted_id
+        except pymongo.errors.DuplicateKeyError:
+            self.logger.info(f'A document with the same key is already in the db')
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while inserting a document in the db {exp}')
+
+    def update(self, query: Dict, update: Dict, upsert: bool = False) -> Optional[int]:
+        try:
+            with self._timed('update'):
+                result = self.collection.update_one(query, update, upsert=upsert)
+            return result.modified_count
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while updating a document in the db {exp}')
+
+    def update_many(self, query: Dict, update: Dict) -> Optional[int]:
+        try:
+            with self._timed('update_many'):
+                result = self.collection.update_many(query, update)
+            return result.modified_count
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while updating documents in the db {exp}')
+
+    def find_one_and_update(self, query: Dict, update: Union[Dict, List], upsert: bool = False) -> Optional[Dict]:
+        """ Atomically updates a document & returns it as it is after the update """
+        try:
+            with self._timed('find_one_and_update'):
+                return self.collection.find_one_and_update(query, update, upsert=upsert,
+                                                           return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while updating a document in the db {exp}')
+
+    def replace(self, document: Dict, query: Dict, upsert: bool = False) -> Optional[int]:
+        try:
+            with self._timed('replace'):
+                result = self.collection.replace_one(query, document, upsert=upsert)
+            return result.modified_count
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while replacing a document in the db {exp}')
+
+    def delete(self, query: Dict[str, Union[Dict, List]]) -> Optional[int]:
+        """ Deletes all the documents matching `query`. Returns the number of deleted documents """
+        try:
+            with self._timed('delete'):
+                result = self.collection.delete_many(query)
+            return result.deleted_count
+        except pymongo.errors.PyMongoError as exp:
+            self.logger.error(f'got an error while deleting documents in the db {exp}')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # The client is owned by `MongoClientRegistry` & kept open for the next warm invocation
+        pass
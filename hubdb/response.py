@@ -0,0 +1,14 @@
+from typing import Dict, Optional
+
+
+def json_response(body, status, headers: Optional[Dict] = None, is_base64_encoded: bool = False):
+    """ Lambda proxy integration response, `headers` are added to (or override) the JSON content type """
+    return {
+        "isBase64Encoded": is_base64_encoded,
+        "headers": {
+            "Content-Type": "application/json",
+            **(headers or {})
+        },
+        "statusCode": int(status),
+        "body": body
+    }
@@ -1,6 +1,13 @@
+import os
+import re
+import abc
 import json
+import time
+import base64
 import logging
-import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 
 
 def get_logger(context='generic', file=True):
@@ -10,8 +17,10 @@ def get_logger(context='generic', file=True):
 
 
 def _return_json_builder(body, status):
+    # A plain JSON body, flagged as base64 API Gateway would decode it for the requests accepting `application/json`,
+    # the binary media type of the REST API
     return {
-        "isBase64Encoded": True,
+        "isBase64Encoded": False,
         "headers": {
             "Content-Type": "application/json"
         },
@@ -19,11 +28,317 @@ def _return_json_builder(body, status):
         "body": body
     }
 
-# Returns Base64 encoded docker credentials from AWS environment
+
+class SecretProvider(abc.ABC):
+    """
+    Source of the docker credentials, `fetch` returns `docker_username` & `docker_password`. Every provider holds them
+    base64 encoded, the way `hubapi/deployment.py` stores them & the clients get them, see `decode_credentials`
+    """
+
+    @abc.abstractmethod
+    def fetch(self) -> Dict[str, str]:
+        ...
+
+
+class EnvSecretProvider(SecretProvider):
+    """ `JINA_DOCKER_USERNAME` & `JINA_DOCKER_PASSWORD` in the Lambda environment """
+
+    def fetch(self) -> Dict[str, str]:
+        return {'docker_username': os.environ['JINA_DOCKER_USERNAME'],
+                'docker_password': os.environ['JINA_DOCKER_PASSWORD']}
+
+
+class SSMSecretProvider(SecretProvider):
+    """
+    `<path>/username` & `<path>/password` in SSM Parameter Store, `password` being a SecureString decrypted by KMS
+    (written by `hubapi/deployment.py` through `aws.services.ssm.SSMParameter`)
+    """
+
+    def __init__(self, path: str):
+        # boto3 comes with the Lambda runtime, but is only imported when SSM is the provider
+        import boto3
+        self.client = boto3.client('ssm')
+        self.path = path.rstrip('/')
+
+    def fetch(self) -> Dict[str, str]:
+        names = {f'{self.path}/username': 'docker_username', f'{self.path}/password': 'docker_password'}
+        response = self.client.get_parameters(Names=list(names), WithDecryption=True)
+        if response['InvalidParameters']:
+            raise KeyError(f'Missing SSM parameters {response["InvalidParameters"]}')
+        return {names[parameter['Name']]: parameter['Value'] for parameter in response['Parameters']}
+
+
+class FileSecretProvider(SecretProvider):
+    """ JSON file with `docker_username` & `docker_password` (base64 encoded), a local stand-in for the others """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self) -> Dict[str, str]:
+        with open(self.path) as fp:
+            secret = json.load(fp)
+        return {'docker_username': secret['docker_username'], 'docker_password': secret['docker_password']}
+
+
+class SecretCache:
+    """
+    Keeps the secret of a provider in memory for `ttl` seconds, so that warm invocations don't do any I/O.
+    Within the last `refresh_ahead` seconds the cached secret is still returned, while a background thread
+    fetches the next one. Lambda freezes the container between invocations, so the refresh only progresses
+    while an invocation runs, which is when it's needed
+    """
+
+    def __init__(self, provider: SecretProvider, ttl: float, refresh_ahead: float):
+        self.logger = get_logger(self.__class__.__name__)
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._secret = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        secret = self.provider.fetch()
+        self._secret, self._expires_at = secret, time.monotonic() + self.ttl
+
+    def _refresh(self):
+        try:
+            with self._lock:
+                self._load()
+        except Exception as exp:
+            # the cached secret is served until it expires, the next invocation tries again
+            self.logger.error(f'Got the following exception while refreshing the secret {exp!r}')
+        finally:
+            self._refreshing = False
+
+    def get(self) -> Dict[str, str]:
+        now = time.monotonic()
+        secret = self._secret
+        if secret is None or now >= self._expires_at:
+            with self._lock:
+                if self._secret is None or time.monotonic() >= self._expires_at:
+                    self._load()
+                return self._secret
+        if now >= self._expires_at - self.refresh_ahead and not self._refreshing:
+            self._refreshing = True
+            threading.Thread(target=self._refresh, daemon=True).start()
+        # the secret read before the refresh started, the refresh may have replaced it already
+        return secret
+
+    def clear(self):
+        with self._lock:
+            self._secret, self._expires_at = None, 0.0
+
+
+class SecretSource:
+    ENV = 'env'
+    SSM = 'ssm'
+    FILE = 'file'
+
+
+DEFAULT_SECRET_TTL = 300
+DEFAULT_SECRET_REFRESH_AHEAD = 60
+
+# Module level, so warm invocations re-use the cached secret
+_secret_cache = None
+
+
+def secret_provider() -> SecretProvider:
+    """
+    Picked by `JINA_DOCKER_SECRET_SOURCE`: `env` (default), `ssm` (under `JINA_DOCKER_SECRET_SSM_PATH`)
+    or `file` (at `JINA_DOCKER_SECRET_FILE`)
+    """
+    source = os.environ.get('JINA_DOCKER_SECRET_SOURCE', SecretSource.ENV)
+    if source == SecretSource.SSM:
+        return SSMSecretProvider(path=os.environ['JINA_DOCKER_SECRET_SSM_PATH'])
+    if source == SecretSource.FILE:
+        return FileSecretProvider(path=os.environ['JINA_DOCKER_SECRET_FILE'])
+    if source == SecretSource.ENV:
+        return EnvSecretProvider()
+    raise ValueError(f'Unknown secret source `{source}`')
+
+
+def secret_cache() -> SecretCache:
+    global _secret_cache
+    if _secret_cache is None:
+        _secret_cache = SecretCache(provider=secret_provider(),
+                                    ttl=float(os.environ.get('JINA_DOCKER_SECRET_TTL') or DEFAULT_SECRET_TTL),
+                                    refresh_ahead=float(os.environ.get('JINA_DOCKER_SECRET_REFRESH_AHEAD') or
+                                                        DEFAULT_SECRET_REFRESH_AHEAD))
+    return _secret_cache
+
+
+def reset_secret_cache():
+    """ Forgets the cached secret & provider, picking up a changed environment (used by the tests) """
+    global _secret_cache
+    _secret_cache = None
+
+
+class Registry:
+    # Token endpoint of the registry (https://docs.docker.com/registry/spec/auth/token/)
+    AUTH_URL = os.environ.get('JINA_DOCKER_REGISTRY_AUTH_URL', 'https://auth.docker.io/token')
+    SERVICE = os.environ.get('JINA_DOCKER_REGISTRY_SERVICE', 'registry.docker.io')
+    METHOD = 'GET'
+    # Tokens are only minted for pulls, of repositories under this prefix
+    REPOSITORY_PREFIX = os.environ.get('JINA_DOCKER_REPOSITORY_PREFIX', 'jinahub/')
+    REPOSITORY_PATTERN = re.compile(r'[a-z0-9]+(?:[._-][a-z0-9]+)*(?:/[a-z0-9]+(?:[._-][a-z0-9]+)*)*')
+    # Lifetime of a token the registry returns without `expires_in`, per the spec
+    DEFAULT_EXPIRES_IN = 60
+    CONNECT_TIMEOUT = 2
+    READ_TIMEOUT = 5
+
+
+class RegistryTokenCache:
+    """
+    LRU cache of the bearer tokens minted per scope, each one handed out until `refresh_margin` seconds before it
+    expires, so that a token is never handed out too close to its expiry to be used by the client.
+    Minting holds the lock, so concurrent requests for a scope wait for one upstream login instead of each logging in
+    """
+
+    def __init__(self, max_size: int, refresh_margin: float):
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scope: str) -> Optional[Dict]:
+        """ The cached token, `None` if there isn't one valid for long enough """
+        entry = self._entries.get(scope)
+        if entry is None:
+            return None
+        token, expires_at = entry
+        if expires_at - self.refresh_margin <= time.monotonic():
+            del self._entries[scope]
+            return None
+        self._entries.move_to_end(scope)
+        return {**token, 'expires_in': int(expires_at - time.monotonic())}
+
+    def put(self, scope: str, token: Dict):
+        self._entries[scope] = (token, time.monotonic() + token['expires_in'])
+        self._entries.move_to_end(scope)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_or_mint(self, scope: str, mint) -> Dict:
+        token = self.get(scope)
+        if token is not None:
+            return token
+        with self._lock:
+            token = self.get(scope)
+            if token is None:
+                token = mint(scope)
+                self.put(scope, token)
+        return token
+
+    def clear(self):
+        self._entries.clear()
+
+
+REGISTRY_TOKEN_CACHE_SIZE = 256
+# A token has at least this many seconds left when handed out, enough for the client to pull the manifest & layers
+REGISTRY_TOKEN_REFRESH_MARGIN = 15
+
+REGISTRY_TOKEN_CACHE = RegistryTokenCache(max_size=REGISTRY_TOKEN_CACHE_SIZE,
+                                          refresh_margin=REGISTRY_TOKEN_REFRESH_MARGIN)
+
+# Module level, so warm invocations re-use the connection to the registry
+_http = None
+
+
+def http_client():
+    global _http
+    if _http is None:
+        # only paid for by the invocations minting a token
+        import urllib3
+        _http = urllib3.PoolManager(num_pools=1,
+                                    timeout=urllib3.Timeout(connect=Registry.CONNECT_TIMEOUT,
+                                                            read=Registry.READ_TIMEOUT),
+                                    retries=False)
+    return _http
+
+
+class RegistryTokenFailed(Exception):
+    """ The registry didn't mint a token with the docker credentials """
+
+
+def pull_scope(repository: str) -> str:
+    """ Scope of a token pulling `repository`, `ValueError` for repositories tokens aren't minted for """
+    if not Registry.REPOSITORY_PATTERN.fullmatch(repository) or \
+            not repository.startswith(Registry.REPOSITORY_PREFIX):
+        raise ValueError(f'Invalid repository `{repository}`')
+    return f'repository:{repository}:pull'
+
+
+def decode_credentials(secret: Dict[str, str]) -> Tuple[str, str]:
+    """ Plain username & password of a secret fetched by any `SecretProvider` """
+    return tuple(base64.b64decode(secret[key]).decode('ascii') for key in ['docker_username', 'docker_password'])
+
+
+def mint_registry_token(scope: str) -> Dict:
+    """ Logs in to the registry with the docker credentials, for a bearer token of `scope` """
+    logger = get_logger(context='mint_registry_token')
+    username, password = decode_credentials(secret_cache().get())
+    basic = base64.b64encode(f'{username}:{password}'.encode('ascii')).decode('ascii')
+    response = http_client().request(method=Registry.METHOD, url=Registry.AUTH_URL,
+                                     fields={'service': Registry.SERVICE, 'scope': scope},
+                                     headers={'Authorization': f'Basic {basic}'})
+    logger.info(f'Got the following response status from the registry: {response.status}')
+    if response.status != 200:
+        raise RegistryTokenFailed(f'Registry returned {response.status} for `{scope}`')
+    body = json.loads(response.data)
+    token = body.get('token') or body.get('access_token')
+    if not token:
+        raise RegistryTokenFailed(f'Registry returned no token for `{scope}`')
+    return {'token': token, 'expires_in': int(body.get('expires_in') or Registry.DEFAULT_EXPIRES_IN)}
+
+
+def raw_credentials_allowed() -> bool:
+    """ Whether requests without a `repository` still get the docker credentials, until all clients pull by token """
+    return os.environ.get('JINA_DOCKER_RAW_CREDENTIALS', 'true').lower() == 'true'
+
+
+def _credentials_response(logger):
+    try:
+        secret = secret_cache().get()
+    except Exception as exp:
+        logger.error(f'Got the following exception while reading the docker credentials {exp!r}')
+        return _return_json_builder(body='Docker credentials are not available. Please check Lambda logs',
+                                    status=500)
+
+    return _return_json_builder(body=json.dumps({"docker_username": secret['docker_username'],
+                                                 "docker_password": secret['docker_password']}), status=200)
+
+
+def _token_response(repository, logger):
+    try:
+        scope = pull_scope(repository)
+    except ValueError as exp:
+        return _return_json_builder(body=str(exp), status=400)
+
+    try:
+        token = REGISTRY_TOKEN_CACHE.get_or_mint(scope, mint_registry_token)
+    except Exception as exp:
+        logger.error(f'Got the following exception while minting a registry token {exp!r}')
+        return _return_json_builder(body='Registry token is not available. Please check Lambda logs',
+                                    status=502)
+
+    # same fields as the token endpoint of the registry, `expires_in` being what's left of the cached token
+    return _return_json_builder(body=json.dumps({"token": token['token'], "access_token": token['token'],
+                                                 "expires_in": token['expires_in'], "scope": scope}), status=200)
+
+
 def lambda_handler(event, context):
+    """Hands out a short-lived bearer token pulling the `repository` query parameter, minted with the docker
+    credentials & shared by every request for the same repository until close to its expiry.
+    Without `repository`, returns the docker credentials (base64 encoded, as stored) in a json body, unless
+    `JINA_DOCKER_RAW_CREDENTIALS` is `false`
+    """
     logger = get_logger(context='docker_auth')
 
-    docker_username = os.environ['JINA_DOCKER_USERNAME']
-    docker_password = os.environ['JINA_DOCKER_PASSWORD']
-
-    return _return_json_builder(body=json.dumps({"docker_username": docker_username, "docker_password": docker_password}), status=200)
+    repository = ((event or {}).get('queryStringParameters') or {}).get('repository')
+    if repository:
+        return _token_response(repository, logger)
+    if not raw_credentials_allowed():
+        return _return_json_builder(body='Pass the `repository` to pull', status=400)
+    return _credentials_response(logger)
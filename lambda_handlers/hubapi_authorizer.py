@@ -1,7 +1,12 @@
-import logging
+import os
 import re
-
-import urllib3
+import json
+import time
+import hashlib
+import logging
+import functools
+from collections import OrderedDict
+from typing import Optional, Dict
 
 
 def get_logger(context='generic', file=True):
@@ -10,27 +15,204 @@ def get_logger(context='generic', file=True):
     return logger
 
 
-def validate_github_token(token):
-    logger = get_logger(context='validate_github_token')
-    http = urllib3.PoolManager()
-    if not token:
-        logging.warning(f'No tokens passed to validate_github_token')
-        return False
+class GitHub:
+    URL = os.environ.get('JINA_GITHUB_API_URL', 'https://api.github.com')
+    # Authenticated user of the token
+    USER_PATH = '/user'
+    # Accepts any valid token, including the GitHub App & Actions installation tokens `USER_PATH` answers 403 to
+    ROOT_PATH = '/'
+    METHOD = 'GET'
+    APP = 'jina-hub-api'
+    # Fail fast instead of holding the authorizer (& the request behind it) when GitHub is slow
+    CONNECT_TIMEOUT = 2
+    READ_TIMEOUT = 3
+
+
+class TokenCache:
+    """
+    LRU cache of the GitHub identity (`login` & `id`) of tokens, keyed on a hash of the token so that tokens are
+    never kept in memory. Invalid tokens are cached with an empty identity & for a shorter time, as they may just
+    not have been propagated by GitHub yet
+    """
+
+    def __init__(self, max_size: int, valid_ttl: float, invalid_ttl: float):
+        self.max_size = max_size
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def ttl(self, identity: Dict) -> float:
+        return self.valid_ttl if identity else self.invalid_ttl
+
+    def get(self, key: str) -> Optional[Dict]:
+        """ The cached identity, `None` if the token isn't cached """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        identity, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return identity
+
+    def put(self, key: str, identity: Dict):
+        self._entries[key] = (identity, time.monotonic() + self.ttl(identity))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class DynamoDBTokenStore:
+    """
+    Token identities shared by all the authorizer containers, in a DynamoDB table with a `token_hash` (string)
+    partition key & TTL enabled on `expires_at`. Any error is logged & treated as a miss
+    """
+
+    def __init__(self, table_name: str):
+        self.logger = get_logger(self.__class__.__name__)
+        # boto3 comes with the Lambda runtime, but is only imported when the table is configured
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            item = self.table.get_item(Key={'token_hash': key}).get('Item')
+        except Exception as exp:
+            self.logger.error(f'got an error while reading the token cache {exp!r}')
+            return None
+        # DynamoDB only deletes expired items eventually
+        if item is None or int(item['expires_at']) <= time.time():
+            return None
+        if not item['valid']:
+            return {}
+        return {'login': item['login'], 'id': int(item['github_id'])} if 'github_id' in item else INSTALLATION_IDENTITY
+
+    def put(self, key: str, identity: Dict, ttl: float):
+        item = {'token_hash': key, 'valid': bool(identity), 'expires_at': int(time.time() + ttl)}
+        if identity.get('id'):
+            item.update({'login': identity['login'], 'github_id': identity['id']})
+        try:
+            self.table.put_item(Item=item)
+        except Exception as exp:
+            self.logger.error(f'got an error while writing the token cache {exp!r}')
+
+
+TOKEN_CACHE_SIZE = 1024
+VALID_TOKEN_TTL = 300
+INVALID_TOKEN_TTL = 30
+
+TOKEN_CACHE = TokenCache(max_size=TOKEN_CACHE_SIZE, valid_ttl=VALID_TOKEN_TTL, invalid_ttl=INVALID_TOKEN_TTL)
+
+# Module level, so warm invocations re-use the connections to GitHub & to the persistent cache
+_http = None
+_token_store = None
+
+
+def http_client():
+    global _http
+    if _http is None:
+        # urllib3 is most of the import time of this module, only pay for it when there is a token to validate
+        import urllib3
+        _http = urllib3.PoolManager(num_pools=1,
+                                    timeout=urllib3.Timeout(connect=GitHub.CONNECT_TIMEOUT, read=GitHub.READ_TIMEOUT),
+                                    retries=False)
+    return _http
+
+
+def token_store() -> Optional[DynamoDBTokenStore]:
+    """ Persistent cache, only used when `JINA_TOKEN_CACHE_TABLE` is set """
+    global _token_store
+    if _token_store is None and os.environ.get('JINA_TOKEN_CACHE_TABLE'):
+        _token_store = DynamoDBTokenStore(table_name=os.environ['JINA_TOKEN_CACHE_TABLE'])
+    return _token_store
+
+
+# Identity of valid tokens that don't belong to a user (GitHub App & Actions installation tokens)
+INSTALLATION_IDENTITY = {'installation': True}
+
+
+class GitHubRateLimited(Exception):
+    """ GitHub rate limited the token, which says nothing about its validity """
+
+
+def _rate_limited(response) -> bool:
+    """ GitHub answers 403 (or 429) with no requests remaining or a `Retry-After` when rate limiting """
+    return response.status in (403, 429) and \
+        (response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers)
+
+
+def _request_github(token, logger) -> Dict:
+    """
+    GitHub identity of the token, empty if GitHub doesn't accept it. Installation tokens aren't allowed to read
+    `/user` (403), those are checked against the API root instead & get `INSTALLATION_IDENTITY`.
+    Raises `GitHubRateLimited` when GitHub rate limits the token
+    """
     headers = {
         'Authorization': f'token {token}',
         'User-Agent': GitHub.APP
     }
     # TODO: Check & implement if email id needs to be stored
-    response = http.request(method=GitHub.METHOD,
-                            url=GitHub.URL,
-                            headers=headers)
+    response = http_client().request(method=GitHub.METHOD,
+                                     url=f'{GitHub.URL}{GitHub.USER_PATH}',
+                                     headers=headers)
     logger.info(f'Got the following response status from Github: {response.status}')
-    return response.status == 200
-
-class GitHub:
-    URL = 'https://api.github.com'
-    METHOD = 'GET'
-    APP = 'jina-hub-api'
+    if _rate_limited(response):
+        raise GitHubRateLimited(f'{GitHub.USER_PATH} answered {response.status}')
+    if response.status == 403:
+        response = http_client().request(method=GitHub.METHOD,
+                                         url=f'{GitHub.URL}{GitHub.ROOT_PATH}',
+                                         headers=headers)
+        logger.info(f'Got the following response status from the Github API root: {response.status}')
+        if _rate_limited(response):
+            raise GitHubRateLimited(f'{GitHub.ROOT_PATH} answered {response.status}')
+        return INSTALLATION_IDENTITY if response.status == 200 else {}
+    if response.status != 200:
+        return {}
+    user = json.loads(response.data)
+    return {'login': user['login'], 'id': user['id']}
+
+
+def validate_github_token(token) -> Dict:
+    """
+    Returns the GitHub identity (`login` & `id`) of a valid user token, `INSTALLATION_IDENTITY` of a valid
+    installation token, an empty dict otherwise
+    """
+    logger = get_logger(context='validate_github_token')
+    if not token:
+        logging.warning(f'No tokens passed to validate_github_token')
+        return {}
+
+    key = TokenCache.key(token)
+    identity = TOKEN_CACHE.get(key)
+    if identity is not None:
+        logger.info('Got the token identity from the in-memory cache')
+        return identity
+
+    store = token_store()
+    identity = store.get(key) if store else None
+    if identity is not None:
+        logger.info('Got the token identity from the persistent cache')
+        TOKEN_CACHE.put(key, identity)
+        return identity
+
+    try:
+        identity = _request_github(token=token, logger=logger)
+    except Exception as exp:
+        # Not cached (e.g. rate limited), the next request asks GitHub again
+        logger.error(f'Couldn\'t validate the token with GitHub {exp!r}')
+        return {}
+    TOKEN_CACHE.put(key, identity)
+    if store:
+        store.put(key, identity, ttl=TOKEN_CACHE.ttl(identity))
+    return identity
 
 
 class HttpVerb:
@@ -51,8 +233,9 @@ class AuthPolicy:
     principal_id = ''
     # The policy version used for the evaluation. This should always be '2012-10-17'
     version = '2012-10-17'
-    # The regular expression used to validate resource paths for the policy
-    path_regex = '^[/.a-zA-Z0-9-\*]+$'
+    # The regular expression used to validate resource paths for the policy, compiled once per container
+    path_regex = r'^[/.a-zA-Z0-9-\*]+$'
+    path_pattern = re.compile(path_regex)
 
     '''Internal lists of allowed and denied methods.
 
@@ -82,8 +265,7 @@ class AuthPolicy:
         statement can be null.'''
         if verb != '*' and not hasattr(HttpVerb, verb):
             raise NameError('Invalid HTTP verb ' + verb + '. Allowed verbs in HttpVerb class')
-        resource_pattern = re.compile(self.path_regex)
-        if not resource_pattern.match(resource):
+        if not self.path_pattern.match(resource):
             raise NameError('Invalid resource path: ' + resource + '. Path should match ' + self.path_regex)
 
         if resource[:1] == '/':
@@ -188,6 +370,62 @@ class AuthPolicy:
         return policy
 
 
+class FrozenDict(dict):
+    """ `dict` that can't be changed (but is still serialized by `json`), to safely share cached policies """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{self.__class__.__name__} can\'t be changed')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+# Principal of the requests without a valid GitHub token
+ANONYMOUS_PRINCIPAL = 'anonymous'
+
+
+class PolicyShape:
+    ALLOW_ALL = 'allow_all'
+    READ_ONLY = 'read_only'
+
+
+@functools.lru_cache(maxsize=128)
+def policy_document(shape: str, aws_account_id: str, rest_api_id: str, region: str, stage: str) -> FrozenDict:
+    """
+    Policy document of one of the `PolicyShape`s, which only depends on the API it is built for.
+    Built once per API & container, the same (immutable) document is returned afterwards
+    """
+    policy = AuthPolicy('', aws_account_id)
+    policy.rest_api_id = rest_api_id
+    policy.region = region
+    policy.stage = stage
+
+    if shape == PolicyShape.ALLOW_ALL:
+        policy.allow_all_methods()
+    elif shape == PolicyShape.READ_ONLY:
+        policy.allow_method(HttpVerb.GET, '/list/')
+        policy.deny_method(HttpVerb.POST, '/push/')
+    else:
+        raise NameError(f'Invalid policy shape {shape}')
+    return _freeze(policy.build()['policyDocument'])
+
+
+def principal(identity: Dict, token: str) -> str:
+    """ Users are identified by their GitHub id, installation tokens (which rotate hourly) by their hash """
+    if identity.get('id'):
+        return f'github|{identity["id"]}'
+    if identity:
+        return f'github-installation|{TokenCache.key(token)[:16]}'
+    return ANONYMOUS_PRINCIPAL
+
+
 def lambda_handler(event, context):
     logger = get_logger(context='hub_authorizer')
 
@@ -202,25 +440,22 @@ def lambda_handler(event, context):
         method_arn = event['methodArn']
         logger.info(f'Current Method ARN: {method_arn}')
 
-    principal_id = 'user|a1b2c3d4'
     tmp = event['methodArn'].split(':')
     apiGatewayArnTmp = tmp[5].split('/')
     aws_account_id = tmp[4]
 
-    policy = AuthPolicy(principal_id, aws_account_id)
-    policy.rest_api_id = apiGatewayArnTmp[0]
-    policy.region = tmp[3]
-    policy.stage = apiGatewayArnTmp[1]
-
-    if validate_github_token(token=github_token):
-        policy.allow_all_methods()
-    else:
-        policy.allow_method(HttpVerb.GET, '/list/')
-        policy.deny_method(HttpVerb.POST, '/push/')
-
-    auth_response = policy.build()
-    context = {
-        'user_email': 'value',  # TODO: $context.authorizer.user_email -> value
+    identity = validate_github_token(token=github_token)
+    shape = PolicyShape.ALLOW_ALL if identity else PolicyShape.READ_ONLY
+    auth_response = {
+        'principalId': principal(identity=identity, token=github_token),
+        'policyDocument': policy_document(shape=shape, aws_account_id=aws_account_id,
+                                          rest_api_id=apiGatewayArnTmp[0], region=tmp[3],
+                                          stage=apiGatewayArnTmp[1])
     }
+    # Passed on to the Lambda functions behind the API in `requestContext.authorizer` (values have to be strings)
+    context = {
+        'github_login': identity['login'],
+        'github_id': str(identity['id'])
+    } if identity.get('id') else {}
     auth_response['context'] = context
     return auth_response
@@ -1,119 +1,397 @@
+import io
 import os
+import re
 import json
+import time
 import base64
-import logging
-from typing import Optional, Dict, List, Union
+import binascii
+import hashlib
+import functools
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
 
 import pymongo
+from pymongo.read_preferences import SecondaryPreferred
+from bson import ObjectId
+from bson.errors import InvalidId
 
+from hubdb import (MongoDBException, MongoDBTimeout, MongoDBHandler, get_logger, is_db_envs_set, read_environment,
+                   json_response, NGRAM_SIZE, ngrams, CATALOGUE_GENERATION_ID, latest_collection_name,
+                   generation_collection_name, archive_collection_name, log_latency)
 
-def get_logger(context='generic', file=True):
-    logger = logging.getLogger(context)
-    logger.setLevel(logging.DEBUG)
-    return logger
 
+# Secondaries lagging the primary by more than this are not read from (MongoDB requires at least 90 seconds)
+DEFAULT_MAX_STALENESS_SECONDS = 90
 
-class MongoDBException(Exception):
-    """ Any errors raised by MongoDb """
+# Server side time budget of every read, well below the Lambda timeout
+DEFAULT_MAX_TIME_MS = 5000
 
+# Seconds clients are asked to wait before retrying a read that went over its time budget
+RETRY_AFTER_SECONDS = 5
 
-class MongoDBHandler:
+
+@functools.lru_cache(maxsize=None)
+def read_options() -> Dict:
     """
-    Mongodb Handler to connect to the database & insert documents in the collection
+    `MongoDBHandler` options of every read: the list tolerates slightly stale images, so reads are served by
+    a secondary when one is available. Configured with `JINA_LIST_MAX_STALENESS_SECONDS` & `JINA_LIST_MAX_TIME_MS`
     """
+    max_staleness = int(os.environ.get('JINA_LIST_MAX_STALENESS_SECONDS') or DEFAULT_MAX_STALENESS_SECONDS)
+    return {
+        'read_preference': SecondaryPreferred(max_staleness=max_staleness),
+        'max_time_ms': int(os.environ.get('JINA_LIST_MAX_TIME_MS') or DEFAULT_MAX_TIME_MS)
+    }
 
-    def __init__(self, hostname: str, username: str, password: str,
-                 database_name: str, collection_name: str):
-        self.logger = get_logger(self.__class__.__name__)
-        self.hostname = hostname
-        self.username = username
-        self.password = password
-        self.database_name = database_name
-        self.collection_name = collection_name
-        self.connection_string = \
-            f'mongodb+srv://{self.username}:{self.password}@{self.hostname}'
-
-    def __enter__(self):
-        return self.connect()
-
-    def connect(self) -> 'MongoDBHandler':
-        try:
-            self.client = pymongo.MongoClient(self.connection_string)
-            self.client.admin.command('ismaster')
-            self.logger.info('Successfully connected to the database')
-        except pymongo.errors.ConnectionFailure:
-            raise MongoDBException('Database server is not available')
-        except pymongo.errors.ConfigurationError:
-            raise MongoDBException('Credentials passed are not correct!')
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
-        except Exception as exp:
-            raise MongoDBException(exp)
-        return self
-
-    @property
-    def database(self):
-        return self.client[self.database_name]
-
-    @property
-    def collection(self):
-        return self.database[self.collection_name]
-
-    def find_one(self, query: Dict[str, Union[Dict, List]]) -> None:
-        try:
-            return self.collection.find_one(query)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while finding a document in the db {exp}')
-
-    def find(self,
-             query: Dict[str, Union[Dict, List]],
-             projection: Dict[str, Union[Dict, List]],
-             limit: int = 0) -> None:
-        try:
-            return self.collection.find(filter=query, projection=projection, limit=limit)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while finding a document in the db {exp}')
 
-    def aggregate(self, pipeline: List[Dict]):
-        try:
-            return self.collection.aggregate(pipeline)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while executing an aggregation pipeline in the collection {exp}')
+class ResponseCache:
+    """
+    LRU cache of already serialized list responses, bound in size & time.
+    Every entry remembers the catalogue generation it was built from (bumped by `hubapi_push`),
+    entries from an older generation are dropped on lookup.
+    """
 
-    def insert(self, document: str) -> Optional[str]:
-        try:
-            result = self.collection.insert_one(document)
-            self.logger.info(f'Pushed current summary to the database')
-            return result.inserted_id
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while inserting a document in the db {exp}')
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str, generation: int) -> Optional[Tuple]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, entry_generation, response = entry
+            if entry_generation == generation and expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self._entries[key]
+        self.misses += 1
+
+    def put(self, key: str, generation: int, response: Tuple):
+        self._entries[key] = (time.monotonic() + self.ttl, generation, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_TTL = 300
+
+# Survives across warm invocations of the same container
+RESPONSE_CACHE = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def cache_key(query_string_params: Dict) -> str:
+    """ Normalized query strings, order of keys & of multi-valued query strings doesn't change the result """
+    return json.dumps({k: sorted(v) if isinstance(v, list) else v for k, v in query_string_params.items()},
+                      sort_keys=True)
+
+
+# Lets API Gateway / CloudFront & clients re-use a listing for a while, then revalidate it with its `ETag`
+CACHE_CONTROL_MAX_AGE = 60
+
+
+def compute_etag(generation: int, key: str) -> str:
+    """ Strong ETag, a listing only changes when the catalogue generation or the query does """
+    return '"' + hashlib.sha1(f'{generation}:{key}'.encode('utf-8')).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    # weak comparison, as recommended for `If-None-Match` (RFC 7232)
+    return '*' in candidates or etag in [candidate[2:] if candidate.startswith('W/') else candidate
+                                         for candidate in candidates]
+
+
+def request_header(event, name: str) -> Optional[str]:
+    """ Header names are case-insensitive, API Gateway passes them as sent by the client """
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+
+
+# Lambda caps synchronous responses at 6 MB, keep headroom for the headers & the base64 overhead of gzip
+MAX_PAYLOAD_BYTES = 4 * 1024 * 1024
+
+# Documents fetched from the db per round trip while encoding a response
+CURSOR_BATCH_SIZE = 100
+
+# The only binary media type of the REST API (`BinaryMediaTypes` in `apigateway.yml`): API Gateway decodes a base64
+# body when the request accepts it, so only those requests get a compressed response
+COMPRESSED_MEDIA_TYPE = 'application/json'
+
+
+def accepts_gzip(event) -> bool:
+    return ('gzip' in (request_header(event, 'Accept-Encoding') or '')
+            and COMPRESSED_MEDIA_TYPE in (request_header(event, 'Accept') or ''))
+
+
+def checked(result):
+    """ Result of a `MongoDBHandler` read, which returns `None` (& logs the error) when the read failed """
+    if result is None:
+        raise MongoDBException('Couldn\'t read from the database, see the logs')
+    return result
 
-    def replace(self, document: Dict, query: Dict):
-        try:
-            result = self.collection.replace_one(query, document)
-            return result.modified_count
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while replacing a document in the db {exp}')
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+def encode_cursor(cursor, max_bytes: int = MAX_PAYLOAD_BYTES,
+                  limit: int = 0) -> Tuple[str, int, Optional[str], bool, bool]:
+    """
+    Serializes the documents of `cursor` into a JSON array one at a time, so only the encoded output
+    (& one batch of documents) is held in memory. Stops before the output exceeds `max_bytes`,
+    or after `limit` documents (if set). Queries fetch one document more than the page, for the cursor to tell
+    whether another page follows.
+
+    Returns the body, the number of documents written, the `docker-name` of the last document written
+    (for the client to continue `after`), whether the output got truncated & whether documents are left.
+    """
+    buffer = io.StringIO()
+    buffer.write('[')
+    size, count = 2, 0
+    last_name = None
+    for document in cursor:
+        if limit and count == limit:
+            cursor.close()
+            buffer.write(']')
+            return buffer.getvalue(), count, last_name, False, True
+        # `json.dumps` escapes non-ascii characters, so its length is the size in bytes
+        item = json.dumps(document)
+        if size + len(item) + 1 > max_bytes:
+            cursor.close()
+            buffer.write(']')
+            return buffer.getvalue(), count, last_name, True, True
+        if count:
+            buffer.write(',')
+        buffer.write(item)
+        size += len(item) + 1
+        count += 1
+        last_name = document.get('docker-name')
+    buffer.write(']')
+    return buffer.getvalue(), count, last_name, False, False
+
+
+def encode_continuation_token(after: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'after': after}).encode('utf-8')).decode('ascii')
+
+
+def decode_continuation_token(token: str) -> Dict:
+    """ Raises `ValueError` for anything that isn't a token returned by `encode_continuation_token` """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (TypeError, UnicodeError, binascii.Error, json.JSONDecodeError) as exp:
+        raise ValueError(f'Invalid continuation token {token!r}') from exp
+    if not isinstance(decoded, dict) or not isinstance(decoded.get('after', None), str):
+        raise ValueError(f'Invalid continuation token {token!r}')
+    return {'after': decoded['after']}
+
+
+# API Gateway resource served by `history_handler`
+HISTORY_RESOURCE = '/history'
+
+
+def configure_history_query(**kwargs) -> Dict:
+    """ Query on the archive buckets of one build key. Raises `ValueError` if the build key is incomplete """
+    query = {}
+    for param, field in [('name', 'name'), ('version', 'version'), ('jina_version', 'jina_version')]:
+        if not kwargs.get(param):
+            raise ValueError(f'Missing {param}')
+        query[field] = kwargs[param]
+    if 'after' in kwargs:
         try:
-            self.client.close()
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
+            query['bucket'] = {'$gt': ObjectId(kwargs['after'])}
+        except InvalidId as exp:
+            raise ValueError(f'Invalid bucket {kwargs["after"]!r}') from exp
+    return query
 
 
-def is_db_envs_set():
-    """ Checks if any of the db env variables are not set """
-    keys = ['JINA_DB_HOSTNAME', 'JINA_DB_USERNAME', 'JINA_DB_PASSWORD', 'JINA_DB_NAME', 'JINA_HUBPOD_COLLECTION', 'JINA_METADATA_COLLECTION']
-    return all(len(os.environ.get(k, '')) > 0 for k in keys)
+def read_build_history(db: 'MongoDBHandler', query: Dict, limit: int) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Reads the archived builds of `query` oldest first, whole buckets at a time until `limit` builds are read.
+
+    Returns the builds & the `bucket` to continue `after` (None on the last page).
+    """
+    entries = []
+    cursor = checked(db.find(query=query, projection={'_id': 0, 'entries': 1, 'bucket': 1}, sort=[('bucket', 1)],
+                             batch_size=CURSOR_BATCH_SIZE))
+    for bucket in cursor:
+        entries.extend(bucket['entries'])
+        if len(entries) >= limit:
+            has_more = next(cursor, None) is not None
+            cursor.close()
+            return entries, str(bucket['bucket']) if has_more else None
+    return entries, None
+
+
+def history_handler(event, logger):
+    """ Pages through the full build history of one image (`name`, `version` & `jina-version`) """
+    query_string_params = handle_query_strings(event)
+    try:
+        if 'continuation_token' in query_string_params:
+            query_string_params.update(decode_continuation_token(query_string_params.pop('continuation_token')))
+        limit = page_size(**query_string_params)
+        query = configure_history_query(**query_string_params)
+    except ValueError as exp:
+        logger.warning(f'{exp}')
+        return _return_json_builder(body=f'Invalid request: {exp}',
+                                    status=400)
+    hostname, username, password, database_name, hubpod_collection, metadata_collection = read_environment()
+
+    try:
+        with MongoDBHandler(hostname=hostname, username=username, password=password,
+                            database_name=database_name, **read_options(),
+                            collection_name=archive_collection_name(metadata_collection)) as db:
+            entries, after = read_build_history(db=db, query=query, limit=limit)
+    except (MongoDBTimeout, pymongo.errors.ExecutionTimeout) as exp:
+        logger.warning(f'Read went over its time budget {exp}')
+        return _timeout_response()
+    except (MongoDBException, pymongo.errors.PyMongoError) as exp:
+        # cursors raise `OperationFailure` & co while they get iterated, the handler only catches them on the call
+        logger.error(f'Couldn\'t read from the database {exp!r}')
+        return _return_json_builder(body='Couldn\'t connect to the database',
+                                    status=502)
+    if not entries:
+        return _return_json_builder(body='No docs found', status=400)
+    continuation_token = encode_continuation_token(after=after) if after else None
+    return _return_json_builder(body=json.dumps(entries, default=str), status=200,
+                                headers=_page_headers(continuation_token=continuation_token, total=None))
+
+
+# Filters on these fields need every version of an executor, so they can't be served by the latest collection
+VERSION_FILTERS = ['jina_version', 'version']
+
+
+def use_latest_collection(**kwargs) -> bool:
+    return not any(field in kwargs for field in VERSION_FILTERS)
+
+
+class NameSearchMode:
+    # Index lookup on the n-grams of the lowercased names
+    NGRAM = 'ngram'
+    # Unanchored case-insensitive regex, can't use an index
+    REGEX = 'regex'
+
+
+# `ngram` is opt in (`search-mode=ngram`) until it has been benchmarked on a production sized catalogue
+DEFAULT_NAME_SEARCH_MODE = NameSearchMode.REGEX
+
+
+def configure_name_filter(name: str, fields: List[str], search_mode: str = DEFAULT_NAME_SEARCH_MODE) -> Dict:
+    """
+    Forms the filter for a substring search on the executor name.
+    `ngram` mode matches all n-grams of the search string against the multikey `_search.ngrams` index
+    & then confirms the substring on the (few) candidates. `regex` mode searches every field in `fields`.
+    """
+    if search_mode == NameSearchMode.REGEX:
+        return {
+            '$or': [{field: {'$regex': f'.*{re.escape(name)}.*', '$options': 'i'}} for field in fields]
+        }
+
+    name = name.lower()
+    return {
+        '_search.ngrams': {'$all': ngrams(name, min(len(name), NGRAM_SIZE))},
+        '_search.names': {'$regex': re.escape(name)}
+    }
+
+
+class ListIndex:
+    """
+    Indexes (declared in `hubapi/indexes.py`) the list queries are pinned to with `hint`, so that the plan doesn't
+    depend on which index wins the planner's trial on the current data. `check_query_plans.py` explains the same
+    """
+    # hubpod collection, only the live builds (`_deleted: False`) & sorted like the aggregation
+    LIVE_NAME = 'live_name_sort_key'
+    LIVE_JINA_VERSION_NAME = 'live_jina_version_name_sort_key'
+    LIVE_VERSION_NAME = 'live_version_name_sort_key'
+    # latest collection, the equality prefix keeps the results in `_id` order
+    ID = '_id_'
+    KIND = 'kind_id'
+    TYPE = 'type_id'
+    KEYWORDS = 'keywords_id'
+    SEARCH_NGRAMS = 'search_ngrams_id'
+
+
+def latest_query_hint(**kwargs) -> str:
+    """ Index of the most selective filter of a latest collection query """
+    if kwargs.get('name', None) and isinstance(kwargs['name'], str) and \
+            kwargs.get('search_mode', DEFAULT_NAME_SEARCH_MODE) == NameSearchMode.NGRAM:
+        return ListIndex.SEARCH_NGRAMS
+    if isinstance(kwargs.get('keywords', None), list):
+        return ListIndex.KEYWORDS
+    if 'kind' in kwargs:
+        return ListIndex.KIND
+    if 'type' in kwargs:
+        return ListIndex.TYPE
+    return ListIndex.ID
+
+
+def aggregation_hint(**kwargs) -> str:
+    """ Index of a hubpod aggregation, with the version filter (if any) as its equality prefix """
+    if 'jina_version' in kwargs:
+        return ListIndex.LIVE_JINA_VERSION_NAME
+    if 'version' in kwargs:
+        return ListIndex.LIVE_VERSION_NAME
+    return ListIndex.LIVE_NAME
+
+
+def configure_latest_query(**kwargs):
+    """
+    Forms the filter & limit to read from the latest collection.
+    Documents there are keyed on the docker name (`_id`), so `after` is a plain range on the `_id` index.
+    """
+    query = {}
+
+    for field in ['kind', 'type']:
+        if field in kwargs:
+            query[field] = kwargs[field].lower()
+
+    if isinstance(kwargs.get('keywords', None), list):
+        query['keywords'] = {'$in': [i.lower() for i in kwargs['keywords']]}
+
+    if kwargs.get('name', None) and isinstance(kwargs['name'], str):
+        query.update(configure_name_filter(name=kwargs['name'], fields=['docker-name', 'name'],
+                                           search_mode=kwargs.get('search_mode', DEFAULT_NAME_SEARCH_MODE)))
+
+    if 'after' in kwargs:
+        query['_id'] = {'$gt': kwargs['after']}
+
+    return query, page_size(**kwargs)
+
+
+# Upper bound on the images in one response, clients page through the rest with the continuation token
+MAX_PAGE_SIZE = 500
+
+
+def page_size(**kwargs) -> int:
+    """ `n_per_page` capped at `MAX_PAGE_SIZE`. Raises `ValueError` if it isn't a positive integer """
+    if 'n_per_page' not in kwargs:
+        return MAX_PAGE_SIZE
+    n_per_page = int(kwargs['n_per_page'])
+    if n_per_page <= 0:
+        raise ValueError(f'Invalid n-per-page {n_per_page}')
+    return min(n_per_page, MAX_PAGE_SIZE)
+
+
+def with_total(**kwargs) -> bool:
+    return str(kwargs.get('with_total', '')).lower() in ['1', 'true', 'yes']
 
 
 def configure_matches_stage(**kwargs):
+    # Soft deleted builds are left out by the partial indexes on live (`_deleted: False`) documents,
+    # the filter has to be in the query for the planner to pick them
     matches_stage = {
         '$match': {
+            '_deleted': False
         }
     }
 
+    # Every document of an executor shares its `name`, so keyset pagination can happen before grouping
+    if 'after' in kwargs:
+        matches_stage['$match']['name'] = {'$gt': kwargs['after']}
+
     for field in ['jina_version', 'version']:
         if field in kwargs:
             matches_stage['$match'][field] = kwargs[field]
@@ -125,41 +403,45 @@ def configure_matches_stage(**kwargs):
     if isinstance(kwargs.get('keywords', None), list):
         matches_stage['$match'][f'manifest_info.keywords'] = {'$in': [i.lower() for i in kwargs['keywords']]}
 
-    if isinstance(kwargs.get('name', None), str):
-        matches_stage['$match']['$or'] = [
-            {
-                'name': {
-                    '$regex': f'.*{kwargs["name"]}.*',
-                    '$options': 'i'
-                }
-            },
-            {
-                'manifest_info.name': {
-                    '$regex': f'.*{kwargs["name"]}.*',
-                    '$options': 'i'
-                }
-            }
-        ]
+    if kwargs.get('name', None) and isinstance(kwargs['name'], str):
+        matches_stage['$match'].update(
+            configure_name_filter(name=kwargs['name'], fields=['name', 'manifest_info.name'],
+                                  search_mode=kwargs.get('search_mode', DEFAULT_NAME_SEARCH_MODE))
+        )
+
+    return matches_stage
 
-    if matches_stage['$match']:
-        return matches_stage
+
+def configure_count_aggregation(**kwargs):
+    """ Counts the executors matching the query strings, regardless of the page """
+    kwargs.pop('after', None)
+    aggregation_pipeline = []
+    matches_stage = configure_matches_stage(**kwargs)
+    if matches_stage:
+        aggregation_pipeline.append(matches_stage)
+    aggregation_pipeline.extend([
+        {'$group': {'_id': '$name'}},
+        {'$count': 'total'}
+    ])
+    return aggregation_pipeline
 
 
-def configure_aggregation(**kwargs):
+def configure_aggregation(paginate: bool = True, **kwargs):
 
     aggregation_pipeline = []
 
     """
     Stage 1:
     - Form `$match` from different query strings
-    - This will be executed only if proper query strings are passed
     - Accepted query strings -
-      - `name` -> simple regex search
+      - `name` -> substring search (regex, or the n-gram index with `search-mode=ngram`)
       - `jina_version` -> exact match
       - `version` -> exact match
       - `kind` -> exact match
       - `type` -> exact match
       - `keywords` -> array search
+    - `after` -> keyset pagination on `name`, served by the same index as the sort
+    - Soft deleted builds are always left out
     """
     matches_stage = configure_matches_stage(**kwargs)
     if matches_stage:
@@ -171,16 +453,12 @@ def configure_aggregation(**kwargs):
     - `name`: 1 - this sorts alphabetically (set to -1 for reverse order)
     - `jina_version`: -1 - Sorted according to semver. This should always be latest first.
     - `version`: -1 - Sorted according to semver. This should also be latest first.
+    - Both versions are packed in `_sort_key` by `hubapi_push`, so one compact `(name, _sort_key)` index serves it
     """
     init_sort_stage = {
         '$sort': {
             'name': 1,
-            "_jina_version.major": -1,
-            "_jina_version.minor": -1,
-            "_jina_version.patch": -1,
-            "_version.major": -1,
-            "_version.minor": -1,
-            "_version.patch": -1
+            '_sort_key': -1
         }
     }
     aggregation_pipeline.append(init_sort_stage)
@@ -219,30 +497,16 @@ def configure_aggregation(**kwargs):
 
     """
     Stage 5:
-    - Pagination: Fetch images only after a certain image name
-    """
-    if 'after' in kwargs:
-        pagination_filter_stage = {
-            '$match': {
-                '_id.name': {
-                    '$gt': kwargs['after']
-                }
-            }
-        }
-        aggregation_pipeline.append(pagination_filter_stage)
-
-    """
-    Stage 6:
-    - Fetch n results at a time
+    - Fetch n results at a time (at most `MAX_PAGE_SIZE`), plus one to tell whether another page follows
     """
-    if 'n_per_page' in kwargs:
+    if paginate:
         limit_stage = {
-            '$limit': int(kwargs['n_per_page'])
+            '$limit': page_size(**kwargs) + 1
         }
         aggregation_pipeline.append(limit_stage)
 
     """
-    Stage 7:
+    Stage 6:
      - 1st element of the `images` list would be the latest executor
     """
     project_executors_stage = {
@@ -255,7 +519,7 @@ def configure_aggregation(**kwargs):
     aggregation_pipeline.append(project_executors_stage)
 
     """
-    # Stage 8:
+    # Stage 7:
     # - Finalize the set of arguments to be set
     """
     project_final_args_stage = {
@@ -284,32 +548,63 @@ def configure_aggregation(**kwargs):
     return aggregation_pipeline
 
 
-def _return_json_builder(body, status):
+# CORS headers of every response
+CORS_HEADERS = {
+    "Access-Control-Allow-Headers": "Content-Type, If-None-Match",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET",
+    "Access-Control-Expose-Headers": "ETag, X-Continuation-Token, X-Total-Count"
+}
+
+
+def _return_json_builder(body, status, headers=None, is_base64_encoded=False):
+    return json_response(body=body, status=status, headers={**CORS_HEADERS, **(headers or {})},
+                         is_base64_encoded=is_base64_encoded)
+
+
+def _timeout_response():
+    return _return_json_builder(body='Query took too long, please retry later', status=503,
+                                headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+def _cache_headers(hit: bool):
+    return {
+        "X-Cache": "Hit" if hit else "Miss",
+        "X-Cache-Hits": str(RESPONSE_CACHE.hits),
+        "X-Cache-Misses": str(RESPONSE_CACHE.misses)
+    }
+
+
+def _validator_headers(etag: str):
     return {
-        "isBase64Encoded": False,
-        "headers": {
-            "Access-Control-Allow-Headers": "Content-Type",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET",
-            "Content-Type": "application/json"
-        },
-        "statusCode": int(status),
-        "body": body
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={CACHE_CONTROL_MAX_AGE}"
     }
 
 
-def str_to_ascii_to_base64_to_str(text):
-    return base64.b64decode(text.encode('ascii')).decode('ascii')
+def _page_headers(continuation_token: Optional[str], total: Optional[int]):
+    headers = {}
+    if continuation_token:
+        headers["X-Continuation-Token"] = continuation_token
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+    return headers
 
 
-def read_environment():
-    hostname = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_HOSTNAME'))
-    username = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_USERNAME'))
-    password = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_PASSWORD'))
-    database_name = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_NAME'))
-    hubpod_collection = str_to_ascii_to_base64_to_str(os.environ.get('JINA_HUBPOD_COLLECTION'))
-    metadata_collection = str_to_ascii_to_base64_to_str(os.environ.get('JINA_METADATA_COLLECTION'))
-    return hostname, username, password, database_name, hubpod_collection, metadata_collection
+def _list_response(body, status, hit: bool, etag: str, page_headers: Dict, gzip_body: bool):
+    headers = _cache_headers(hit=hit)
+    headers.update(page_headers)
+    if int(status) == 200:
+        headers.update(_validator_headers(etag=etag))
+        if gzip_body:
+            # Only imported by the invocations that accept a compressed response
+            import gzip
+            compressed_body = base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('ascii')
+            if len(compressed_body) < len(body):
+                headers.update({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+                return _return_json_builder(body=compressed_body, status=status, headers=headers,
+                                            is_base64_encoded=True)
+    return _return_json_builder(body=body, status=status, headers=headers)
 
 
 def handle_query_strings(event):
@@ -323,6 +618,7 @@ def handle_query_strings(event):
     return query_string_params if query_string_params else {}
 
 
+@log_latency
 def lambda_handler(event, context):
     """Lambda handler to read data from Mongodb Atlas (Used to perform `jina hub list`)
     """
@@ -332,19 +628,95 @@ def lambda_handler(event, context):
         logger.error('MongoDB environment vars are not set! book-keeping skipped.')
         return _return_json_builder(body='Invalid Lambda environment',
                                     status=500)
+    if event.get('resource') == HISTORY_RESOURCE:
+        return history_handler(event=event, logger=logger)
+
     query_string_params = handle_query_strings(event)
+    if 'continuation_token' in query_string_params:
+        try:
+            query_string_params.update(decode_continuation_token(query_string_params.pop('continuation_token')))
+        except ValueError as exp:
+            logger.warning(f'{exp}')
+            return _return_json_builder(body='Invalid continuation token',
+                                        status=400)
+    try:
+        limit = page_size(**query_string_params)
+    except ValueError as exp:
+        logger.warning(f'{exp}')
+        return _return_json_builder(body='Invalid n-per-page',
+                                    status=400)
+    gzip_body = accepts_gzip(event)
     hostname, username, password, database_name, hubpod_collection, metadata_collection = read_environment()
 
     try:
+        # the generation & the page are read in one causally consistent session, so the page is never older than
+        # the generation it gets cached under, even when a more stale secondary serves it
         with MongoDBHandler(hostname=hostname, username=username, password=password,
-                            database_name=database_name, collection_name=hubpod_collection) as db:
-            cursor = db.aggregate(pipeline=configure_aggregation(**query_string_params))
-            current_images = list(cursor)
-            if current_images:
-                return _return_json_builder(body=json.dumps(current_images),
-                                            status=200)
-            return _return_json_builder(body="No docs found",
-                                        status=400)
-    except MongoDBException:
+                            database_name=database_name, **read_options(),
+                            collection_name=generation_collection_name(hubpod_collection)) as generation_db, \
+                generation_db.start_session() as session:
+            generation_doc = generation_db.find_one(query={'_id': CATALOGUE_GENERATION_ID}, session=session)
+            generation = generation_doc['generation'] if generation_doc else 0
+
+            key = cache_key(query_string_params)
+            etag = compute_etag(generation=generation, key=key)
+            if etag_matches(if_none_match=request_header(event, 'If-None-Match'), etag=etag):
+                return _return_json_builder(body='', status=304, headers=_validator_headers(etag=etag))
+
+            cached_response = RESPONSE_CACHE.get(key=key, generation=generation)
+            if cached_response:
+                body, status, page_headers = cached_response
+                return _list_response(body=body, status=status, hit=True, etag=etag,
+                                      page_headers=page_headers, gzip_body=gzip_body)
+
+            total = None
+            if use_latest_collection(**query_string_params):
+                with MongoDBHandler(hostname=hostname, username=username, password=password,
+                                    database_name=database_name, **read_options(),
+                                    collection_name=latest_collection_name(hubpod_collection)) as db:
+                    query, limit = configure_latest_query(**query_string_params)
+                    cursor = checked(db.find(query=query, projection={'_id': 0, '_search': 0, '_sort_key': 0},
+                                             limit=limit + 1, sort=[('_id', 1)], batch_size=CURSOR_BATCH_SIZE,
+                                             hint=latest_query_hint(**query_string_params),
+                                             session=session))
+                    body, count, last_name, truncated, has_more = encode_cursor(cursor, limit=limit,
+                                                                                max_bytes=MAX_PAYLOAD_BYTES)
+                    if with_total(**query_string_params):
+                        query.pop('_id', None)
+                        total = checked(db.count(query=query, session=session))
+            else:
+                with MongoDBHandler(hostname=hostname, username=username, password=password,
+                                    database_name=database_name, **read_options(),
+                                    collection_name=hubpod_collection) as db:
+                    hint = aggregation_hint(**query_string_params)
+                    cursor = checked(db.aggregate(pipeline=configure_aggregation(**query_string_params),
+                                                  batchSize=CURSOR_BATCH_SIZE, allowDiskUse=True, hint=hint,
+                                                  session=session))
+                    body, count, last_name, truncated, has_more = encode_cursor(cursor, limit=limit,
+                                                                                max_bytes=MAX_PAYLOAD_BYTES)
+                    if with_total(**query_string_params):
+                        count_pipeline = configure_count_aggregation(**query_string_params)
+                        total = next(checked(db.aggregate(pipeline=count_pipeline, allowDiskUse=True, hint=hint,
+                                                          session=session)), {}).get('total', 0)
+
+            continuation_token = None
+            if truncated:
+                logger.warning(f'Response truncated to {count} images after `{last_name}`')
+            if count and has_more:
+                continuation_token = encode_continuation_token(after=last_name)
+
+            status = 200
+            if not count:
+                body, status = "No docs found", 400
+            page_headers = _page_headers(continuation_token=continuation_token, total=total)
+            RESPONSE_CACHE.put(key=key, generation=generation, response=(body, status, page_headers))
+            return _list_response(body=body, status=status, hit=False, etag=etag,
+                                  page_headers=page_headers, gzip_body=gzip_body)
+    except (MongoDBTimeout, pymongo.errors.ExecutionTimeout) as exp:
+        logger.warning(f'Read went over its time budget {exp}')
+        return _timeout_response()
+    except (MongoDBException, pymongo.errors.PyMongoError) as exp:
+        # cursors raise `OperationFailure` & co while they get iterated, the handler only catches them on the call
+        logger.error(f'Couldn\'t read from the database {exp!r}')
         return _return_json_builder(body='Couldn\'t connect to the database',
                                     status=502)
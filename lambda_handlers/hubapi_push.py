@@ -1,141 +1,112 @@
 import os
+import re
 import json
+import time
 import base64
-import logging
-from typing import Optional, Dict, List, Union
+import hashlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Optional, Dict, List, Union, Tuple, NamedTuple
 
 import pymongo
+from bson import Binary, ObjectId
+from pymongo.write_concern import WriteConcern
 
+from hubdb import (MongoDBHandler, get_logger, is_db_envs_set, read_environment, search_fields, archive_collection_name,
+                   idempotency_collection_name, latest_collection_name, latest_update, bump_generation,
+                   tombstone_update, TOMBSTONE_FIELD, log_latency, json_response as _return_json_builder)
 
-def get_logger(context='generic', file=True):
-    logger = logging.getLogger(context)
-    logger.setLevel(logging.DEBUG)
-    return logger
+# Pushes are only acknowledged once a majority of the replica set has them, so they survive a failover
+WRITE_CONCERN = WriteConcern(w='majority', wtimeout=5000)
 
 
-class MongoDBException(Exception):
-    """ Any errors raised by MongoDb """
-
-
-class MongoDBHandler:
+def _handle_dot_in_keys(document: Union[Dict, List]) -> Union[Dict, List]:
     """
-    Mongodb Handler to connect to the database & insert documents in the collection
+    Copy of the json decoded document with the `.` in keys (rejected by MongoDB) replaced by `_`, at any depth
+    & in every list item. Walks the document once with an explicit stack, so deep manifests don't hit the
+    recursion limit. Containers are matched on their exact type, which is all `json.loads` returns
     """
-
-    def __init__(self, hostname: str, username: str, password: str,
-                 database_name: str, collection_name: str):
-        self.logger = get_logger(self.__class__.__name__)
-        self.hostname = hostname
-        self.username = username
-        self.password = password
-        self.database_name = database_name
-        self.collection_name = collection_name
-        self.connection_string = \
-            f'mongodb+srv://{self.username}:{self.password}@{self.hostname}'
-
-    def __enter__(self):
-        return self.connect()
-
-    def connect(self) -> 'MongoDBHandler':
-        try:
-            self.client = pymongo.MongoClient(self.connection_string)
-            self.client.admin.command('ismaster')
-            self.logger.info('Successfully connected to the database')
-        except pymongo.errors.ConnectionFailure:
-            raise MongoDBException('Database server is not available')
-        except pymongo.errors.ConfigurationError:
-            raise MongoDBException('Credentials passed are not correct!')
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
-        except Exception as exp:
-            raise MongoDBException(exp)
-        return self
+    sanitized = {} if type(document) is dict else [None] * len(document)
+    stack = [(document, sanitized)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        source, target = pop()
+        items = source.items() if type(source) is dict else enumerate(source)
+        rename = type(source) is dict
+        for key, value in items:
+            kind = type(value)
+            if kind is dict:
+                value_copy = {}
+                push((value, value_copy))
+                value = value_copy
+            elif kind is list:
+                value_copy = [None] * len(value)
+                push((value, value_copy))
+                value = value_copy
+            target[key.replace('.', '_') if rename and '.' in key else key] = value
+    return sanitized
+
+
+# `major.minor.patch` with optional `-pre.release` & `+build` suffixes (https://semver.org), a leading `v` is allowed
+SEMVER_PATTERN = re.compile(r'^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+([0-9A-Za-z.-]+))?$')
+
+# Rank of the usual pre-release tags, unknown tags sort before all of them. Releases sort after every pre-release
+PRERELEASE_TAGS = {'dev': 1, 'a': 2, 'alpha': 2, 'b': 3, 'beta': 3, 'pre': 4, 'rc': 4}
+PRERELEASE_NUMBER = re.compile(r'^([A-Za-z]*)[.-]?(\d*)')
+
+# Bits of each part in `Semver.sort_key`, major gets one bit less so the key stays a positive signed int64
+SORT_KEY_BITS = (15, 16, 16, 16)
+RELEASE_RANK = (1 << SORT_KEY_BITS[3]) - 1
+
+
+class Semver(NamedTuple):
+    major: int
+    minor: int
+    patch: int
+    prerelease: Optional[str] = None
+    build: Optional[str] = None
 
     @property
-    def database(self):
-        return self.client[self.database_name]
+    def prerelease_rank(self) -> int:
+        """ 16 bit rank: tag rank in the upper 4 bits, its number (e.g. `rc.2` -> 2) in the lower 12 """
+        if self.prerelease is None:
+            return RELEASE_RANK
+        tag, number = PRERELEASE_NUMBER.match(self.prerelease).groups()
+        return (PRERELEASE_TAGS.get(tag.lower(), 0) << 12) | min(int(number or 0), (1 << 12) - 1)
 
     @property
-    def collection(self):
-        return self.database[self.collection_name]
-
-    def find_one(self, query: Dict[str, Union[Dict, List]]) -> None:
-        try:
-            return self.collection.find_one(query)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while finding a document in the db {exp}')
-
-    def find(self,
-             query: Dict[str, Union[Dict, List]],
-             projection: Dict[str, Union[Dict, List]],
-             limit: int = 0) -> None:
-        try:
-            return self.collection.find(filter=query, projection=projection, limit=limit)
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while finding a document in the db {exp}')
-
-    def insert(self, document: str) -> Optional[str]:
-        try:
-            result = self.collection.insert_one(document)
-            self.logger.info(f'Pushed current summary to the database')
-            return result.inserted_id
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while inserting a document in the db {exp}')
-
-    def replace(self, document: Dict, query: Dict):
-        try:
-            result = self.collection.replace_one(query, document)
-            return result.modified_count
-        except pymongo.errors.PyMongoError as exp:
-            self.logger.error(f'got an error while replacing a document in the db {exp}')
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            self.client.close()
-        except pymongo.errors.PyMongoError as exp:
-            raise MongoDBException(exp)
-
-
-def is_db_envs_set():
-    """ Checks if any of the db env variables are not set """
-    keys = ['JINA_DB_HOSTNAME', 'JINA_DB_USERNAME', 'JINA_DB_PASSWORD', 'JINA_DB_NAME', 'JINA_HUBPOD_COLLECTION', 'JINA_METADATA_COLLECTION']
-    return all(len(os.environ.get(k, '')) > 0 for k in keys)
-
-
-def _handle_dot_in_keys(document: Dict[str, Union[Dict, List]]) -> Union[Dict, List]:
-    updated_document = {}
-    for key, value in document.items():
-        if isinstance(value, dict):
-            value = _handle_dot_in_keys(value)
-        if isinstance(value, list) and len(value) > 0 and isinstance(value[0], dict):
-            value[0] = _handle_dot_in_keys(value[0])
-        updated_document[key.replace('.', '_')] = value
-    return updated_document
-
-
-def _return_json_builder(body, status):
-    return {
-        "isBase64Encoded": False,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "statusCode": int(status),
-        "body": body
-    }
-
-
-def str_to_ascii_to_base64_to_str(text):
-    return base64.b64decode(text.encode('ascii')).decode('ascii')
+    def sort_key(self) -> int:
+        """
+        Major, minor, patch & pre-release rank packed in one integer, comparing like the versions do.
+        Parts too big for their bits are clamped, which keeps the order (ties aside)
+        """
+        key = 0
+        for part, bits in zip((self.major, self.minor, self.patch, self.prerelease_rank), SORT_KEY_BITS):
+            key = (key << bits) | min(part, (1 << bits) - 1)
+        return key
+
+    def fields(self) -> Dict:
+        """ Integer fields stored as `_version` & `_jina_version`, for sorting on semver """
+        return {'major': self.major, 'minor': self.minor, 'patch': self.patch}
+
+
+def version_sort_key(jina_version: str, version: str) -> Binary:
+    """
+    `_sort_key` of a hubpod document: the sort keys of `jina_version` & `version`, 8 bytes each, big endian.
+    MongoDB compares binaries of the same length byte by byte, so a single field (& index) sorts like the semver
+    of both versions, `jina_version` first
+    """
+    return Binary(parse_semver(jina_version).sort_key.to_bytes(8, 'big') +
+                  parse_semver(version).sort_key.to_bytes(8, 'big'))
 
 
-def read_environment():
-    hostname = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_HOSTNAME'))
-    username = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_USERNAME'))
-    password = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_PASSWORD'))
-    database_name = str_to_ascii_to_base64_to_str(os.environ.get('JINA_DB_NAME'))
-    hubpod_collection = str_to_ascii_to_base64_to_str(os.environ.get('JINA_HUBPOD_COLLECTION'))
-    metadata_collection = str_to_ascii_to_base64_to_str(os.environ.get('JINA_METADATA_COLLECTION'))
-    return hostname, username, password, database_name, hubpod_collection, metadata_collection
+@lru_cache(maxsize=4096)
+def parse_semver(version: str) -> Semver:
+    match = SEMVER_PATTERN.match(version.strip())
+    if match is None:
+        raise ValueError(f'`{version}` is not a semantic version')
+    major, minor, patch, prerelease, build = match.groups()
+    return Semver(int(major), int(minor), int(patch), prerelease, build)
 
 
 def parse_summary(summary, logger):
@@ -155,16 +126,16 @@ def parse_summary(summary, logger):
     _hubpod_summary['version'] = _build_summary['version']
     _hubpod_summary['jina_version'] = _build_summary['jina_version']
     _hubpod_summary['manifest_info'] = _build_summary['manifest_info']
+    _hubpod_summary['_search'] = search_fields(_build_summary['name'],
+                                               _build_summary['manifest_info'].get('name'))
 
     # For sorting on semver, store `major`, `minor`, `patch` as integers
-    _version_major, _version_minor, _version_patch = _build_summary['version'].split('.')
-    _hubpod_summary['_version'] = {'major': int(_version_major),
-                                   'minor': int(_version_minor),
-                                   'patch': int(_version_patch)}
-    _jina_version_major, _jina_version_minor, _jina_version_patch = _build_summary['jina_version'].split('.')
-    _hubpod_summary['_jina_version'] = {'major': int(_jina_version_major),
-                                        'minor': int(_jina_version_minor),
-                                        'patch': int(_jina_version_patch)}
+    _hubpod_summary['_version'] = parse_semver(_build_summary['version']).fields()
+    _hubpod_summary['_jina_version'] = parse_semver(_build_summary['jina_version']).fields()
+    _hubpod_summary['_sort_key'] = version_sort_key(jina_version=_build_summary['jina_version'],
+                                                    version=_build_summary['version'])
+    # Pushing a soft deleted build again brings it back
+    _hubpod_summary[TOMBSTONE_FIELD] = False
 
     # hubpod only has `name`, `version`, `jina_version`, `details`, `build_history`, `is_build_success`
     _metadata_summary = {}
@@ -178,6 +149,439 @@ def parse_summary(summary, logger):
     return _build_query, _hubpod_summary, _metadata_summary
 
 
+# Upper bound on the summaries accepted in one batch push
+MAX_BATCH_SIZE = 100
+
+
+class PushStatus:
+    CREATED = 'created'
+    UPDATED = 'updated'
+    INVALID = 'invalid'
+    FAILED = 'failed'
+
+
+# Fields of the build key, these never change once a document exists
+BUILD_KEY_FIELDS = ['name', 'version', 'jina_version']
+
+# Latest builds kept inline in the metadata document. The archive collection holds every build (these included),
+# so the history endpoint reads it alone, while readers of the metadata document get the latest builds with it
+BUILD_HISTORY_INLINE = 50
+
+# Builds per document in the archive collection
+BUILD_HISTORY_BUCKET_SIZE = 100
+
+
+def metadata_update(metadata_document: Dict) -> Dict:
+    """
+    Upsert of a metadata document that appends to (instead of reading & rewriting) the existing `build_history`,
+    keeping only the latest `BUILD_HISTORY_INLINE` builds
+    """
+    # Pushing a soft deleted build again brings it back
+    restore = tombstone_update(deleted=False)
+    return {
+        '$setOnInsert': {key: metadata_document[key] for key in BUILD_KEY_FIELDS},
+        '$set': dict(restore['$set'], **{key: value for key, value in metadata_document.items()
+                                         if key not in BUILD_KEY_FIELDS and key != 'build_history'}),
+        '$unset': restore['$unset'],
+        '$push': {'build_history': {'$each': metadata_document['build_history'],
+                                    '$slice': -BUILD_HISTORY_INLINE}},
+        '$inc': {'build_count': len(metadata_document['build_history'])}
+    }
+
+
+def archive_requests(build_query: Dict, build_history: List) -> List[pymongo.UpdateOne]:
+    """
+    Upserts appending builds to the archive (bucket pattern), one build each: a build goes into the open bucket
+    of the build key (the one holding less than `BUILD_HISTORY_BUCKET_SIZE` builds), or creates the next one.
+    Adding a single build at a time never overflows a bucket & keeps one open bucket, so the buckets hold the builds
+    in order. Send them in order, one after the other (see `archive_in_rounds`)
+    """
+    archive_filter = dict(build_query, count={'$lt': BUILD_HISTORY_BUCKET_SIZE})
+    return [pymongo.UpdateOne(archive_filter, {
+        # ObjectIds are unique & increase with time, so the buckets of a build key can be paged in order
+        '$setOnInsert': {'bucket': ObjectId()},
+        '$push': {'entries': build},
+        '$inc': {'count': 1}
+    }, upsert=True) for build in build_history]
+
+
+QUOTA_COLLECTION_SUFFIX = '_quota'
+
+# Images a GitHub user may push per (UTC) day, unless `JINA_PUSH_DAILY_QUOTA` says otherwise
+DEFAULT_DAILY_PUSH_QUOTA = 500
+
+
+def quota_collection_name(metadata_collection: str) -> str:
+    return f'{metadata_collection}{QUOTA_COLLECTION_SUFFIX}'
+
+
+def daily_push_quota() -> int:
+    return int(os.environ.get('JINA_PUSH_DAILY_QUOTA') or DEFAULT_DAILY_PUSH_QUOTA)
+
+
+def push_identity(event) -> Optional[Dict]:
+    """ GitHub identity of the pusher, set in the request context by `hubapi_authorizer` """
+    authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+    if not authorizer.get('github_id'):
+        return None
+    return {'login': authorizer.get('github_login'), 'id': authorizer['github_id']}
+
+
+def consume_push_quota(identity: Dict, pushes: int, db_params: Dict, metadata_collection: str,
+                       logger) -> Optional[int]:
+    """
+    Counts `pushes` against the daily quota of the user, in one atomic round trip: an update pipeline only adds them
+    if they fit in the quota, so rejected pushes don't use it up.
+    Returns the seconds until the quota resets if it is exceeded, `None` otherwise (also when it can't be read)
+    """
+    quota = daily_push_quota()
+    now = datetime.utcnow()
+    tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+    pushed = {'$ifNull': ['$pushes', 0]}
+    accepted = {'$lte': [{'$add': [pushed, pushes]}, quota]}
+    with MongoDBHandler(**db_params, collection_name=quota_collection_name(metadata_collection)) as db:
+        counter = db.find_one_and_update(query={'_id': f'{identity["id"]}|{now.date().isoformat()}'}, update=[
+            {'$set': {'accepted': accepted,
+                      'pushes': {'$cond': [accepted, {'$add': [pushed, pushes]}, pushed]},
+                      'login': {'$ifNull': ['$login', identity['login']]},
+                      'expires_at': {'$ifNull': ['$expires_at', tomorrow]}}}
+        ], upsert=True)
+    if counter is None:
+        logger.warning(f'Couldn\'t count the pushes of `{identity["login"]}`, skipping the quota')
+        return None
+    if not counter['accepted']:
+        logger.warning(f'`{identity["login"]}` would exceed the daily quota with {pushes} more pushes, '
+                       f'{counter["pushes"]} so far')
+        return int((tomorrow - now).total_seconds()) + 1
+    return None
+
+
+RATE_LIMIT_COLLECTION_SUFFIX = '_rate_limit'
+
+# Token bucket per authorizer principal: `JINA_PUSH_BURST` pushes at once, refilled at `JINA_PUSH_RATE_PER_MINUTE`
+DEFAULT_PUSH_BURST = 10
+DEFAULT_PUSH_RATE_PER_MINUTE = 30
+
+def rate_limit_collection_name(metadata_collection: str) -> str:
+    return f'{metadata_collection}{RATE_LIMIT_COLLECTION_SUFFIX}'
+
+
+def push_rate_limit() -> Tuple[float, float]:
+    """ Capacity & refill rate (tokens per second) of the token bucket """
+    burst = float(os.environ.get('JINA_PUSH_BURST') or DEFAULT_PUSH_BURST)
+    rate_per_minute = float(os.environ.get('JINA_PUSH_RATE_PER_MINUTE') or DEFAULT_PUSH_RATE_PER_MINUTE)
+    return burst, rate_per_minute / 60
+
+
+def push_principal(event) -> Optional[str]:
+    """ Principal returned by `hubapi_authorizer`, `None` for anonymous pushes (with the push key) """
+    authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+    principal = authorizer.get('principalId')
+    return principal if principal and principal != 'anonymous' else None
+
+
+def take_push_token(principal: str, db_params: Dict, metadata_collection: str, logger) -> Optional[int]:
+    """
+    Takes a token from the bucket of the principal, in one atomic round trip: an update pipeline refills the bucket
+    lazily from the elapsed time & takes a token only if a whole one is left, so concurrent Lambdas can't both spend
+    the same token. Returns the seconds until a token is available if the bucket is empty, `None` otherwise (also
+    when the bucket can't be read, like the daily quota)
+    """
+    capacity, rate = push_rate_limit()
+    now = time.time()
+    elapsed = {'$max': [{'$subtract': [now, {'$ifNull': ['$updated_at', now]}]}, 0]}
+    with MongoDBHandler(**db_params, collection_name=rate_limit_collection_name(metadata_collection)) as db:
+        bucket = db.find_one_and_update(query={'_id': principal}, update=[
+            {'$set': {'tokens': {'$min': [capacity, {'$add': [{'$ifNull': ['$tokens', capacity]},
+                                                              {'$multiply': [elapsed, rate]}]}]}}},
+            {'$set': {'taken': {'$gte': ['$tokens', 1]},
+                      'tokens': {'$cond': [{'$gte': ['$tokens', 1]}, {'$subtract': ['$tokens', 1]}, '$tokens']},
+                      'updated_at': now,
+                      # the bucket is full again after `capacity / rate` seconds, there's no point in keeping it longer
+                      'expires_at': datetime.utcfromtimestamp(now + capacity / rate)}}
+        ], upsert=True)
+    if bucket is None:
+        logger.warning(f'Couldn\'t take a push token for `{principal}`, skipping the rate limit')
+        return None
+    if not bucket['taken']:
+        logger.warning(f'`{principal}` is over the push rate limit')
+        return int((1 - bucket['tokens']) / rate) + 1
+    return None
+
+
+# A push with the same summary & principal within this many seconds gets the response of the first one
+DEFAULT_IDEMPOTENCY_WINDOW_SECONDS = 600
+
+
+def idempotency_key(summary: Union[Dict, List], principal: Optional[str]) -> str:
+    """ Hash of the build summary as canonical json, so retries with reordered keys map to the same push """
+    canonical = json.dumps([principal, summary], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def pushed_names(summary: Union[Dict, List]) -> List[str]:
+    """ Executor names in the summary (or batch), `hubdb.forget_pushes` drops their responses on deletes """
+    summaries = summary if isinstance(summary, list) else [summary]
+    return sorted({item['name'] for item in summaries if isinstance(item, dict) and isinstance(item.get('name'), str)})
+
+
+# Seconds a pending push holds its idempotency key, longer than the Lambda timeout so that it only lapses for
+# invocations that died before releasing it
+IDEMPOTENCY_LEASE_SECONDS = 60
+
+# Attempts at reserving an idempotency key whose previous holder lapsed
+RESERVE_ATTEMPTS = 3
+
+
+def _replay(previous: Dict) -> Dict:
+    return _return_json_builder(body=previous['body'], status=previous['status'],
+                                headers={'Idempotent-Replayed': 'true'})
+
+
+def reserve_push(key: str, names: List[str], db_params: Dict, metadata_collection: str, logger) -> Optional[Dict]:
+    """
+    Reserves the idempotency key for this push by inserting a pending document on it (`_id` is unique, so only one
+    of concurrent identical pushes gets it). Returns `None` once reserved, otherwise the response of the push holding
+    the key: its response replayed if it's done, 409 while it's in progress. Expired documents (not yet removed by
+    the TTL index) are taken over with a compare-and-set on `expires_at`. The document keeps the executor `names`
+    of the push, deleting their builds drops it
+    """
+    with MongoDBHandler(**db_params, collection_name=idempotency_collection_name(metadata_collection)) as db:
+        for _ in range(RESERVE_ATTEMPTS):
+            pending = {'pending': True, 'names': names,
+                       'expires_at': datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+            if db.insert({'_id': key, **pending}) is not None:
+                return None
+            previous = db.find_one({'_id': key})
+            if previous is None:
+                continue
+            if previous['expires_at'] <= datetime.utcnow():
+                if db.update(query={'_id': key, 'expires_at': previous['expires_at']},
+                             update={'$set': pending, '$unset': {'status': '', 'body': ''}}) == 1:
+                    return None
+                continue
+            if previous.get('pending'):
+                logger.info('An identical push is in progress')
+                return _return_json_builder(body='An identical push is in progress, retry later',
+                                            status=409, headers={'Retry-After': str(IDEMPOTENCY_LEASE_SECONDS)})
+            logger.info('Replaying the response of an identical push within the idempotency window')
+            return _replay(previous)
+    logger.warning(f'Couldn\'t reserve the idempotency key in {RESERVE_ATTEMPTS} attempts')
+    return _return_json_builder(body='Couldn\'t connect to the database', status=502)
+
+
+def should_retry(response: Optional[Dict]) -> bool:
+    """ Failed (5xx or no response) & throttled (429) pushes, & batches with a failed summary (207) """
+    if response is None or response['statusCode'] >= 500 or response['statusCode'] == 429:
+        return True
+    return response['statusCode'] == 207 and \
+        any(status['status'] == PushStatus.FAILED for status in json.loads(response['body']))
+
+
+def remember_push(key: str, response: Optional[Dict], db_params: Dict, metadata_collection: str):
+    """
+    Keeps the response of a push for the idempotency window. Pushes that `should_retry` release the key instead,
+    for the retries to go through
+    """
+    with MongoDBHandler(**db_params, collection_name=idempotency_collection_name(metadata_collection)) as db:
+        if should_retry(response):
+            db.delete({'_id': key, 'pending': True})
+            return
+        window = int(os.environ.get('JINA_PUSH_IDEMPOTENCY_SECONDS') or DEFAULT_IDEMPOTENCY_WINDOW_SECONDS)
+        db.update(query={'_id': key},
+                  update={'$set': {'status': response['statusCode'], 'body': response['body'],
+                                   'expires_at': datetime.utcnow() + timedelta(seconds=window)},
+                          '$unset': {'pending': ''}},
+                  upsert=True)
+
+
+def use_transaction() -> bool:
+    """ Writing both collections in one transaction needs a replica set (like Atlas), so it's opt-in """
+    return os.environ.get('JINA_PUSH_TRANSACTION', '').lower() == 'true'
+
+
+def write_build(database, session, hubpod_collection: str, metadata_collection: str,
+                build_query: Dict, hubpod_document: Dict, metadata_document: Dict) -> bool:
+    """
+    Upserts the hubpod & metadata documents of a build, appends its history to the archive & promotes it in the
+    latest collection (if it's the executor's most recent image), one round trip each. Returns if it was a new build
+    """
+    hubpod_result = database[hubpod_collection].replace_one(build_query, hubpod_document,
+                                                            upsert=True, session=session)
+    database[metadata_collection].update_one(build_query, metadata_update(metadata_document),
+                                             upsert=True, session=session)
+    requests = archive_requests(build_query, metadata_document['build_history'])
+    if requests:
+        database[archive_collection_name(metadata_collection)].bulk_write(requests, ordered=True, session=session)
+    database[latest_collection_name(hubpod_collection)].bulk_write([latest_update(hubpod_document)], session=session)
+    return hubpod_result.upserted_id is not None
+
+
+def parse_batch(summaries: List, logger, identity: Optional[Dict] = None) -> Tuple[List[Dict], List[Tuple]]:
+    """
+    Validates every summary of a batch. Returns the status of every summary, in the order they were passed (only
+    the invalid ones have one yet), & the parsed valid ones with their index
+    """
+    statuses = []
+    parsed = []
+    for index, summary in enumerate(summaries):
+        try:
+            build_query, hubpod_document, metadata_document = parse_summary(summary=summary, logger=logger)
+        except (KeyError, ValueError, TypeError, AttributeError) as exp:
+            logger.warning(f'Invalid summary at index {index} in the batch {exp!r}')
+            statuses.append({'status': PushStatus.INVALID, 'error': repr(exp)})
+            continue
+        if identity:
+            metadata_document['pushed_by'] = identity
+        statuses.append(dict(build_query))
+        parsed.append((index, build_query, hubpod_document, metadata_document))
+    return statuses, parsed
+
+
+def archive_in_rounds(db: MongoDBHandler, builds: List[Tuple[int, Dict, List]]) -> Dict[int, str]:
+    """
+    Appends the `build_history` of every `(position, build_query, build_history)` to the archive. A build key
+    takes its builds one at a time & in order (see `archive_requests`), so every round sends the next build of each
+    build key in one unordered bulk write: a failed request only holds back the later builds of its own build key.
+    Pushes usually carry a single build, i.e. one round. Returns the error per position
+    """
+    queues = {}
+    for position, build_query, build_history in builds:
+        queue = queues.setdefault(tuple(build_query[key] for key in BUILD_KEY_FIELDS), [])
+        queue.extend((position, request) for request in archive_requests(build_query, build_history))
+    errors = {}
+    while queues:
+        batch = [(key, *queue.pop(0)) for key, queue in queues.items()]
+        for index, error in db.bulk_write([request for _, _, request in batch])['errors'].items():
+            key, position, _ = batch[index]
+            errors.setdefault(position, error)
+            errors.update({later: 'Not written after an earlier error'
+                           for later, _ in queues[key] if later not in errors})
+            queues[key] = []
+        queues = {key: queue for key, queue in queues.items() if queue}
+    return errors
+
+
+def push_batch(statuses: List[Dict], parsed: List[Tuple], db_params: Dict, hubpod_collection: str,
+               metadata_collection: str, logger):
+    """
+    Writes the summaries validated by `parse_batch` with a single unordered bulk write per collection. Each write
+    only covers the summaries every earlier write succeeded for, & only fully written summaries are promoted in the
+    latest collection. Returns the status of every summary, in the order they were passed
+    """
+    if parsed:
+        logger.info(f'pushing hubpod data for {len(parsed)} images!')
+        with MongoDBHandler(**db_params, collection_name=hubpod_collection) as db:
+            hubpod_result = db.bulk_write([pymongo.ReplaceOne(build_query, hubpod_document, upsert=True)
+                                           for _, build_query, hubpod_document, _ in parsed])
+        errors = dict(hubpod_result['errors'])
+
+        written = [position for position in range(len(parsed)) if position not in errors]
+        if written:
+            logger.info(f'pushing metadata for {len(written)} images!')
+            with MongoDBHandler(**db_params, collection_name=metadata_collection) as db:
+                metadata_result = db.bulk_write([pymongo.UpdateOne(parsed[position][1],
+                                                                   metadata_update(parsed[position][3]), upsert=True)
+                                                 for position in written])
+            errors.update({written[index]: error for index, error in metadata_result['errors'].items()})
+
+        written = [position for position in written if position not in errors]
+        if written:
+            logger.info(f'archiving build history for {len(written)} images!')
+            with MongoDBHandler(**db_params, collection_name=archive_collection_name(metadata_collection)) as db:
+                errors.update(archive_in_rounds(db, [(position, parsed[position][1],
+                                                      parsed[position][3]['build_history'])
+                                                     for position in written]))
+
+        for position, (index, _, _, _) in enumerate(parsed):
+            if position in errors:
+                statuses[index].update({'status': PushStatus.FAILED, 'error': errors[position]})
+            elif position in hubpod_result['upserted']:
+                statuses[index]['status'] = PushStatus.CREATED
+            else:
+                statuses[index]['status'] = PushStatus.UPDATED
+
+        pushed = [parsed[position][2] for position in written if position not in errors]
+        if pushed:
+            logger.info(f'promoting {len(pushed)} images in the latest collection!')
+            with MongoDBHandler(**db_params, collection_name=latest_collection_name(hubpod_collection)) as db:
+                db.bulk_write([latest_update(hubpod_document) for hubpod_document in pushed])
+            bump_generation(db_params=db_params, hubpod_collection=hubpod_collection)
+
+    all_pushed = all(status['status'] in [PushStatus.CREATED, PushStatus.UPDATED] for status in statuses)
+    return _return_json_builder(body=json.dumps(statuses),
+                                status=200 if all_pushed else 207)
+
+
+def push_summary(build_query: Dict, hubpod_document: Dict, metadata_document: Dict, db_params: Dict,
+                 hubpod_collection: str, metadata_collection: str, logger):
+    logger.info(f'pushing hubpod data & metadata!')
+    try:
+        with MongoDBHandler(**db_params, collection_name=hubpod_collection) as db:
+            write_kwargs = dict(database=db.database, hubpod_collection=hubpod_collection,
+                                metadata_collection=metadata_collection, build_query=build_query,
+                                hubpod_document=hubpod_document, metadata_document=metadata_document)
+            if use_transaction():
+                with db.client.start_session() as session:
+                    created = session.with_transaction(lambda s: write_build(session=s, **write_kwargs))
+            else:
+                created = write_build(session=None, **write_kwargs)
+    except pymongo.errors.PyMongoError as exp:
+        # Without a transaction the writes before the failed one stay, in the order of `write_build`: the hubpod
+        # document, the metadata, the archive. The build only gets promoted in the latest collection last
+        logger.error(f'Couldn\'t write the build {exp!r}')
+        return _return_json_builder(body='Couldn\'t write the build, it may be partly written. Please retry',
+                                    status=502)
+
+    bump_generation(db_params=db_params, hubpod_collection=hubpod_collection)
+
+    if created:
+        logger.info(f'Inserted the hubpod & metadata documents in db')
+        return _return_json_builder(body='Created new doc in MongoDB',
+                                    status=200)
+    logger.info(f'Updated the hubpod & metadata documents in db')
+    return _return_json_builder(body='Updated existing doc in MongoDB',
+                                status=200)
+
+
+def push_within_limits(event, summary: Union[Dict, List], principal: Optional[str], db_params: Dict,
+                       hubpod_collection: str, metadata_collection: str, logger) -> Dict:
+    """ Pushes the summary (or batch) unless the principal is over its rate limit or the user over its daily quota """
+    if principal:
+        retry_after = take_push_token(principal=principal, db_params=db_params,
+                                      metadata_collection=metadata_collection, logger=logger)
+        if retry_after is not None:
+            return _return_json_builder(body='Too many pushes, slow down',
+                                        status=429, headers={'Retry-After': str(retry_after)})
+
+    identity = push_identity(event)
+    if isinstance(summary, list):
+        statuses, parsed = parse_batch(summaries=summary, logger=logger, identity=identity)
+        pushes = len(parsed)
+    else:
+        # an invalid summary raises, like it always did
+        build_query, hubpod_document, metadata_document = parse_summary(summary=summary, logger=logger)
+        if identity:
+            metadata_document['pushed_by'] = identity
+        pushes = 1
+
+    # only the valid summaries count against the quota
+    if identity and pushes:
+        retry_after = consume_push_quota(identity=identity, pushes=pushes, db_params=db_params,
+                                         metadata_collection=metadata_collection, logger=logger)
+        if retry_after is not None:
+            return _return_json_builder(body=f'Daily quota of {daily_push_quota()} pushes exceeded',
+                                        status=429, headers={'Retry-After': str(retry_after)})
+
+    if isinstance(summary, list):
+        return push_batch(statuses=statuses, parsed=parsed, db_params=db_params, hubpod_collection=hubpod_collection,
+                          metadata_collection=metadata_collection, logger=logger)
+    return push_summary(build_query=build_query, hubpod_document=hubpod_document, metadata_document=metadata_document,
+                        db_params=db_params, hubpod_collection=hubpod_collection,
+                        metadata_collection=metadata_collection, logger=logger)
+
+
+@log_latency
 def lambda_handler(event, context):
     """Lambda handler to write data into Mongodb Atlas (Used to perform `jina hub push`)
     """
@@ -194,50 +598,33 @@ def lambda_handler(event, context):
             return _return_json_builder(body='Invalid body passed in event',
                                         status=500)
 
-        summary = json.loads(event['body'])
-        build_query, hubpod_document, metadata_document = parse_summary(summary=summary, logger=logger)
-
+        # API Gateway passes the body base64 encoded for binary media types
+        body = base64.b64decode(event['body']) if event.get('isBase64Encoded') is True else event['body']
+        summary = json.loads(body)
         hostname, username, password, database_name, hubpod_collection, metadata_collection = read_environment()
-
-        updated = False
-        replaced = False
-
-
-        logger.info(f'pushing hubpod data!')
-        with MongoDBHandler(hostname=hostname, username=username, password=password,
-                            database_name=database_name, collection_name=hubpod_collection) as db:
-            existing_doc = db.find_one(query=build_query)
-            if existing_doc:
-                _modified_count = db.replace(document=hubpod_document, query=build_query)
-                logger.info(f'Updated the hubpod document in db. {_modified_count} documents modified')
-                updated = True
-            else:
-                _inserted_id = db.insert(document=hubpod_document)
-                logger.info(f'Inserted the hubpod in db with id {_inserted_id}')
-                replaced = True
-
-
-        logger.info(f'pushing metadata!')
-        current_build_history = metadata_document['build_history']
-        with MongoDBHandler(hostname=hostname, username=username, password=password,
-                            database_name=database_name, collection_name=metadata_collection) as db:
-            existing_doc = db.find_one(query=build_query)
-            if existing_doc:
-                metadata_document['build_history'] = existing_doc['build_history'] + current_build_history
-                _modified_count = db.replace(document=metadata_document, query=build_query)
-                logger.info(f'Updated the metadata document in db. {_modified_count} documents modified')
-                updated = True
-            else:
-                _inserted_id = db.insert(document=metadata_document)
-                logger.info(f'Inserted the metadata document in db with id {_inserted_id}')
-                replaced = True
-
-        if updated:
-            return _return_json_builder(body='Updated existing doc in MongoDB',
-                                        status=200)
-        if replaced:
-            return _return_json_builder(body='Created new doc in MongoDB',
-                                        status=200)
+        db_params = {'hostname': hostname, 'username': username, 'password': password,
+                     'database_name': database_name, 'write_concern': WRITE_CONCERN}
+
+        if isinstance(summary, list) and (not summary or len(summary) > MAX_BATCH_SIZE):
+            logger.warning(f'Got a batch of {len(summary)} summaries! bookkeeping skipped.')
+            return _return_json_builder(body=f'Batch should have 1 to {MAX_BATCH_SIZE} summaries',
+                                        status=400)
+
+        principal = push_principal(event)
+        key = idempotency_key(summary=summary, principal=principal)
+        reserved = reserve_push(key=key, names=pushed_names(summary), db_params=db_params,
+                                metadata_collection=metadata_collection, logger=logger)
+        if reserved is not None:
+            return reserved
+
+        response = None
+        try:
+            response = push_within_limits(event=event, summary=summary, principal=principal, db_params=db_params,
+                                          hubpod_collection=hubpod_collection,
+                                          metadata_collection=metadata_collection, logger=logger)
+        finally:
+            remember_push(key=key, response=response, db_params=db_params, metadata_collection=metadata_collection)
+        return response
 
     except KeyError as exp:
         logger.error(f'Got following keyerror during `hub_push` {exp!r}')
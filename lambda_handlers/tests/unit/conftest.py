@@ -0,0 +1,50 @@
+import base64
+import contextlib
+
+import mongomock
+import pymongo
+import pytest
+
+import hubdb
+
+from ... import hubapi_list
+
+
+def _encode(text):
+    return base64.b64encode(text.encode('ascii')).decode('ascii')
+
+
+@pytest.fixture
+def mongo_env(monkeypatch):
+    envs = {
+        'JINA_DB_HOSTNAME': 'TestingHost',
+        'JINA_DB_USERNAME': 'TestingUser',
+        'JINA_DB_PASSWORD': 'TestingPassword',
+        'JINA_DB_NAME': 'TestingName',
+        'JINA_HUBPOD_COLLECTION': 'hubpod',
+        'JINA_METADATA_COLLECTION': 'metadata'
+    }
+    for key, value in envs.items():
+        monkeypatch.setenv(key, _encode(value))
+    hubdb.reset_environment()
+    yield envs
+    hubdb.reset_environment()
+
+
+@pytest.fixture
+def mongomock_client(monkeypatch):
+    """ Single in-memory mongo client handed out for every `pymongo.MongoClient(...)` call """
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongomock.database.Database, 'command', lambda *args, **kwargs: {'ok': 1},
+                        raising=False)
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda *args, **kwargs: client)
+    # mongomock has no sessions, its single in-memory server is causally consistent anyway
+    monkeypatch.setattr(client, 'start_session', lambda *args, **kwargs: contextlib.nullcontext(), raising=False)
+    return client
+
+
+@pytest.fixture
+def hub_db(mongo_env, mongomock_client, monkeypatch):
+    monkeypatch.setattr(hubdb.MongoClientRegistry, '_clients', {})
+    monkeypatch.setattr(hubapi_list, 'RESPONSE_CACHE', hubapi_list.ResponseCache(max_size=2, ttl=60))
+    return mongomock_client[mongo_env['JINA_DB_NAME']]
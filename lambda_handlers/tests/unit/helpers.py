@@ -0,0 +1,29 @@
+import json
+
+from ... import hubapi_list
+from ... import hubapi_push
+
+
+def build_summary(name='jinahub/pod.encoder.dummyencoder', version='0.0.1', jina_version='1.0.0', manifest=None):
+    manifest_info = {'name': 'DummyEncoder', 'kind': 'encoder', 'type': 'pod', 'keywords': ['numeric'],
+                     'description': 'dummy'}
+    manifest_info.update(manifest or {})
+    return {
+        'name': name,
+        'version': version,
+        'jina_version': jina_version,
+        'manifest_info': manifest_info,
+        'details': {},
+        'is_build_success': True,
+        'build_history': {'time': '2020-10-22'}
+    }
+
+
+def push(summary):
+    return hubapi_push.lambda_handler({'body': json.dumps(summary)}, None)
+
+
+def list_images(headers=None, **params):
+    event = {'queryStringParameters': params or None, 'multiValueQueryStringParameters': None,
+             'headers': headers}
+    return hubapi_list.lambda_handler(event, None)
@@ -1,11 +1,19 @@
 import os
+import sys
 
 import json
+import base64
 import logging
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import pytest
 
+from ... import docker_auth
 from ...docker_auth import lambda_handler
-from jina.helper import yaml
 
 def get_logger(context='generic', file=True):
     logger = logging.getLogger(context)
@@ -13,13 +21,173 @@ def get_logger(context='generic', file=True):
     return logger
 
 
-def test_docker_auth(monkeypatch):
+def _stored(username, password):
+    """ The credentials as every provider holds them, base64 encoded like `hubapi/deployment.py` stores them """
+    return {'docker_username': base64.b64encode(username.encode('ascii')).decode('ascii'),
+            'docker_password': base64.b64encode(password.encode('ascii')).decode('ascii')}
+
+
+class _SSMStub:
+    """ `get_parameters` of a boto3 SSM client, over `parameters` """
+    parameters = {}
+
+    def get_parameters(self, Names, WithDecryption):
+        return {'Parameters': [{'Name': name, 'Value': self.parameters[name]}
+                               for name in Names if name in self.parameters],
+                'InvalidParameters': [name for name in Names if name not in self.parameters]}
+
+
+@pytest.fixture(params=['env', 'file', 'ssm'])
+def docker_secret(request, tmp_path, monkeypatch):
+    """ Selects each provider in turn, yields a function storing the credentials in it """
+    path = tmp_path / 'docker_secret.json'
+    monkeypatch.setenv('JINA_DOCKER_SECRET_SOURCE', request.param)
+    monkeypatch.setenv('JINA_DOCKER_SECRET_FILE', str(path))
+    monkeypatch.setenv('JINA_DOCKER_SECRET_SSM_PATH', '/hubapi/docker/')
+    monkeypatch.setitem(sys.modules, 'boto3', types.SimpleNamespace(client=lambda service: _SSMStub()))
+    monkeypatch.setattr(_SSMStub, 'parameters', {})
+
+    def _store(username, password):
+        secret = _stored(username, password)
+        if request.param == 'env':
+            monkeypatch.setenv('JINA_DOCKER_USERNAME', secret['docker_username'])
+            monkeypatch.setenv('JINA_DOCKER_PASSWORD', secret['docker_password'])
+        elif request.param == 'file':
+            path.write_text(json.dumps(secret))
+        else:
+            _SSMStub.parameters.update({'/hubapi/docker/username': secret['docker_username'],
+                                        '/hubapi/docker/password': secret['docker_password']})
+        docker_auth.reset_secret_cache()
+
+    yield _store
+    docker_auth.reset_secret_cache()
+
+
+def test_docker_auth(docker_secret):
+    docker_secret('test_username', 'test_password')
 
-    monkeypatch.setenv('JINA_DOCKER_USERNAME', 'test_username')
-    monkeypatch.setenv('JINA_DOCKER_PASSWORD', 'test_password')
-   
     returned_body = lambda_handler(None, None)
-    docker_creds =  json.loads(returned_body['body'])
-    assert returned_body['statusCode'] == 200
-    assert docker_creds['docker_username'] ==  'test_username'
-    assert docker_creds['docker_password'] == 'test_password'
\ No newline at end of file
+    docker_creds = json.loads(returned_body['body'])
+    assert returned_body['statusCode'] == 200 and returned_body['isBase64Encoded'] is False
+    # handed out as stored
+    assert docker_creds == _stored('test_username', 'test_password')
+    assert docker_auth.decode_credentials(docker_creds) == ('test_username', 'test_password')
+
+
+def test_secret_provider_is_abstract():
+    with pytest.raises(TypeError):
+        docker_auth.SecretProvider()
+
+
+@pytest.fixture
+def docker_secret_file(tmp_path, monkeypatch):
+    path = tmp_path / 'docker_secret.json'
+    path.write_text(json.dumps(_stored('file_username', 'file_password')))
+    monkeypatch.setenv('JINA_DOCKER_SECRET_SOURCE', 'file')
+    monkeypatch.setenv('JINA_DOCKER_SECRET_FILE', str(path))
+    docker_auth.reset_secret_cache()
+    yield path
+    docker_auth.reset_secret_cache()
+
+
+def test_docker_auth_secret_cached(docker_secret_file):
+    assert json.loads(lambda_handler(None, None)['body']) == _stored('file_username', 'file_password')
+
+    # warm invocations don't read the secret again
+    docker_secret_file.unlink()
+    for _ in range(3):
+        assert json.loads(lambda_handler(None, None)['body']) == _stored('file_username', 'file_password')
+
+    docker_auth.secret_cache().clear()
+    assert lambda_handler(None, None)['statusCode'] == 500
+
+
+def test_secret_refreshed_ahead_of_expiry(docker_secret_file):
+    cache = docker_auth.SecretCache(provider=docker_auth.FileSecretProvider(path=str(docker_secret_file)),
+                                    ttl=60, refresh_ahead=60)
+    assert docker_auth.decode_credentials(cache.get())[0] == 'file_username'
+
+    docker_secret_file.write_text(json.dumps(_stored('rotated', 'rotated')))
+    # within `refresh_ahead` of the expiry: the cached secret is returned & the next one fetched in the background
+    assert docker_auth.decode_credentials(cache.get())[0] == 'file_username'
+    for _ in range(100):
+        if docker_auth.decode_credentials(cache.get())[0] == 'rotated':
+            break
+        time.sleep(0.01)
+    assert docker_auth.decode_credentials(cache.get())[0] == 'rotated'
+
+
+class _RegistryStub(BaseHTTPRequestHandler):
+    """ Mints `token-<n>` for the `file_username:file_password` basic credentials """
+    requests = 0
+
+    def do_GET(self):
+        _RegistryStub.requests += 1
+        query = parse_qs(urlparse(self.path).query)
+        expected = base64.b64encode(b'file_username:file_password').decode('ascii')
+        if self.headers.get('Authorization') == f'Basic {expected}' and query['scope'][0].endswith(':pull'):
+            body = json.dumps({'token': f'token-{_RegistryStub.requests}', 'expires_in': 300}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def registry_stub(docker_secret, monkeypatch):
+    docker_secret('file_username', 'file_password')
+
+    server = HTTPServer(('127.0.0.1', 0), _RegistryStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _RegistryStub.requests = 0
+    monkeypatch.setattr(docker_auth.Registry, 'AUTH_URL', f'http://127.0.0.1:{server.server_port}/token')
+    monkeypatch.setattr(docker_auth, 'REGISTRY_TOKEN_CACHE',
+                        docker_auth.RegistryTokenCache(max_size=2, refresh_margin=15))
+    yield _RegistryStub
+    server.shutdown()
+    server.server_close()
+
+
+def _pull(repository):
+    return lambda_handler({'queryStringParameters': {'repository': repository}}, None)
+
+
+def test_registry_token_shared_per_repository(registry_stub):
+    for _ in range(3):
+        response = _pull('jinahub/pod.encoder.dummy')
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert body['token'] == body['access_token'] == 'token-1'
+        assert body['scope'] == 'repository:jinahub/pod.encoder.dummy:pull'
+        assert 0 < body['expires_in'] <= 300
+    assert json.loads(_pull('jinahub/pod.crafter.dummy')['body'])['token'] == 'token-2'
+    assert registry_stub.requests == 2
+
+    # close to its expiry, the token gets minted again
+    docker_auth.REGISTRY_TOKEN_CACHE.refresh_margin = 300
+    assert json.loads(_pull('jinahub/pod.encoder.dummy')['body'])['token'] == 'token-3'
+
+
+def test_registry_token_only_for_our_repositories(registry_stub, monkeypatch):
+    for repository in ['library/ubuntu', 'jinahub/../other', 'jinahub/pod:latest']:
+        assert _pull(repository)['statusCode'] == 400
+    assert registry_stub.requests == 0
+
+    monkeypatch.setenv('JINA_DOCKER_RAW_CREDENTIALS', 'false')
+    assert lambda_handler({'queryStringParameters': None}, None)['statusCode'] == 400
+
+
+def test_registry_token_login_failure(registry_stub, docker_secret):
+    docker_secret('wrong', 'wrong')
+    assert _pull('jinahub/pod.encoder.dummy')['statusCode'] == 502
+    assert _pull('jinahub/pod.encoder.dummy')['statusCode'] == 502
+    # failures aren't cached
+    assert registry_stub.requests == 2
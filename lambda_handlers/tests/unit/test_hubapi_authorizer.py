@@ -0,0 +1,137 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from ... import hubapi_authorizer
+
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:123456789012:abcdef1234/dev/POST/push'
+
+
+class _GitHubStub(BaseHTTPRequestHandler):
+    """
+    Accepts `token valid` (of `jina-dev`) & the installation token `token app`, rejects any other token.
+    Rate limits every token while `rate_limited`
+    """
+    requests = 0
+    rate_limited = False
+
+    def do_GET(self):
+        _GitHubStub.requests += 1
+        if _GitHubStub.rate_limited:
+            self.send_response(403)
+            self.send_header('X-RateLimit-Remaining', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/user' and self.headers.get('Authorization') == 'token valid':
+            body = json.dumps({'login': 'jina-dev', 'id': 42}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.headers.get('Authorization') == 'token app':
+            self.send_response(403 if self.path == '/user' else 200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github_stub(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), _GitHubStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _GitHubStub.requests = 0
+    _GitHubStub.rate_limited = False
+    monkeypatch.setattr(hubapi_authorizer.GitHub, 'URL', f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setattr(hubapi_authorizer, 'TOKEN_CACHE',
+                        hubapi_authorizer.TokenCache(max_size=2, valid_ttl=60, invalid_ttl=60))
+    monkeypatch.delenv('JINA_TOKEN_CACHE_TABLE', raising=False)
+    yield _GitHubStub
+    server.shutdown()
+    server.server_close()
+
+
+def _authorize(token):
+    return hubapi_authorizer.lambda_handler({'authorizationToken': token, 'methodArn': METHOD_ARN}, None)
+
+
+def test_token_validity_cached(github_stub):
+    for _ in range(3):
+        assert _authorize('valid')['policyDocument']['Statement'][0]['Resource'] == \
+               ('arn:aws:execute-api:us-east-1:123456789012:abcdef1234/*/*/*',)
+        assert _authorize('invalid')['policyDocument']['Statement'][-1]['Effect'] == 'Deny'
+    assert github_stub.requests == 2
+
+
+def test_invalid_token_cached_shorter(github_stub):
+    hubapi_authorizer.TOKEN_CACHE.invalid_ttl = 0
+    assert hubapi_authorizer.validate_github_token('invalid') == {}
+    assert hubapi_authorizer.validate_github_token('invalid') == {}
+    assert hubapi_authorizer.validate_github_token('valid') == {'login': 'jina-dev', 'id': 42}
+    assert hubapi_authorizer.validate_github_token('valid') == {'login': 'jina-dev', 'id': 42}
+    assert github_stub.requests == 3
+
+
+def test_github_identity_in_context(github_stub):
+    response = _authorize('valid')
+    assert response['principalId'] == 'github|42'
+    assert response['context'] == {'github_login': 'jina-dev', 'github_id': '42'}
+
+    response = _authorize('invalid')
+    assert response['principalId'] == hubapi_authorizer.ANONYMOUS_PRINCIPAL
+    assert response['context'] == {}
+
+
+def test_installation_token(github_stub):
+    response = _authorize('app')
+    assert response['principalId'].startswith('github-installation|')
+    assert response['context'] == {}
+    assert response['policyDocument']['Statement'][0]['Resource'] == \
+           ('arn:aws:execute-api:us-east-1:123456789012:abcdef1234/*/*/*',)
+    assert github_stub.requests == 2
+    assert _authorize('app')['principalId'] == response['principalId']
+    assert github_stub.requests == 2
+
+
+def test_rate_limited_token_not_cached(github_stub):
+    github_stub.rate_limited = True
+    response = _authorize('valid')
+    assert response['principalId'] == hubapi_authorizer.ANONYMOUS_PRINCIPAL
+    assert github_stub.requests == 1
+
+    # a rate limited 403 isn't taken for an installation token, & the next request asks GitHub again
+    github_stub.rate_limited = False
+    assert _authorize('valid')['principalId'] == 'github|42'
+    assert github_stub.requests == 2
+
+
+def test_token_cache_bounded():
+    cache = hubapi_authorizer.TokenCache(max_size=2, valid_ttl=60, invalid_ttl=60)
+    for token in ['a', 'b', 'c']:
+        cache.put(hubapi_authorizer.TokenCache.key(token), {'login': token, 'id': 1})
+    assert cache.get(hubapi_authorizer.TokenCache.key('a')) is None
+    assert cache.get(hubapi_authorizer.TokenCache.key('c')) == {'login': 'c', 'id': 1}
+    assert 'c' not in cache._entries
+
+
+def test_policy_document_memoized():
+    hubapi_authorizer.policy_document.cache_clear()
+    documents = [hubapi_authorizer.policy_document(shape=hubapi_authorizer.PolicyShape.READ_ONLY,
+                                                   aws_account_id='123456789012', rest_api_id='abcdef1234',
+                                                   region='us-east-1', stage='dev') for _ in range(2)]
+    assert documents[0] is documents[1]
+    assert json.loads(json.dumps(documents[0]))['Statement'][1] == {
+        'Action': 'execute-api:Invoke', 'Effect': 'Deny',
+        'Resource': ['arn:aws:execute-api:us-east-1:123456789012:abcdef1234/*/POST/push/']
+    }
+    with pytest.raises(TypeError):
+        documents[0]['Statement'] = []
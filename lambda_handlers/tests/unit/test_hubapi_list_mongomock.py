@@ -0,0 +1,271 @@
+import base64
+import gzip
+import json
+
+import mongomock
+import pymongo
+import pytest
+
+from ... import hubapi_list
+from .helpers import build_summary, push, list_images
+
+
+def test_list_reads_latest_collection(hub_db):
+    push(build_summary(name='jinahub/pod.encoder.b', version='0.0.1'))
+    push(build_summary(name='jinahub/pod.encoder.b', version='0.0.2'))
+    push(build_summary(name='jinahub/pod.encoder.a', version='0.0.1', manifest={'kind': 'indexer'}))
+
+    images = json.loads(list_images()['body'])
+    assert [image['docker-name'] for image in images] == ['jinahub/pod.encoder.a', 'jinahub/pod.encoder.b']
+    assert images[1]['version'] == '0.0.2'
+    assert all('_id' not in image for image in images)
+
+    images = json.loads(list_images(kind='Encoder')['body'])
+    assert [image['docker-name'] for image in images] == ['jinahub/pod.encoder.b']
+
+    images = json.loads(list_images(after='jinahub/pod.encoder.a', **{'n-per-page': '1'})['body'])
+    assert [image['docker-name'] for image in images] == ['jinahub/pod.encoder.b']
+
+
+@pytest.mark.parametrize('search_mode', ['ngram', 'regex'])
+@pytest.mark.parametrize('jina_version', [None, '1.0.0'])
+def test_list_name_search(hub_db, search_mode, jina_version):
+    push(build_summary(name='jinahub/pod.encoder.torchencoder'))
+    push(build_summary(name='jinahub/pod.encoder.tfencoder', version='0.0.2'))
+    push(build_summary(name='jinahub/pod.indexer.faiss', manifest={'kind': 'indexer', 'name': 'FaissIndexer'}))
+
+    params = {'search-mode': search_mode}
+    if jina_version:
+        params['jina-version'] = jina_version
+
+    images = json.loads(list_images(name='TorchEnc', **params)['body'])
+    assert [image['docker-name'] for image in images] == ['jinahub/pod.encoder.torchencoder']
+    assert all('_search' not in image for image in images)
+
+    images = json.loads(list_images(name='indexer', **params)['body'])
+    assert [image['docker-name'] for image in images] == ['jinahub/pod.indexer.faiss']
+
+    assert list_images(name='t.e', **params)['body'] == 'No docs found'
+
+
+def test_list_response_cache(hub_db):
+    push(build_summary(name='jinahub/pod.encoder.a'))
+
+    response = list_images()
+    assert response['headers']['X-Cache'] == 'Miss'
+    response = list_images()
+    assert response['headers']['X-Cache'] == 'Hit'
+    assert response['headers']['X-Cache-Hits'] == '1'
+    assert len(json.loads(response['body'])) == 1
+
+    # order of multi-valued query strings doesn't matter
+    assert list_images(keywords=['numeric', 'nlp'])['headers']['X-Cache'] == 'Miss'
+    assert list_images(keywords=['nlp', 'numeric'])['headers']['X-Cache'] == 'Hit'
+
+    # a push bumps the generation & invalidates every cached response
+    push(build_summary(name='jinahub/pod.encoder.b'))
+    response = list_images()
+    assert response['headers']['X-Cache'] == 'Miss'
+    assert len(json.loads(response['body'])) == 2
+
+
+def test_list_etag(hub_db):
+    push(build_summary(name='jinahub/pod.encoder.a'))
+
+    response = list_images()
+    etag = response['headers']['ETag']
+    assert response['headers']['Cache-Control'].startswith('public')
+
+    response = list_images(headers={'if-none-match': etag})
+    assert response['statusCode'] == 304
+    assert response['body'] == ''
+    assert list_images(headers={'If-None-Match': f'W/{etag}'})['statusCode'] == 304
+
+    # a different query or a new push changes the ETag
+    assert list_images(headers={'If-None-Match': etag}, kind='encoder')['statusCode'] == 200
+    push(build_summary(name='jinahub/pod.encoder.b'))
+    response = list_images(headers={'If-None-Match': etag})
+    assert response['statusCode'] == 200
+    assert response['headers']['ETag'] != etag
+
+
+def test_list_truncated_to_payload_limit(hub_db, monkeypatch):
+    for name in ['a', 'b', 'c']:
+        push(build_summary(name=f'jinahub/pod.encoder.{name}'))
+    full_body = list_images()['body']
+    monkeypatch.setattr(hubapi_list, 'MAX_PAYLOAD_BYTES', len(full_body) - 10)
+
+    response = list_images(kind='encoder')
+    assert [image['docker-name'] for image in json.loads(response['body'])] == \
+           ['jinahub/pod.encoder.a', 'jinahub/pod.encoder.b']
+    token = response['headers']['X-Continuation-Token']
+
+    response = list_images(kind='encoder', **{'continuation-token': token})
+    assert [image['docker-name'] for image in json.loads(response['body'])] == ['jinahub/pod.encoder.c']
+    assert 'X-Continuation-Token' not in response['headers']
+
+    assert list_images(**{'continuation-token': 'not-a-token'})['statusCode'] == 400
+
+
+def test_list_gzip(hub_db):
+    for name in ['a', 'b', 'c']:
+        push(build_summary(name=f'jinahub/pod.encoder.{name}'))
+    plain = list_images()
+    assert plain['isBase64Encoded'] is False
+
+    # API Gateway only decodes the base64 body of the requests accepting its binary media type
+    assert list_images(headers={'Accept-Encoding': 'gzip, deflate, br', 'Accept': '*/*'})['isBase64Encoded'] is False
+
+    compressed = list_images(headers={'Accept-Encoding': 'gzip, deflate, br', 'Accept': 'application/json'})
+    assert compressed['isBase64Encoded'] is True
+    assert compressed['headers']['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(base64.b64decode(compressed['body'])).decode('utf-8') == plain['body']
+
+
+@pytest.mark.parametrize('params', [{}, {'jina-version': '1.0.0'}])
+def test_list_keyset_pagination(hub_db, monkeypatch, params):
+    names = [f'jinahub/pod.encoder.{name}' for name in ['a', 'b', 'c', 'd', 'e']]
+    for name in names:
+        push(build_summary(name=name))
+        push(build_summary(name=name, version='0.0.2'))
+    monkeypatch.setattr(hubapi_list, 'MAX_PAGE_SIZE', 2)
+
+    response = list_images(**params, **{'with-total': 'true'})
+    assert response['headers']['X-Total-Count'] == '5'
+
+    listed = []
+    token = None
+    while True:
+        page_params = dict(params, **{'continuation-token': token}) if token else params
+        response = list_images(**page_params)
+        images = json.loads(response['body'])
+        assert len(images) <= 2
+        assert all(image['version'] == '0.0.2' for image in images)
+        listed.extend(image['docker-name'] for image in images)
+        token = response['headers'].get('X-Continuation-Token')
+        if not token:
+            break
+    assert listed == names
+
+    assert list_images(**{'n-per-page': '0'})['statusCode'] == 400
+    assert list_images(**{'n-per-page': 'all'})['statusCode'] == 400
+
+
+@pytest.mark.parametrize('params', [{}, {'jina-version': '1.0.0'}])
+def test_list_exactly_full_last_page(hub_db, monkeypatch, params):
+    names = [f'jinahub/pod.encoder.{name}' for name in ['a', 'b', 'c', 'd']]
+    for name in names:
+        push(build_summary(name=name))
+    monkeypatch.setattr(hubapi_list, 'MAX_PAGE_SIZE', 2)
+
+    response = list_images(**params)
+    assert [image['docker-name'] for image in json.loads(response['body'])] == names[:2]
+    token = response['headers']['X-Continuation-Token']
+
+    response = list_images(**params, **{'continuation-token': token})
+    assert response['statusCode'] == 200
+    assert [image['docker-name'] for image in json.loads(response['body'])] == names[2:]
+    assert 'X-Continuation-Token' not in response['headers']
+
+
+def test_list_read_options(monkeypatch):
+    monkeypatch.setenv('JINA_LIST_MAX_STALENESS_SECONDS', '120')
+    monkeypatch.setenv('JINA_LIST_MAX_TIME_MS', '1500')
+    hubapi_list.read_options.cache_clear()
+    options = hubapi_list.read_options()
+    hubapi_list.read_options.cache_clear()
+    assert options['read_preference'].max_staleness == 120
+    assert options['read_preference'].mode == pymongo.ReadPreference.SECONDARY_PREFERRED.mode
+    assert options['max_time_ms'] == 1500
+
+
+def test_list_time_budget_exceeded(hub_db, monkeypatch):
+    assert push(build_summary())['statusCode'] == 200
+
+    def _aggregate(collection, pipeline, **kwargs):
+        assert kwargs['maxTimeMS'] == hubapi_list.DEFAULT_MAX_TIME_MS and kwargs['allowDiskUse'] is True
+        assert kwargs['hint'] == hubapi_list.ListIndex.LIVE_JINA_VERSION_NAME
+        raise pymongo.errors.ExecutionTimeout('operation exceeded time limit', code=50)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'aggregate', _aggregate)
+    response = list_images(**{'jina-version': '1.0.0'})
+    assert response['statusCode'] == 503
+    assert response['headers']['Retry-After'] == str(hubapi_list.RETRY_AFTER_SECONDS)
+
+
+@pytest.mark.parametrize('failing_read', ['call', 'iteration'])
+def test_list_read_failure(hub_db, monkeypatch, failing_read):
+    assert push(build_summary())['statusCode'] == 200
+
+    class _KilledCursor:
+        def hint(self, index):
+            return self
+
+        def __iter__(self):
+            raise pymongo.errors.OperationFailure('cursor killed', code=237)
+
+    find = mongomock.collection.Collection.find
+
+    def _find(collection, *args, **kwargs):
+        if collection.name != 'hubpod_latest':
+            return find(collection, *args, **kwargs)
+        if failing_read == 'call':
+            # `MongoDBHandler.find` logs the error & returns `None`
+            raise pymongo.errors.OperationFailure('not authorized', code=13)
+        return _KilledCursor()
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'find', _find)
+    response = list_images()
+    assert response['statusCode'] == 502
+    assert hubapi_list.RESPONSE_CACHE.get(key=hubapi_list.cache_key({}), generation=1) is None
+
+
+@pytest.mark.parametrize('params, index', [
+    ({}, hubapi_list.ListIndex.ID),
+    ({'after': 'jinahub/pod.a'}, hubapi_list.ListIndex.ID),
+    ({'kind': 'encoder', 'type': 'pod'}, hubapi_list.ListIndex.KIND),
+    ({'type': 'pod'}, hubapi_list.ListIndex.TYPE),
+    ({'kind': 'encoder', 'keywords': ['nlp']}, hubapi_list.ListIndex.KEYWORDS),
+    ({'keywords': ['nlp'], 'name': 'dummy', 'search_mode': 'ngram'}, hubapi_list.ListIndex.SEARCH_NGRAMS),
+    ({'keywords': ['nlp'], 'name': 'dummy'}, hubapi_list.ListIndex.KEYWORDS),
+    ({'name': 'dummy', 'search_mode': 'regex'}, hubapi_list.ListIndex.ID),
+])
+def test_latest_query_hint(params, index):
+    assert hubapi_list.latest_query_hint(**params) == index
+
+
+@pytest.mark.parametrize('params, index', [
+    ({'version': '0.0.1'}, hubapi_list.ListIndex.LIVE_VERSION_NAME),
+    ({'version': '0.0.1', 'jina_version': '1.0.0', 'name': 'dummy'}, hubapi_list.ListIndex.LIVE_JINA_VERSION_NAME),
+    ({'kind': 'encoder'}, hubapi_list.ListIndex.LIVE_NAME),
+])
+def test_aggregation_hint(params, index):
+    assert hubapi_list.aggregation_hint(**params) == index
+
+
+def test_latest_image_by_packed_sort_key(hub_db):
+    for version, jina_version in [('0.0.9', '1.0.0'), ('0.0.10', '1.0.0'), ('0.0.11-rc.1', '1.0.0'),
+                                  ('0.0.1', '0.9.13')]:
+        push(build_summary(version=version, jina_version=jina_version))
+
+    assert len({document['_sort_key'] for document in hub_db['hubpod'].find()}) == 4
+    images = json.loads(list_images()['body'])
+    assert [(image['version'], image['jina-version']) for image in images] == [('0.0.11-rc.1', '1.0.0')]
+
+    push(build_summary(version='0.0.11', jina_version='1.0.0'))
+    assert json.loads(list_images()['body'])[0]['version'] == '0.0.11'
+
+
+def test_list_skips_soft_deleted_builds(hub_db):
+    push(build_summary(version='0.0.1'))
+    push(build_summary(version='0.0.2'))
+    hub_db['hubpod'].update_one({'version': '0.0.2'}, {'$set': {'_deleted': True}})
+
+    images = json.loads(list_images(jina_version='1.0.0')['body'])
+    assert [image['version'] for image in images] == ['0.0.1']
+
+    # pushing the build again brings it back
+    push(dict(build_summary(version='0.0.2'), details={'rebuilt': True}))
+    assert hub_db['hubpod'].find_one({'version': '0.0.2'})['_deleted'] is False
+    assert hub_db['metadata'].find_one({'version': '0.0.2'})['_deleted'] is False
+    assert json.loads(list_images(jina_version='1.0.0')['body'])[0]['version'] == '0.0.2'
@@ -0,0 +1,316 @@
+import base64
+import datetime
+import json
+import time
+
+import mongomock
+import pymongo
+import pytest
+
+from ... import hubapi_list
+from ... import hubapi_push
+from .helpers import build_summary, push
+
+
+def test_push_maintains_latest_collection(hub_db):
+    assert push(build_summary(version='0.0.2'))['statusCode'] == 200
+    assert push(build_summary(version='0.0.10'))['statusCode'] == 200
+    assert push(build_summary(version='0.0.3'))['statusCode'] == 200
+
+    assert hub_db['hubpod'].count_documents({}) == 3
+    latest = list(hub_db['hubpod_latest'].find())
+    assert len(latest) == 1
+    assert latest[0]['_id'] == 'jinahub/pod.encoder.dummyencoder'
+    assert latest[0]['version'] == '0.0.10'
+    assert latest[0]['docker-command'] == 'docker pull jinahub/pod.encoder.dummyencoder:0.0.10-1.0.0'
+
+
+def test_push_base64_encoded_body(hub_db):
+    event = {'body': base64.b64encode(json.dumps(build_summary()).encode('utf-8')).decode('ascii'),
+             'isBase64Encoded': True}
+    assert hubapi_push.lambda_handler(event, None)['statusCode'] == 200
+    assert hub_db['hubpod'].count_documents({}) == 1
+
+
+def test_batch_push(hub_db):
+    push(build_summary(name='jinahub/pod.encoder.a'))
+
+    summaries = [
+        build_summary(name='jinahub/pod.encoder.b', version='0.0.2'),
+        build_summary(name='jinahub/pod.encoder.b', version='0.0.10'),
+        {'name': 'jinahub/pod.encoder.broken'},
+        build_summary(name='jinahub/pod.encoder.a')
+    ]
+    response = push(summaries)
+    assert response['statusCode'] == 207
+    assert [status['status'] for status in json.loads(response['body'])] == \
+           ['created', 'created', 'invalid', 'updated']
+
+    assert hub_db['hubpod'].count_documents({}) == 3
+    assert hub_db['metadata'].find_one({'name': 'jinahub/pod.encoder.a'})['build_history'] == \
+           [{'time': '2020-10-22'}, {'time': '2020-10-22'}]
+    assert hub_db['hubpod_latest'].find_one({'_id': 'jinahub/pod.encoder.b'})['version'] == '0.0.10'
+
+    assert push([])['statusCode'] == 400
+
+
+def test_push_upserts(hub_db):
+    assert push(build_summary())['body'] == 'Created new doc in MongoDB'
+    summary = build_summary(manifest={'description': 'updated'})
+    summary['build_history'] = [{'time': '2020-10-23'}]
+    summary['is_build_success'] = False
+    assert push(summary)['body'] == 'Updated existing doc in MongoDB'
+
+    assert hub_db['hubpod'].count_documents({}) == 1
+    assert hub_db['hubpod'].find_one()['manifest_info']['description'] == 'updated'
+    metadata = hub_db['metadata'].find_one()
+    assert metadata['is_build_success'] is False
+    assert metadata['build_history'] == [{'time': '2020-10-22'}, {'time': '2020-10-23'}]
+
+
+def test_push_write_failure(hub_db, monkeypatch):
+    def _update_one(collection, *args, **kwargs):
+        raise pymongo.errors.WriteConcernError('waiting for replication timed out', code=64)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'update_one', _update_one)
+    response = push(build_summary())
+    assert response['statusCode'] == 502
+
+    # the hubpod document went through before the metadata write failed, the build isn't promoted though
+    assert hub_db['hubpod'].count_documents({}) == 1
+    assert hub_db['hubpod_latest'].count_documents({}) == 0
+    assert hub_db['metadata_idempotency'].count_documents({}) == 0
+
+
+def test_build_history_archive(hub_db, monkeypatch):
+    monkeypatch.setattr(hubapi_push, 'BUILD_HISTORY_INLINE', 3)
+    monkeypatch.setattr(hubapi_push, 'BUILD_HISTORY_BUCKET_SIZE', 2)
+    for day in range(10, 15):
+        summary = build_summary()
+        summary['build_history'] = [{'time': f'2020-10-{day}'}]
+        assert push(summary)['statusCode'] == 200
+
+    metadata = hub_db['metadata'].find_one()
+    assert metadata['build_count'] == 5
+    assert metadata['build_history'] == [{'time': f'2020-10-{day}'} for day in range(12, 15)]
+    assert hub_db['metadata_archive'].count_documents({}) == 3
+
+    params = {'name': 'jinahub/pod.encoder.dummyencoder', 'version': '0.0.1', 'jina-version': '1.0.0',
+              'n-per-page': '3'}
+    history, tokens = [], []
+    while True:
+        response = hubapi_list.lambda_handler({'resource': '/history', 'queryStringParameters': params,
+                                               'multiValueQueryStringParameters': None}, None)
+        assert response['statusCode'] == 200
+        history += json.loads(response['body'])
+        if 'X-Continuation-Token' not in response['headers']:
+            break
+        tokens.append(response['headers']['X-Continuation-Token'])
+        params = dict(params, **{'continuation-token': tokens[-1]})
+    assert len(tokens) == 1
+    assert history == [{'time': f'2020-10-{day}'} for day in range(10, 15)]
+
+    response = hubapi_list.lambda_handler({'resource': '/history', 'queryStringParameters': {'name': 'x'},
+                                           'multiValueQueryStringParameters': None}, None)
+    assert response['statusCode'] == 400
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_build_history_buckets_never_overflow(hub_db, monkeypatch, batch):
+    monkeypatch.setattr(hubapi_push, 'BUILD_HISTORY_BUCKET_SIZE', 2)
+    for days in [range(10, 11), range(11, 16), range(16, 19)]:
+        summary = build_summary()
+        summary['build_history'] = [{'time': f'2020-10-{day}'} for day in days]
+        assert push([summary] if batch else summary)['statusCode'] == 200
+
+    buckets = list(hub_db['metadata_archive'].find(sort=[('bucket', 1)]))
+    assert [bucket['count'] for bucket in buckets] == [2, 2, 2, 2, 1]
+    assert [entry for bucket in buckets for entry in bucket['entries']] == \
+        [{'time': f'2020-10-{day}'} for day in range(10, 19)]
+
+
+def test_push_identity_and_daily_quota(hub_db, monkeypatch):
+    monkeypatch.setenv('JINA_PUSH_DAILY_QUOTA', '2')
+    authorizer = {'github_login': 'jina-dev', 'github_id': '42'}
+
+    def _push_as(summary):
+        return hubapi_push.lambda_handler({'body': json.dumps(summary),
+                                           'requestContext': {'authorizer': authorizer}}, None)
+
+    assert _push_as(build_summary())['statusCode'] == 200
+    assert hub_db['metadata'].find_one()['pushed_by'] == {'login': 'jina-dev', 'id': '42'}
+
+    response = _push_as([build_summary(version='0.0.2'), build_summary(version='0.0.3')])
+    assert response['statusCode'] == 429
+    assert 0 < int(response['headers']['Retry-After']) <= 24 * 3600
+    assert hub_db['hubpod'].count_documents({}) == 1
+
+    # the rejected batch didn't use up the quota, & invalid summaries don't count against it
+    assert _push_as([build_summary(version='0.0.4'), {'name': 'jinahub/pod.encoder.broken'}])['statusCode'] == 207
+    assert hub_db['metadata_quota'].find_one()['pushes'] == 2
+    assert _push_as(build_summary(version='0.0.5'))['statusCode'] == 429
+    assert hub_db['hubpod'].count_documents({}) == 2
+
+    # pushes without a GitHub identity (e.g. from CI with the push key) aren't counted
+    assert push(build_summary(version='0.0.2'))['statusCode'] == 200
+    assert 'pushed_by' not in hub_db['metadata'].find_one({'version': '0.0.2'})
+
+
+def test_push_idempotent_replay(hub_db):
+    first = push(build_summary())
+    assert first['body'] == 'Created new doc in MongoDB'
+
+    # same summary with reordered keys, e.g. a CI retry
+    replayed = hubapi_push.lambda_handler({'body': json.dumps(build_summary(), sort_keys=True)}, None)
+    assert replayed['body'] == first['body']
+    assert replayed['headers']['Idempotent-Replayed'] == 'true'
+    assert hub_db['metadata'].find_one()['build_count'] == 1
+
+    assert push(build_summary(version='0.0.2'))['body'] == 'Created new doc in MongoDB'
+    hub_db['metadata_idempotency'].update_many({}, {'$set': {'expires_at': datetime.datetime(2020, 1, 1)}})
+    assert push(build_summary())['body'] == 'Updated existing doc in MongoDB'
+    assert hub_db['metadata'].find_one({'version': '0.0.1'})['build_count'] == 2
+
+
+def test_push_idempotency_key_reserved(hub_db):
+    key = hubapi_push.idempotency_key(summary=build_summary(), principal=None)
+    lease = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+    hub_db['metadata_idempotency'].insert_one({'_id': key, 'pending': True, 'expires_at': lease})
+
+    # an identical push is still in progress
+    response = push(build_summary())
+    assert response['statusCode'] == 409
+    assert hub_db['hubpod'].count_documents({}) == 0
+
+    # its Lambda died without releasing the key
+    hub_db['metadata_idempotency'].update_one({'_id': key}, {'$set': {'expires_at': datetime.datetime(2020, 1, 1)}})
+    assert push(build_summary())['body'] == 'Created new doc in MongoDB'
+    remembered = hub_db['metadata_idempotency'].find_one({'_id': key})
+    assert 'pending' not in remembered and remembered['status'] == 200
+
+
+def test_push_throttled_not_replayed(hub_db, monkeypatch):
+    monkeypatch.setenv('JINA_PUSH_BURST', '1')
+    monkeypatch.setenv('JINA_PUSH_RATE_PER_MINUTE', '1')
+    event = {'body': json.dumps(build_summary()), 'requestContext': {'authorizer': {'principalId': 'github|42'}}}
+    hub_db['metadata_rate_limit'].insert_one({'_id': 'github|42', 'tokens': 0, 'updated_at': time.time()})
+
+    assert hubapi_push.lambda_handler(event, None)['statusCode'] == 429
+    assert hub_db['metadata_idempotency'].count_documents({}) == 0
+
+    # the replay check comes before the rate limit, so retries of a done push don't spend tokens
+    hub_db['metadata_rate_limit'].update_one({'_id': 'github|42'}, {'$inc': {'updated_at': -60}})
+    assert hubapi_push.lambda_handler(event, None)['statusCode'] == 200
+    replayed = hubapi_push.lambda_handler(event, None)
+    assert replayed['headers']['Idempotent-Replayed'] == 'true'
+    assert hub_db['metadata_rate_limit'].find_one()['tokens'] < 1
+
+
+def test_batch_with_failed_summary_not_replayed(hub_db, monkeypatch):
+    bulk_write = hubapi_push.MongoDBHandler.bulk_write
+
+    def _fail_first_metadata_write(self, requests, ordered=False):
+        result = bulk_write(self, requests[1:] if self.collection_name == 'metadata' else requests, ordered)
+        if self.collection_name == 'metadata':
+            monkeypatch.setattr(hubapi_push.MongoDBHandler, 'bulk_write', bulk_write)
+            result = {'upserted': {index + 1 for index in result['upserted']},
+                      'errors': dict({0: 'write failed'}, **{index + 1: error
+                                                              for index, error in result['errors'].items()})}
+        return result
+
+    summaries = [build_summary(version='0.0.1'), build_summary(version='0.0.2')]
+    monkeypatch.setattr(hubapi_push.MongoDBHandler, 'bulk_write', _fail_first_metadata_write)
+    response = push(summaries)
+    assert response['statusCode'] == 207
+    assert [status['status'] for status in json.loads(response['body'])] == ['failed', 'created']
+    assert hub_db['metadata_idempotency'].count_documents({}) == 0
+
+    # the retry goes through instead of replaying the failure
+    response = push(summaries)
+    assert response['statusCode'] == 200 and 'Idempotent-Replayed' not in response['headers']
+    assert hub_db['metadata'].count_documents({}) == 2
+
+
+def test_batch_promotes_only_fully_written_summaries(hub_db, monkeypatch):
+    bulk_write = hubapi_push.MongoDBHandler.bulk_write
+
+    def _fail_archiving_a(self, requests, ordered=False):
+        if self.collection_name != 'metadata_archive':
+            return bulk_write(self, requests, ordered)
+        failing = {index for index, request in enumerate(requests)
+                   if request._filter['name'] == 'jinahub/pod.encoder.a'}
+        result = bulk_write(self, [request for index, request in enumerate(requests) if index not in failing], ordered)
+        assert not ordered and not result['errors']
+        return {'upserted': set(), 'errors': {index: 'write failed' for index in failing}}
+
+    monkeypatch.setattr(hubapi_push.MongoDBHandler, 'bulk_write', _fail_archiving_a)
+    summary_a = build_summary(name='jinahub/pod.encoder.a')
+    summary_a['build_history'] = [{'time': '2020-10-22'}, {'time': '2020-10-23'}]
+    response = push([summary_a, build_summary(name='jinahub/pod.encoder.b')])
+    assert [status['status'] for status in json.loads(response['body'])] == ['failed', 'created']
+
+    # the failure of `a` didn't hold back `b`, which is the only one promoted
+    assert hub_db['metadata_archive'].count_documents({'name': 'jinahub/pod.encoder.b'}) == 1
+    assert hub_db['metadata_archive'].count_documents({'name': 'jinahub/pod.encoder.a'}) == 0
+    assert [document['_id'] for document in hub_db['hubpod_latest'].find()] == ['jinahub/pod.encoder.b']
+
+
+def test_push_rate_limit(hub_db, monkeypatch):
+    monkeypatch.setenv('JINA_PUSH_BURST', '2')
+    monkeypatch.setenv('JINA_PUSH_RATE_PER_MINUTE', '1')
+
+    def _push_as(principal, version):
+        return hubapi_push.lambda_handler({'body': json.dumps(build_summary(version=version)),
+                                           'requestContext': {'authorizer': {'principalId': principal}}}, None)
+
+    assert [_push_as('github|42', f'0.0.{i}')['statusCode'] for i in range(3)] == [200, 200, 429]
+    assert 0 < int(_push_as('github|42', '0.0.4')['headers']['Retry-After']) <= 60
+    assert _push_as('github|7', '0.0.5')['statusCode'] == 200
+    assert _push_as('anonymous', '0.0.6')['statusCode'] == 200
+
+    # a minute later the bucket has one token again
+    hub_db['metadata_rate_limit'].update_one({'_id': 'github|42'}, {'$inc': {'updated_at': -60}})
+    assert _push_as('github|42', '0.0.7')['statusCode'] == 200
+    assert hub_db['hubpod'].count_documents({}) == 5
+
+
+def test_push_rate_limit_fails_open(hub_db, monkeypatch):
+    # `MongoDBHandler.find_one_and_update` returns `None` when the rate limit document can't be read
+    monkeypatch.setattr(hubapi_push.MongoDBHandler, 'find_one_and_update', lambda *args, **kwargs: None)
+    response = hubapi_push.lambda_handler({'body': json.dumps(build_summary()),
+                                           'requestContext': {'authorizer': {'principalId': 'github|42',
+                                                                             'github_login': 'jina-dev',
+                                                                             'github_id': '42'}}}, None)
+    assert response['statusCode'] == 200
+
+
+def test_parse_summary_sanitizes_every_list_item():
+    summary = build_summary(manifest={'keywords': ['a.b']})
+    summary['details'] = {'layers.count': 2, 'steps': [{'step.1': 'pull'}, {'step.2': [{'cmd.args': ['x.y']}]}]}
+    summary['build_history'] = [{'time': '2020-10-22'}, {'docker.tag': 'latest'}]
+
+    _, hubpod_document, metadata_document = hubapi_push.parse_summary(summary=summary, logger=None)
+    assert metadata_document['details'] == {'layers_count': 2,
+                                            'steps': [{'step_1': 'pull'}, {'step_2': [{'cmd_args': ['x.y']}]}]}
+    assert metadata_document['build_history'][1] == {'docker_tag': 'latest'}
+    assert hubpod_document['manifest_info']['keywords'] == ['a.b']
+    assert summary['details']['steps'][1] == {'step.2': [{'cmd.args': ['x.y']}]}
+
+
+@pytest.mark.parametrize('lower, higher', [
+    ('0.0.9', '0.0.10'),
+    ('0.9.9', '0.10.0'),
+    ('1.0.0-rc.1', '1.0.0'),
+    ('1.0.0-alpha', '1.0.0-beta.2'),
+    ('1.0.0-rc.2', '1.0.0-rc.10'),
+    ('0.9.0+build.7', '1.0.0-dev'),
+])
+def test_semver_sort_key(lower, higher):
+    assert hubapi_push.parse_semver(lower).sort_key < hubapi_push.parse_semver(higher).sort_key
+
+
+def test_semver_rejects_invalid():
+    assert hubapi_push.parse_semver('v1.2.3+build.1') == (1, 2, 3, None, 'build.1')
+    for version in ['1.2', '1.2.3.4', 'latest', '1.2.x']:
+        with pytest.raises(ValueError):
+            hubapi_push.parse_semver(version)
@@ -0,0 +1,110 @@
+import json
+import logging
+
+import pymongo
+import pytest
+
+import hubdb
+from hubdb import LATENCY_STATS, MongoClientRegistry, MongoDBHandler
+
+
+class _FakeAdmin:
+    def command(self, name):
+        return {'ok': 1}
+
+
+class _FakeCollection:
+    def __init__(self, client):
+        self.client = client
+
+    def aggregate(self, pipeline, **kwargs):
+        self.client.calls.append(kwargs)
+        if self.client.fail_next:
+            self.client.fail_next = False
+            raise pymongo.errors.AutoReconnect('primary stepped down')
+        return iter([{'docker-name': 'jinahub/pod.encoder.dummy'}])
+
+
+class _FakeMongoClient:
+    instances = []
+    fail_next = False
+
+    def __init__(self, *args, **kwargs):
+        self.admin = _FakeAdmin()
+        self.closed = False
+        self.calls = []
+        self.options = []
+        _FakeMongoClient.instances.append(self)
+
+    def get_database(self, name, **kwargs):
+        self.options.append(kwargs)
+        return {'collection': _FakeCollection(self)}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_mongoclient(monkeypatch):
+    _FakeMongoClient.instances = []
+    monkeypatch.setattr(pymongo, 'MongoClient', _FakeMongoClient)
+    monkeypatch.setattr(MongoClientRegistry, '_clients', {})
+    return _FakeMongoClient
+
+
+def _handler(**kwargs):
+    return MongoDBHandler(hostname='host', username='user', password='password',
+                          database_name='db', collection_name='collection', **kwargs)
+
+
+def test_client_reused_across_invocations(fake_mongoclient):
+    for _ in range(3):
+        with _handler() as db:
+            assert list(db.aggregate(pipeline=[]))
+    assert len(fake_mongoclient.instances) == 1
+    assert not fake_mongoclient.instances[0].closed
+
+
+def test_reconnect_on_failover(fake_mongoclient):
+    with _handler() as db:
+        db.client.fail_next = True
+        assert list(db.aggregate(pipeline=[]))
+    assert len(fake_mongoclient.instances) == 2
+    assert fake_mongoclient.instances[0].closed
+
+
+def test_read_options_and_latency(fake_mongoclient, monkeypatch):
+    monkeypatch.setattr(LATENCY_STATS, 'stats', {})
+    with _handler(read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED, max_time_ms=100) as db:
+        assert list(db.aggregate(pipeline=[], batchSize=10))
+    client = fake_mongoclient.instances[0]
+    assert client.options == [{'read_preference': pymongo.ReadPreference.SECONDARY_PREFERRED,
+                               'write_concern': None}]
+    assert client.calls == [{'maxTimeMS': 100, 'batchSize': 10}]
+    assert LATENCY_STATS.stats['collection.aggregate']['count'] == 1
+
+
+def test_latency_logged_per_invocation(fake_mongoclient, monkeypatch):
+    lines = []
+    monkeypatch.setattr(logging.getLogger('db_latency'), 'info', lines.append)
+
+    @hubdb.log_latency
+    def _handler_fn(event, context):
+        with _handler() as db:
+            list(db.aggregate(pipeline=[]))
+            list(db.aggregate(pipeline=[]))
+        return 'response'
+
+    assert _handler_fn({}, None) == 'response'
+    latency = json.loads(lines[-1])['db_latency']
+    assert latency['collection.aggregate']['count'] == 2
+    assert LATENCY_STATS.stats == {}
+
+
+def test_environment_read_once(mongo_env, monkeypatch):
+    assert hubdb.is_db_envs_set()
+    assert hubdb.read_environment()[0] == 'TestingHost'
+    monkeypatch.setenv('JINA_DB_HOSTNAME', 'T3RoZXJIb3N0')
+    assert hubdb.read_environment()[0] == 'TestingHost'
+    hubdb.reset_environment()
+    assert hubdb.read_environment()[0] == 'OtherHost'